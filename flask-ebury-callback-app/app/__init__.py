@@ -1,12 +1,19 @@
 from flask import Flask
 from flask_socketio import SocketIO
-# from app.ebury_api import start_token_watcher
 
-socketio = SocketIO()
+# Threading mode, served by gunicorn's gthread workers (see gunicorn.conf.py)
+socketio = SocketIO(async_mode='threading')
 
 def create_app():
     app = Flask(__name__)
-    app.config.from_object('app.tyconfig.Config')
+
+    # app/config.py, overridden by EBURY_SETTINGS and FLASK_ environment variables
+    from .startup import check_config, load_config, prepare_preload, start_background
+    load_config(app)
+    check_config(app)
+
+    from .log import configure_logging
+    configure_logging(app.config)
 
     with app.app_context():
         from . import routes
@@ -15,8 +22,11 @@ def create_app():
     # Initialize SocketIO for the auto refreshing of the 'callbacks' page
     socketio.init_app(app)
 
-    # Start the token watcher in a separate thread, this refreshes 
-    # the access token when it gets close to expiry
-    # start_token_watcher(app)
+    # With gunicorn --preload (see gunicorn.conf.py) this runs in the master, the
+    # background work is started in each worker after the fork
+    if app.config.get('EBURY_PRELOAD'):
+        prepare_preload(app)
+    else:
+        start_background(app)
 
-    return app
\ No newline at end of file
+    return app
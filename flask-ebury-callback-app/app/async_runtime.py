@@ -0,0 +1,167 @@
+import asyncio
+import threading
+import time
+import aiohttp
+from flask import current_app
+from .http_client import ConnectionStats, endpoint_name, observe_upstream
+from .resilience import (RETRY_STATUSES, DeadlineExceeded, UpstreamPolicy, current_deadline, deadline_scope,
+                         get_upstream_policy, time_left)
+from .user_tokens import current_user, user_scope
+
+# Event loop for calls to the Ebury API made with asyncio (see ebury_api_async.py).
+# One loop runs on a background thread for the whole process and owns a pooled
+# aiohttp session. A request thread hands its coroutine to the loop and waits for
+# the result, so fetching data for many clients takes tasks on the loop instead of
+# a thread each, and every page load shares the same loop and connections.
+# Turned on with EBURY_ASYNC_MODE.
+
+
+# Seconds run() waits past the caller's deadline for the coroutine to end on its own
+RUN_GRACE = 0.5
+
+
+class AsyncRuntime:
+    def __init__(self, pool_size=16, connect_timeout=5, read_timeout=30, policy=None):
+        self.pool_size = pool_size
+        self.policy = policy or UpstreamPolicy(connect_timeout=connect_timeout, read_timeout=read_timeout)
+        self.stats = ConnectionStats()
+        self.loop = asyncio.new_event_loop()
+        self._session = None
+        self._thread = threading.Thread(target=self.loop.run_forever, name='ebury-async', daemon=True)
+        self._thread.start()
+
+    # The session has to be made on the loop, it is made by the first coroutine that needs it
+    @property
+    def session(self):
+        if self._session is None:
+            trace = aiohttp.TraceConfig()
+            trace.on_request_start.append(self._on_request_start)
+            trace.on_connection_create_end.append(self._on_connection_create)
+            self._session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=0, limit_per_host=self.pool_size),
+                headers={'Accept-Encoding': 'gzip'},
+                cookie_jar=aiohttp.DummyCookieJar(),
+                trace_configs=[trace],
+            )
+        return self._session
+
+    async def _on_request_start(self, session, context, params):
+        context.host = params.url.host
+        self.stats.record_request(context.host)
+
+    async def _on_connection_create(self, session, context, params):
+        self.stats.record_new_connection(getattr(context, 'host', None))
+
+    # Run a coroutine on the loop inside an app context, with the caller's deadline
+    # and user, and wait for its result. The wait ends at the deadline (plus a moment
+    # for the coroutine to give up on its own), or after `timeout` seconds without
+    # one, and the coroutine is then cancelled.
+    def run(self, coro, app, timeout):
+        deadline = current_deadline()
+        user = current_user()
+        left = time_left()
+        if left is not None:
+            timeout = max(left, 0) + RUN_GRACE
+
+        async def in_app_context():
+            with app.app_context(), deadline_scope(deadline), user_scope(user):
+                return await coro
+
+        future = asyncio.run_coroutine_threadsafe(in_app_context(), self.loop)
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            # the coroutine's own timeouts are TimeoutErrors too
+            if future.done():
+                raise
+            future.cancel()
+            raise DeadlineExceeded(f"No result from the event loop after {timeout:.1f}s")
+
+    def close(self):
+        if self._session is not None:
+            asyncio.run_coroutine_threadsafe(self._session.close(), self.loop).result()
+        self.loop.call_soon_threadsafe(self.loop.stop)
+
+
+# Send a request on the runtime's session and return read(response), timing it for
+# /metrics and retrying it as the runtime's UpstreamPolicy says (see resilience.py)
+async def _send(method, url, read, idempotent=None, **kwargs):
+    runtime = get_async_runtime()
+    call = runtime.policy.start(method, url, endpoint_name(url), idempotent)
+    while True:
+        connect, read_timeout = call.before_attempt()
+        # total bounds the whole attempt by the deadline, like the sync client's timeouts
+        # (aiohttp takes a total of 0 as no limit)
+        left = time_left()
+        kwargs['timeout'] = aiohttp.ClientTimeout(total=None if left is None else max(left, 0.001),
+                                                  sock_connect=connect, sock_read=read_timeout)
+        start = time.perf_counter()
+        try:
+            async with runtime.session.request(method, url, **kwargs) as response:
+                status = response.status
+                if status in RETRY_STATUSES and call.idempotent:
+                    delay = call.after_attempt(status=status)
+                    if delay is not None:
+                        observe_upstream(url, start, status)
+                        await asyncio.sleep(delay)
+                        continue
+                else:
+                    call.after_attempt(status=status)
+                result = await read(response)
+        except aiohttp.ClientResponseError as e:
+            observe_upstream(url, start, e.status)
+            raise
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            observe_upstream(url, start, type(e).__name__)
+            delay = call.after_attempt(error=e)
+            if delay is None:
+                raise
+            await asyncio.sleep(delay)
+            continue
+        finally:
+            call.end_attempt()
+        observe_upstream(url, start, status)
+        return result
+
+async def _read_all(response):
+    return response.status, response.headers, await response.read()
+
+async def _read_json(response):
+    response.raise_for_status()
+    return await response.json(content_type=None)
+
+# Send a request and return (status, headers, body bytes)
+async def request(method, url, **kwargs):
+    return await _send(method, url, _read_all, **kwargs)
+
+# Send a request and return the response JSON, raising for an error status like requests does
+async def request_json(method, url, **kwargs):
+    return await _send(method, url, _read_json, **kwargs)
+
+
+_runtime = None
+_runtime_lock = threading.Lock()
+
+# Get the process wide runtime, it is started on first use from the app config
+def get_async_runtime():
+    global _runtime
+    if _runtime is None:
+        with _runtime_lock:
+            if _runtime is None:
+                config = current_app.config
+                _runtime = AsyncRuntime(
+                    pool_size=config.get('EBURY_HTTP_POOL_SIZE', 16),
+                    connect_timeout=config.get('EBURY_HTTP_CONNECT_TIMEOUT', 5),
+                    read_timeout=config.get('EBURY_HTTP_READ_TIMEOUT', 30),
+                    policy=get_upstream_policy(),
+                )
+    return _runtime
+
+# Run a coroutine from ebury_api_async on the runtime and return its result, waiting
+# at most until the request's deadline, or EBURY_REQUEST_DEADLINE seconds without one
+def run_async(coro):
+    app = current_app._get_current_object()
+    return get_async_runtime().run(coro, app, app.config.get('EBURY_REQUEST_DEADLINE', 25))
+
+def async_mode_enabled():
+    return current_app.config.get('EBURY_ASYNC_MODE', False)
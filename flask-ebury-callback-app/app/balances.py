@@ -0,0 +1,289 @@
+import logging
+import threading
+import time
+from flask import current_app
+from app import socketio
+from . import ebury_api
+from .cache import invalidate
+from .user_tokens import get_user_tokens, user_scope
+
+logger = logging.getLogger(__name__)
+
+# The latest balances of every client, kept so the balance page can be shown without
+# calling Ebury and so browsers only get told about what changed.
+# - /balance renders from the snapshot, fetching only the clients whose balances are
+#   missing, failed last time or older than the 'balances' cache ttl
+# - while a balance page is open (on the '/balances' Socket.IO namespace) the clients it
+#   shows are refreshed every EBURY_BALANCE_POLL_INTERVAL seconds in the background
+# - a webhook of one of EBURY_BALANCE_WEBHOOK_TYPES refreshes only its client's balances,
+#   webhooks for the same client within EBURY_BALANCE_REFRESH_DELAY seconds are
+#   refreshed together
+# Each refresh is compared per currency with the snapshot and only the rows that changed
+# are pushed as 'balance_changes' to the 'balance:<client id>' rooms.
+# Refreshes go past the API cache, and are made as one of the operators watching the
+# client (see user_tokens.py). Clients only watched without an operator use the app's
+# token, and are skipped while the app has none with EBURY_USER_SESSIONS.
+
+BALANCE_NAMESPACE = '/balances'
+NOT_FETCHED = {'error': 'Not fetched yet'}
+
+
+def balance_room(client_id):
+    return 'balance:' + client_id
+
+
+# {currency: amount} of a client's balances response
+def balance_rows(balances):
+    rows = {}
+    for balance in balances or []:
+        amount = balance.get('amount') or {}
+        if amount.get('currency') is not None:
+            rows[amount['currency']] = amount.get('amount')
+    return rows
+
+
+class ClientBalance:
+    __slots__ = ('balances', 'rows', 'error', 'shown', 'updated_at')
+
+    def __init__(self, balances=None, error=None):
+        self.balances = balances
+        self.rows = balance_rows(balances) if error is None else {}
+        self.error = error
+        # what the balance page is given, the same object until the next refresh
+        self.shown = balances if error is None else {'error': error}
+        self.updated_at = time.monotonic()
+
+
+class BalanceSnapshots:
+    def __init__(self, poll_interval=30, refresh_delay=0.5, namespace=BALANCE_NAMESPACE):
+        self.poll_interval = poll_interval
+        self.refresh_delay = refresh_delay
+        self.namespace = namespace
+        self._clients = {}
+        # {sid: user id} of the connections watching each client, and the clients of each connection
+        self._watched = {}
+        self._sid_clients = {}
+        # clients waiting for a targeted refresh
+        self._dirty = set()
+        self._lock = threading.Lock()
+        self._wake = threading.Condition(self._lock)
+        self._app = None
+        self._thread = None
+        self._stats = {'refreshes': 0, 'targeted_refreshes': 0, 'rows_pushed': 0, 'unchanged': 0, 'skipped': 0}
+
+    # The clients that need fetching before showing a page: missing, failed or older than max_age
+    def stale(self, client_ids, max_age):
+        now = time.monotonic()
+        clients = self._clients
+        return [
+            client_id for client_id in client_ids
+            if (entry := clients.get(client_id)) is None or entry.error is not None
+            or now - entry.updated_at >= max_age
+        ]
+
+    # Balances of the clients in the shape get_ebury_balance returns
+    def view(self, client_ids):
+        balances = {}
+        for client_id in client_ids:
+            entry = self._clients.get(client_id)
+            balances[client_id] = entry.shown if entry is not None else NOT_FETCHED
+        return balances
+
+    # Store the results of get_ebury_balance ({client_id: balances or {'error': ...}})
+    # and push the rows that changed, returns the changes
+    def apply(self, results):
+        changes = []
+        with self._lock:
+            for client_id, result in results.items():
+                if isinstance(result, dict) and 'error' in result:
+                    entry = ClientBalance(error=result['error'])
+                else:
+                    entry = ClientBalance(result)
+                previous = self._clients.get(client_id)
+                self._clients[client_id] = entry
+                client_changes = self._diff(client_id, previous, entry)
+                if previous is not None and not client_changes:
+                    # nothing to render again on the balance page
+                    entry.shown = previous.shown
+                changes.extend(client_changes)
+            self._stats['refreshes'] += 1
+            if not changes:
+                self._stats['unchanged'] += 1
+            self._stats['rows_pushed'] += len(changes)
+        if changes:
+            self._push(changes)
+        return changes
+
+    @staticmethod
+    def _diff(client_id, previous, entry):
+        if entry.error is not None:
+            if previous is None or previous.error != entry.error:
+                return [{'client_id': client_id, 'error': entry.error}]
+            return []
+        old_rows = previous.rows if previous is not None else {}
+        changes = [
+            {'client_id': client_id, 'currency': currency, 'amount': amount}
+            for currency, amount in entry.rows.items()
+            if currency not in old_rows or old_rows[currency] != amount
+        ]
+        changes.extend(
+            {'client_id': client_id, 'currency': currency, 'amount': None}
+            for currency in old_rows if currency not in entry.rows
+        )
+        if previous is not None and previous.error is not None:
+            changes.append({'client_id': client_id, 'error': None})
+        return changes
+
+    def _push(self, changes):
+        # only clients an open page shows
+        with self._lock:
+            watched = {change['client_id'] for change in changes if change['client_id'] in self._watched}
+        by_client = {}
+        for change in changes:
+            if change['client_id'] in watched:
+                by_client.setdefault(change['client_id'], []).append(change)
+        for client_id, client_changes in by_client.items():
+            socketio.emit('balance_changes', {'changes': client_changes},
+                          to=balance_room(client_id), namespace=self.namespace)
+
+    # Fetch the balances of the clients from Ebury, past the cache, and apply them
+    def refresh(self, client_ids):
+        return self.apply(ebury_api.get_ebury_balance(list(client_ids), use_cache=False))
+
+    # Refresh the watched clients, each as one of the operators watching it
+    def refresh_watched(self, client_ids):
+        with self._lock:
+            watchers = {client_id: set(self._watched.get(client_id, {}).values()) for client_id in client_ids}
+        users = {}
+        by_user = {}
+        skipped = 0
+        for client_id, user_ids in watchers.items():
+            user = None
+            for user_id in sorted(user_ids - {None}):
+                if user_id not in users:
+                    users[user_id] = get_user_tokens().get(user_id)
+                user = users[user_id]
+                if user is not None:
+                    break
+            if user is None and not (None in user_ids and self._app_token_usable()):
+                skipped += 1
+                continue
+            by_user.setdefault(user, []).append(client_id)
+        if skipped:
+            with self._lock:
+                self._stats['skipped'] += skipped
+        changes = []
+        for user, user_client_ids in by_user.items():
+            with user_scope(user):
+                changes.extend(self.refresh(user_client_ids))
+        return changes
+
+    # Without operator sessions the app logs in itself when it has no token, with them
+    # it only has the token of a host to host login made before
+    @staticmethod
+    def _app_token_usable():
+        if not current_app.config.get('EBURY_USER_SESSIONS', False):
+            return True
+        return ebury_api.token_manager.current() is not None
+
+    # A webhook that changes the client's balances has arrived
+    def balance_changed(self, client_id):
+        invalidate('balances', client_id)
+        with self._lock:
+            entry = self._clients.get(client_id)
+            if client_id not in self._watched:
+                # nobody is looking, the next page load fetches it
+                if entry is not None:
+                    entry.updated_at = float('-inf')
+                return
+            self._dirty.add(client_id)
+            self._wake.notify()
+
+    # A balance page connected showing these clients, for the operator with this user id
+    # (None without one)
+    def watch(self, sid, client_ids, app, user_id=None):
+        with self._lock:
+            self._unwatch(sid)
+            self._sid_clients[sid] = tuple(client_ids)
+            for client_id in client_ids:
+                self._watched.setdefault(client_id, {})[sid] = user_id
+        self.start(app)
+
+    def unwatch(self, sid):
+        with self._lock:
+            self._unwatch(sid)
+
+    def _unwatch(self, sid):
+        for client_id in self._sid_clients.pop(sid, ()):
+            sids = self._watched.get(client_id)
+            if sids is not None:
+                sids.pop(sid, None)
+                if not sids:
+                    del self._watched[client_id]
+
+    def start(self, app):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._app = app
+            self._thread = threading.Thread(target=self._refresh_loop, name='balance-refresher', daemon=True)
+            self._thread.start()
+
+    # Targeted refreshes as webhooks mark clients dirty, and a full refresh of the
+    # watched clients every poll_interval
+    def _refresh_loop(self):
+        next_poll = time.monotonic() + self.poll_interval
+        with self._app.app_context():
+            while True:
+                with self._lock:
+                    while not self._dirty and time.monotonic() < next_poll:
+                        self._wake.wait(next_poll - time.monotonic())
+                    poll = time.monotonic() >= next_poll
+                if not poll:
+                    # let the other webhooks of a burst arrive
+                    time.sleep(self.refresh_delay)
+                with self._lock:
+                    if poll:
+                        client_ids = list(self._watched)
+                        self._dirty.clear()
+                        next_poll = time.monotonic() + self.poll_interval
+                    else:
+                        client_ids = [client_id for client_id in self._dirty if client_id in self._watched]
+                        self._dirty.clear()
+                        self._stats['targeted_refreshes'] += 1
+                if not client_ids:
+                    continue
+                try:
+                    self.refresh_watched(client_ids)
+                except Exception as e:
+                    logger.warning("Balance refresh failed", extra={'fields': {'error': repr(e)}})
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['clients'] = len(self._clients)
+            stats['watched_clients'] = len(self._watched)
+            stats['connections'] = len(self._sid_clients)
+        return stats
+
+
+_snapshots = None
+_snapshots_lock = threading.Lock()
+
+# Get the process wide balance snapshots, created on first use from the app config
+def get_balance_snapshots():
+    global _snapshots
+    if _snapshots is None:
+        with _snapshots_lock:
+            if _snapshots is None:
+                config = current_app.config
+                _snapshots = BalanceSnapshots(
+                    poll_interval=config.get('EBURY_BALANCE_POLL_INTERVAL', 30),
+                    refresh_delay=config.get('EBURY_BALANCE_REFRESH_DELAY', 0.5),
+                )
+    return _snapshots
+
+# Called by the webhook processing for every verified webhook
+def webhook_received(client_id, webhook_type):
+    if client_id and webhook_type in current_app.config.get('EBURY_BALANCE_WEBHOOK_TYPES', ()):
+        get_balance_snapshots().balance_changed(client_id)
@@ -0,0 +1,220 @@
+import logging
+import threading
+from flask import current_app
+from app import socketio
+from .message_bus import LocalBus, get_message_bus
+from .metrics import webhook_emit
+
+logger = logging.getLogger(__name__)
+
+# Pushes callbacks to the browsers on the 'callbacks' page in micro-batches.
+# Events are collected for up to `window` seconds (or until `batch_size` are waiting)
+# and sent as 'callback_batch' messages. Browsers are in the 'all' room, or in
+# 'client:<client id>' and 'type:<webhook type>' rooms for the ones they watch. The
+# browsers in the same rooms get one message with every event matching any of their
+# rooms once, so a browser watching both a client and a type doesn't get an event of
+# that client and type twice.
+# Browsers acknowledge each batch they render, one that falls more than `max_lag`
+# batches behind is skipped until it catches up and is then told how many it missed.
+# With several workers each batch of events that arrived on this worker is also sent to
+# the others over the message bus (see message_bus.py), and the events they send are
+# pushed to this worker's browsers straight away.
+
+ALL_ROOM = 'all'
+
+
+def rooms_for(event):
+    rooms = [ALL_ROOM]
+    if event.get('client_id'):
+        rooms.append(f"client:{event['client_id']}")
+    if event.get('webhook_type'):
+        rooms.append(f"type:{event['webhook_type']}")
+    return rooms
+
+
+class CallbackBroadcaster:
+    def __init__(self, window=0.25, batch_size=200, max_pending=5000, max_lag=10, namespace='/', bus=None):
+        self.window = window
+        self.batch_size = batch_size
+        self.max_pending = max_pending
+        self.max_lag = max_lag
+        self.namespace = namespace
+        self.bus = bus or LocalBus()
+        self._pending = []
+        # the events that arrived on this worker, for the other workers
+        self._outbox = []
+        self._cond = threading.Condition()
+        self._thread = None
+        # room membership and per browser progress, guarded by _lock
+        self._lock = threading.Lock()
+        self._rooms = {}
+        self._sid_rooms = {}
+        self._sent = {}
+        self._acked = {}
+        self._missed = {}
+        self._stats = {'published': 0, 'remote': 0, 'batches': 0, 'emitted': 0, 'dropped_overflow': 0,
+                       'dropped_slow': 0}
+        self.bus.subscribe(self.deliver)
+
+    def start(self):
+        with self._cond:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._flush_loop, name='callback-broadcaster', daemon=True)
+                self._thread.start()
+
+    # Queue events for the next batch, this never blocks. When more than max_pending
+    # are waiting the oldest are dropped.
+    def publish(self, events):
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            self._pending.extend(events)
+            if not isinstance(self.bus, LocalBus):
+                self._outbox.extend(events)
+                if len(self._outbox) > self.max_pending:
+                    del self._outbox[:len(self._outbox) - self.max_pending]
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                del self._pending[:overflow]
+            if len(self._pending) >= self.batch_size:
+                self._cond.notify()
+        with self._lock:
+            self._stats['published'] += len(events)
+            if overflow > 0:
+                self._stats['dropped_overflow'] += overflow
+
+    # Events from the other workers, they have already waited for their batch there
+    def deliver(self, events):
+        if self._thread is None:
+            self.start()
+        with self._cond:
+            self._pending.extend(events)
+            overflow = len(self._pending) - self.max_pending
+            if overflow > 0:
+                del self._pending[:overflow]
+            self._cond.notify()
+        with self._lock:
+            self._stats['remote'] += len(events)
+            if overflow > 0:
+                self._stats['dropped_overflow'] += overflow
+
+    def _flush_loop(self):
+        while True:
+            with self._cond:
+                if len(self._pending) < self.batch_size:
+                    self._cond.wait(self.window)
+                events, self._pending = self._pending, []
+                outbox, self._outbox = self._outbox, []
+            if outbox:
+                self.bus.publish(outbox)
+            if events:
+                try:
+                    self.flush(events)
+                except Exception as e:
+                    logger.exception("Failed to push callbacks")
+
+    def flush(self, events):
+        event_rooms = [rooms_for(event) for event in events]
+        with self._lock:
+            # the browsers in the same rooms get the same events
+            audiences = {}
+            for sid, sid_rooms in self._sid_rooms.items():
+                audiences.setdefault(frozenset(sid_rooms), []).append(sid)
+
+        for audience_rooms, sids in audiences.items():
+            audience_events = [event for event, rooms in zip(events, event_rooms)
+                               if any(room in audience_rooms for room in rooms)]
+            if not audience_events:
+                continue
+            batches = range(0, len(audience_events), self.batch_size)
+            with self._lock:
+                to = []
+                for sid in sids:
+                    # it may have gone since
+                    if sid not in self._sent:
+                        continue
+                    if self._sent[sid] - self._acked[sid] > self.max_lag:
+                        self._missed[sid] += len(audience_events)
+                        self._stats['dropped_slow'] += len(audience_events)
+                    else:
+                        self._sent[sid] += len(batches)
+                        to.append(sid)
+                if to:
+                    self._stats['batches'] += len(batches)
+                    self._stats['emitted'] += len(audience_events) * len(to)
+            if to:
+                room = ','.join(sorted(audience_rooms))
+                for i in batches:
+                    with webhook_emit.time():
+                        socketio.emit('callback_batch', {'room': room, 'events': audience_events[i:i + self.batch_size]},
+                                      to=to, namespace=self.namespace)
+
+    # Room membership, called from the socket handlers
+    def join(self, sid, rooms):
+        with self._lock:
+            self._leave_rooms(sid)
+            self._sid_rooms[sid] = set(rooms)
+            for room in rooms:
+                self._rooms.setdefault(room, set()).add(sid)
+            self._sent.setdefault(sid, 0)
+            self._acked.setdefault(sid, 0)
+            self._missed.setdefault(sid, 0)
+
+    def _leave_rooms(self, sid):
+        for room in self._sid_rooms.pop(sid, ()):
+            sids = self._rooms.get(room)
+            if sids is not None:
+                sids.discard(sid)
+                if not sids:
+                    del self._rooms[room]
+
+    def remove(self, sid):
+        with self._lock:
+            self._leave_rooms(sid)
+            self._sent.pop(sid, None)
+            self._acked.pop(sid, None)
+            self._missed.pop(sid, None)
+
+    # A browser has rendered a batch, returns the number of events it missed while
+    # it was behind (and resets it) once it has caught up
+    def ack(self, sid):
+        with self._lock:
+            if sid not in self._acked:
+                return 0
+            self._acked[sid] = min(self._acked[sid] + 1, self._sent[sid])
+            if self._missed[sid] and self._sent[sid] - self._acked[sid] <= self.max_lag:
+                missed, self._missed[sid] = self._missed[sid], 0
+                return missed
+            return 0
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['connections'] = len(self._sid_rooms)
+            stats['rooms'] = len(self._rooms)
+            stats['slow_connections'] = sum(
+                1 for sid in self._sent if self._sent[sid] - self._acked[sid] > self.max_lag
+            )
+        stats['pending'] = len(self._pending)
+        stats['bus'] = self.bus.snapshot()
+        return stats
+
+
+_broadcaster = None
+_broadcaster_lock = threading.Lock()
+
+# Get the process wide broadcaster, created on first use from the app config
+def get_broadcaster():
+    global _broadcaster
+    if _broadcaster is None:
+        with _broadcaster_lock:
+            if _broadcaster is None:
+                config = current_app.config
+                _broadcaster = CallbackBroadcaster(
+                    window=config.get('EBURY_FANOUT_WINDOW', 0.25),
+                    batch_size=config.get('EBURY_FANOUT_BATCH_SIZE', 200),
+                    max_pending=config.get('EBURY_FANOUT_MAX_PENDING', 5000),
+                    max_lag=config.get('EBURY_FANOUT_MAX_LAG', 10),
+                    bus=get_message_bus(),
+                )
+    return _broadcaster
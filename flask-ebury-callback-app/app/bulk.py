@@ -0,0 +1,158 @@
+import threading
+from flask import current_app
+from app import socketio
+from .concurrency import fetch_all
+from .cache import invalidate
+from . import ebury_api, graphql
+
+# Bulk changes to webhook subscriptions, e.g. moving every client to a new callback url.
+# An item is {'client_id', 'operation', 'params'} with operation one of
+#   create  params {'url', 'types', 'secret'}
+#   enable  params {'subscription_id'}
+#   disable params {'subscription_id'}
+#   delete  params {'subscription_id'}
+# The items of a client are sent as aliased mutations in one GraphQL document (up to
+# EBURY_BULK_MAX_ALIASES per document), and the clients are run at most
+# EBURY_BULK_CONCURRENCY at a time. As each document is answered its items are pushed
+# as 'bulk_progress' to the 'bulk:<job id>' Socket.IO room, and a report with the
+# result of every item is returned at the end.
+
+BULK_ROOM_PREFIX = 'bulk:'
+
+
+class BulkItemError(ValueError):
+    pass
+
+
+# The mutation input for an item, raises BulkItemError when the item is not valid
+def mutation_input(operation, params):
+    if not isinstance(operation, str) or operation not in graphql.SUBSCRIPTION_MUTATIONS:
+        raise BulkItemError(f"Unknown operation: {operation!r}")
+    if not isinstance(params, dict):
+        raise BulkItemError("params must be an object")
+    if operation == 'create':
+        url = params.get('url')
+        if not url or not isinstance(url, str):
+            raise BulkItemError("create needs a url")
+        types = params.get('types') or []
+        if not isinstance(types, list) or not all(isinstance(name, str) for name in types):
+            raise BulkItemError("types must be a list of strings")
+        secret = params.get('secret')
+        if secret is not None and not isinstance(secret, str):
+            raise BulkItemError("secret must be a string")
+        return {"subscription": {"url": url, "types": types, "active": True, "secret": secret}}
+    subscription_id = params.get('subscription_id')
+    if not subscription_id or not isinstance(subscription_id, str):
+        raise BulkItemError(f"{operation} needs a subscription_id")
+    if operation == 'delete':
+        return {"id": subscription_id}
+    return {"id": subscription_id, "patch": {"active": operation == 'enable'}}
+
+
+def bulk_room(job_id):
+    return BULK_ROOM_PREFIX + job_id
+
+
+class BulkJob:
+    def __init__(self, job_id, items, max_aliases=25):
+        self.job_id = job_id
+        self.items = items
+        self.max_aliases = max_aliases
+        self.results = [None] * len(items)
+        self.done = 0
+        self._lock = threading.Lock()
+
+    # Check every item, the ones that can't be sent get their result straight away.
+    # Returns [(client_id, [(index, operation, input), ...]), ...] with at most
+    # max_aliases operations per entry
+    def plan(self, known_clients):
+        by_client = {}
+        for index, item in enumerate(self.items):
+            if not isinstance(item, dict):
+                self._finish(index, None, None, 'invalid', error="An item must be an object")
+                continue
+            client_id = item.get('client_id')
+            operation = item.get('operation')
+            try:
+                if not isinstance(client_id, str) or client_id not in known_clients:
+                    raise BulkItemError(f"Unknown client_id: {client_id!r}")
+                mutation = mutation_input(operation, item.get('params') or {})
+            except BulkItemError as e:
+                self._finish(index, client_id, operation, 'invalid', error=str(e))
+                continue
+            by_client.setdefault(client_id, []).append((index, operation, mutation))
+
+        return [
+            (client_id, operations[i:i + self.max_aliases])
+            for client_id, operations in by_client.items()
+            for i in range(0, len(operations), self.max_aliases)
+        ]
+
+    # Send one client's aliased document, and record and push the result of each item
+    def run_chunk(self, client_id, operations):
+        document = graphql.aliased_mutation(tuple(operation for _, operation, _ in operations))
+        variables = {f"m{n}": mutation for n, (_, _, mutation) in enumerate(operations)}
+        try:
+            result = graphql.execute(ebury_api.get_access_token(), client_id, document, variables)
+        except Exception as e:
+            for index, operation, _ in operations:
+                self._finish(index, client_id, operation, 'failed', error=str(e))
+            self._push(operations)
+            return
+        finally:
+            invalidate('webhooks', client_id)
+
+        # errors name the alias they belong to in their path
+        errors = {}
+        for error in result.get('errors') or []:
+            path = error.get('path') or []
+            errors.setdefault(path[0] if path else None, []).append(error.get('message'))
+        data = result.get('data') or {}
+        for n, (index, operation, _) in enumerate(operations):
+            alias = f"m{n}"
+            alias_errors = errors.get(alias) or (errors.get(None) if data.get(alias) is None else None)
+            if alias_errors:
+                self._finish(index, client_id, operation, 'failed', error='; '.join(map(str, alias_errors)))
+            else:
+                self._finish(index, client_id, operation, 'success', result=data.get(alias))
+        self._push(operations)
+
+    def _push(self, operations):
+        socketio.emit('bulk_progress', {
+            'job_id': self.job_id,
+            'items': [self.results[index] for index, _, _ in operations],
+            'done': self.done,
+            'total': len(self.items),
+        }, to=bulk_room(self.job_id))
+
+    def _finish(self, index, client_id, operation, status, result=None, error=None):
+        report = {'index': index, 'client_id': client_id, 'operation': operation, 'status': status}
+        if result is not None:
+            report['result'] = result
+        if error is not None:
+            report['error'] = error
+        with self._lock:
+            self.results[index] = report
+            self.done += 1
+
+    def report(self):
+        counts = {}
+        for result in self.results:
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+        return {'job_id': self.job_id, 'total': len(self.items), 'counts': counts, 'items': self.results}
+
+
+# Run a list of items and return the report
+def run_bulk(job_id, items):
+    config = current_app.config
+    job = BulkJob(job_id, items, max_aliases=config.get('EBURY_BULK_MAX_ALIASES', 25))
+    chunks = job.plan(ebury_api.get_client_directory())
+
+    outcomes = fetch_all(lambda chunk: job.run_chunk(*chunk), chunks,
+                         max_workers=config.get('EBURY_BULK_CONCURRENCY', config.get('EBURY_MAX_CONCURRENCY', 8)))
+    # anything left without a result failed outside the GraphQL call
+    for (client_id, operations), outcome in zip(chunks, outcomes):
+        for index, operation, _ in operations:
+            if job.results[index] is None:
+                job._finish(index, client_id, operation, 'failed', error=str(outcome))
+    return job.report()
@@ -0,0 +1,219 @@
+import asyncio
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import Future
+from flask import current_app
+from .user_tokens import current_user, user_scope
+
+# In memory cache for Ebury API responses.
+# Entries are fresh for `ttl` seconds, after that they are still served for another
+# `stale_ttl` seconds while a single background refresh fetches a new value
+# (stale-while-revalidate). A miss is loaded once too: callers that miss a key while
+# it is being loaded wait for that load instead of starting their own. The least
+# recently used entries are evicted once max_entries is reached.
+# get() is for loaders that block, get_async() for coroutines running on the
+# async runtime (see async_runtime.py), both share the same entries and loads.
+
+
+class CacheEntry:
+    __slots__ = ('value', 'stored_at')
+
+    def __init__(self, value, stored_at):
+        self.value = value
+        self.stored_at = stored_at
+
+
+class Load:
+    # A load of a key in flight, for a miss or the refresh of a stale entry. Its
+    # future gets the loaded value (or error) for the callers waiting on it.
+    __slots__ = ('future', 'refresh', 'current')
+
+    def __init__(self, refresh):
+        self.future = Future()
+        self.refresh = refresh
+        # cleared when the key is invalidated during the load, the value may be from
+        # before the change and is not stored
+        self.current = True
+
+
+class TTLCache:
+    def __init__(self, max_entries=1024):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._loads = {}
+        self._tasks = set()
+        self._lock = threading.Lock()
+        self._stats = {
+            'hits': 0,
+            'stale_hits': 0,
+            'misses': 0,
+            'coalesced': 0,
+            'refreshes': 0,
+            'refresh_errors': 0,
+            'evictions': 0,
+            'invalidations': 0,
+        }
+
+    # Look the key up, returns (found, value, load, owner).
+    # load is the refresh of a stale entry or, on a miss, the load to wait for, and
+    # owner is True when the caller has to run it
+    def _lookup(self, key, ttl, stale_ttl):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            load = self._loads.get(key)
+            if entry is not None:
+                age = now - entry.stored_at
+                if age < ttl:
+                    self._stats['hits'] += 1
+                    self._entries.move_to_end(key)
+                    return True, entry.value, None, False
+                if age < ttl + stale_ttl:
+                    self._stats['stale_hits'] += 1
+                    self._entries.move_to_end(key)
+                    if load is not None:
+                        return True, entry.value, load, False
+                    load = self._loads[key] = Load(refresh=True)
+                    return True, entry.value, load, True
+            self._stats['misses'] += 1
+            if load is not None:
+                self._stats['coalesced'] += 1
+                return False, None, load, False
+            load = self._loads[key] = Load(refresh=False)
+            return False, None, load, True
+
+    def get(self, key, loader, ttl, stale_ttl=0):
+        found, value, load, owner = self._lookup(key, ttl, stale_ttl)
+        if found:
+            if owner:
+                threading.Thread(target=self._load, args=(key, loader, load),
+                                 name='ebury-cache-refresh', daemon=True).start()
+            return value
+        if owner:
+            self._load(key, loader, load)
+        return load.future.result()
+
+    async def get_async(self, key, loader, ttl, stale_ttl=0):
+        found, value, load, owner = self._lookup(key, ttl, stale_ttl)
+        if found:
+            if owner:
+                task = asyncio.ensure_future(self._load_async(key, loader, load))
+                # the loop only keeps a weak reference to its tasks
+                self._tasks.add(task)
+                task.add_done_callback(self._tasks.discard)
+            return value
+        if owner:
+            await self._load_async(key, loader, load)
+        # shielded, a waiter that is cancelled must not cancel the load for the others
+        return await asyncio.shield(asyncio.wrap_future(load.future))
+
+    def _load(self, key, loader, load):
+        try:
+            value = loader()
+        except BaseException as e:
+            self._loaded(key, load, error=e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        self._loaded(key, load, value)
+
+    async def _load_async(self, key, loader, load):
+        try:
+            value = await loader()
+        except BaseException as e:
+            # a cancelled load ends too, so its waiters don't wait forever
+            self._loaded(key, load, error=e)
+            if not isinstance(e, Exception):
+                raise
+            return
+        self._loaded(key, load, value)
+
+    def _loaded(self, key, load, value=None, error=None):
+        with self._lock:
+            if self._loads.get(key) is load:
+                del self._loads[key]
+            if load.refresh:
+                # on failure keep serving the stale value, the next stale read will try again
+                self._stats['refreshes' if error is None else 'refresh_errors'] += 1
+            if error is None and load.current:
+                self._entries[key] = CacheEntry(value, time.monotonic())
+                self._entries.move_to_end(key)
+                while len(self._entries) > self.max_entries:
+                    self._entries.popitem(last=False)
+                    self._stats['evictions'] += 1
+        if error is None:
+            load.future.set_result(value)
+        else:
+            load.future.set_exception(error)
+
+    # Remove every entry whose key matches, e.g. invalidate(lambda key: key == ('webhooks', client_id)).
+    # Loads of those keys already running are not stored, and the next lookup starts a
+    # new one. Loads of other keys are not affected.
+    def invalidate(self, match):
+        with self._lock:
+            for key in [key for key in self._entries if match(key)]:
+                del self._entries[key]
+            for key in [key for key in self._loads if match(key)]:
+                self._loads.pop(key).current = False
+            self._stats['invalidations'] += 1
+
+    def clear(self):
+        self.invalidate(lambda key: True)
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+            stats['loading'] = len(self._loads)
+            stats['refreshing'] = sum(1 for load in self._loads.values() if load.refresh)
+        lookups = stats['hits'] + stats['stale_hits'] + stats['misses']
+        # share of lookups answered without waiting on the Ebury API
+        stats['hit_ratio'] = round((stats['hits'] + stats['stale_hits']) / lookups, 4) if lookups else 0.0
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# Get the process wide cache for Ebury API responses
+def get_api_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                _cache = TTLCache(max_entries=current_app.config.get('EBURY_CACHE_MAX_ENTRIES', 1024))
+    return _cache
+
+# Get a value for (endpoint, client_id) from the cache, calling loader when it is missing.
+# The ttl for the endpoint comes from the EBURY_CACHE_TTLS config, loader is always run
+# inside an app context and as the caller's user, as stale entries are refreshed on a
+# background thread.
+def cached(endpoint, client_id, loader):
+    config = current_app.config
+    app = current_app._get_current_object()
+    user = current_user()
+
+    def load():
+        with app.app_context(), user_scope(user):
+            return loader()
+
+    ttl = config.get('EBURY_CACHE_TTLS', {}).get(endpoint, 0)
+    if ttl <= 0:
+        # caching is turned off for this endpoint
+        return loader()
+    stale_ttl = config.get('EBURY_CACHE_STALE_TTL', 0)
+    return get_api_cache().get((endpoint, client_id), load, ttl, stale_ttl)
+
+def invalidate(endpoint, client_id):
+    get_api_cache().invalidate(lambda key: key == (endpoint, client_id))
+
+# The same for a coroutine loader on the async runtime, the refresh of a stale entry
+# runs as a task on the event loop and keeps the app context it was started in
+async def cached_async(endpoint, client_id, loader):
+    config = current_app.config
+    ttl = config.get('EBURY_CACHE_TTLS', {}).get(endpoint, 0)
+    if ttl <= 0:
+        return await loader()
+    stale_ttl = config.get('EBURY_CACHE_STALE_TTL', 0)
+    return await get_api_cache().get_async((endpoint, client_id), loader, ttl, stale_ttl)
@@ -0,0 +1,161 @@
+import hashlib
+import json
+import threading
+import weakref
+from base64 import urlsafe_b64decode
+from collections import OrderedDict
+from functools import lru_cache
+
+# The clients a login has access to, from the `clients` claim of its id token.
+# Every TokenState gets a ClientDirectory with a record per client and an index by
+# client id, so checking a client id or finding its request headers is a dict lookup.
+# A renewed token almost always has the same clients, so directories are kept by a
+# hash of the claim and only built when the claim has changed, and the id token
+# payload is only decoded when it differs from the last ones seen.
+
+MAX_DIRECTORIES = 64
+
+
+# The claims of an id token's payload segment. They are shared by the callers that
+# decode the same payload, so they are read only: changing them raises TypeError.
+@lru_cache(maxsize=16)
+def decode_claims(payload):
+    return _freeze(json.loads(urlsafe_b64decode(payload + '==').decode()))
+
+
+def _read_only(self, *args, **kwargs):
+    raise TypeError("Decoded claims are shared and read only, copy them to make changes")
+
+
+# dict and list that can't be changed, still dict and list for json and the templates
+class FrozenDict(dict):
+    __slots__ = ()
+    __setitem__ = __delitem__ = __ior__ = clear = pop = popitem = setdefault = update = _read_only
+
+
+class FrozenList(list):
+    __slots__ = ()
+    __setitem__ = __delitem__ = __iadd__ = __imul__ = _read_only
+    append = clear = extend = insert = pop = remove = reverse = sort = _read_only
+
+
+def _freeze(value):
+    if isinstance(value, dict):
+        return FrozenDict((key, _freeze(item)) for key, item in value.items())
+    if isinstance(value, list):
+        return FrozenList(_freeze(item) for item in value)
+    return value
+
+
+class ClientRecord:
+    __slots__ = ('client_id', 'client_name', 'claim', '_headers', '__weakref__')
+
+    def __init__(self, claim):
+        self.claim = claim
+        self.client_id = claim.get('client_id')
+        self.client_name = claim.get('client_name')
+        # (access token, headers) for the last token the headers were made for
+        self._headers = (None, None)
+
+    # Headers for a call to the Ebury API for this client. The dict is shared by the
+    # calls made with the same token, so it must not be changed.
+    def headers(self, access_token):
+        token, headers = self._headers
+        if token != access_token:
+            headers = {
+                "Authorization": f"Bearer {access_token}",
+                "Content-Type": "application/json",
+                "X-Client-ID": self.client_id,
+            }
+            self._headers = (access_token, headers)
+        return headers
+
+
+class ClientDirectory:
+    __slots__ = ('claims_hash', 'clients', 'records', 'client_ids', '_index')
+
+    def __init__(self, claims_hash, clients, records):
+        self.claims_hash = claims_hash
+        # the claim as it came, for the templates
+        self.clients = clients
+        self.records = records
+        self.client_ids = tuple(record.client_id for record in records)
+        self._index = {record.client_id: record for record in records}
+
+    def get(self, client_id):
+        return self._index.get(client_id)
+
+    def first(self):
+        return self.records[0] if self.records else None
+
+    def __contains__(self, client_id):
+        return client_id in self._index
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __len__(self):
+        return len(self.records)
+
+
+def claims_hash(clients):
+    return hashlib.sha256(json.dumps(clients, sort_keys=True, separators=(',', ':')).encode()).hexdigest()
+
+
+# Directories by claims hash, most recently used last, and the records of the clients
+# in them by client id, shared by the directories that have the client with the same
+# claim. A record goes once no directory (or TokenState) has it any more.
+_directories = OrderedDict()
+_records = weakref.WeakValueDictionary()
+_lock = threading.Lock()
+_stats = {'built': 0, 'reused': 0}
+# the claim list the last directory was looked up for, as a decoded id token is reused
+# when the token is renewed the same list usually comes again
+_last = (None, None)
+
+# The directory for a `clients` claim, only built when no directory has this claim
+def directory_for(clients):
+    global _last
+    clients = clients or []
+    last_clients, last_directory = _last
+    if clients is last_clients:
+        return last_directory
+    digest = claims_hash(clients)
+    with _lock:
+        directory = _directories.get(digest)
+        if directory is not None:
+            _directories.move_to_end(digest)
+            _stats['reused'] += 1
+            _last = (clients, directory)
+            return directory
+
+        records = []
+        for claim in clients:
+            record = _records.get(claim.get('client_id'))
+            if record is None or record.claim != claim:
+                record = _records[claim.get('client_id')] = ClientRecord(claim)
+            records.append(record)
+        directory = _directories[digest] = ClientDirectory(digest, clients, records)
+        _stats['built'] += 1
+        while len(_directories) > MAX_DIRECTORIES:
+            _directories.popitem(last=False)
+        _last = (clients, directory)
+        return directory
+
+# Headers for a call for client_id, from its record when there is one
+def client_headers(access_token, client_id):
+    record = _records.get(client_id)
+    if record is None:
+        return {
+            "Authorization": f"Bearer {access_token}",
+            "Content-Type": "application/json",
+            "X-Client-ID": client_id,
+        }
+    return record.headers(access_token)
+
+def snapshot():
+    with _lock:
+        stats = dict(_stats)
+        stats['directories'] = len(_directories)
+        stats['records'] = len(_records)
+    return stats
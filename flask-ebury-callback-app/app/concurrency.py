@@ -0,0 +1,60 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from flask import current_app
+from .resilience import current_deadline, deadline_scope
+from .user_tokens import current_user, user_scope
+
+# Run fetch(item) for every item with at most max_workers calls in flight and
+# return the results in the same order as items.
+# Each worker thread gets its own app context so fetch can use current_app, and
+# an exception raised for one item is returned in its place instead of aborting
+# the whole fan-out, so one failing client doesn't hide everybody else's data.
+# The workers keep the caller's deadline and user, see resilience.py and user_tokens.py.
+def fetch_all(fetch, items, max_workers=None):
+    items = list(items)
+    if not items:
+        return []
+
+    app = current_app._get_current_object()
+    if max_workers is None:
+        max_workers = app.config.get('EBURY_MAX_CONCURRENCY', 8)
+    max_workers = max(1, min(max_workers, len(items)))
+
+    deadline = current_deadline()
+    user = current_user()
+
+    def run(item):
+        with app.app_context(), deadline_scope(deadline), user_scope(user):
+            try:
+                return fetch(item)
+            except Exception as e:
+                return e
+
+    if max_workers == 1:
+        return [run(item) for item in items]
+
+    with ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ebury-fetch') as pool:
+        return list(pool.map(run, items))
+
+
+# The same for coroutines on the async runtime (see async_runtime.py): await
+# fetch(item) for every item with at most max_concurrency in flight.
+# The calls are tasks on one event loop instead of threads, and see the app
+# context of the caller as tasks copy its context.
+async def gather_all(fetch, items, max_concurrency=None):
+    items = list(items)
+    if not items:
+        return []
+
+    if max_concurrency is None:
+        max_concurrency = current_app.config.get('EBURY_MAX_CONCURRENCY', 8)
+    semaphore = asyncio.Semaphore(max(1, max_concurrency))
+
+    async def run(item):
+        async with semaphore:
+            try:
+                return await fetch(item)
+            except Exception as e:
+                return e
+
+    return await asyncio.gather(*(run(item) for item in items))
@@ -17,8 +17,170 @@ class Config:
     EBURY_AUTHENTICATION_URL = "https://auth-sandbox.ebury.io/"
     EBURY_API_URL = "https://sandbox.ebury.io/"
  
+    # The access token is renewed in the background EBURY_TOKEN_REFRESH_AHEAD seconds
+    # before it expires, less a random jitter of up to EBURY_TOKEN_REFRESH_JITTER seconds
+    EBURY_TOKEN_REFRESH_AHEAD = 120
+    EBURY_TOKEN_REFRESH_JITTER = 30
+    # With EBURY_USER_SESSIONS every operator who logs in through /ebo_login gets their
+    # own token, kept on the server for their Flask session (signed with SECRET_KEY), in
+    # the credential store below.
+    # At most EBURY_USER_SESSIONS_MAX are kept, the least recently used are logged out,
+    # as are those idle for EBURY_USER_SESSION_IDLE_TIMEOUT seconds.
+    # Anyone with the SECRET_KEY can sign a session as any operator, so the app doesn't
+    # start with EBURY_USER_SESSIONS unless it has been set to a secret of your own
+    # (e.g. FLASK_SECRET_KEY in the environment).
+    SECRET_KEY = "your session secret key"
+    EBURY_USER_SESSIONS = False
+    EBURY_USER_SESSIONS_MAX = 1000
+    EBURY_USER_SESSION_IDLE_TIMEOUT = 8 * 3600
+    # Where the app's own token and the operators' tokens are kept: "memory" gives every
+    # process its own, "sqlite" shares them between all the gunicorn workers using this file
+    EBURY_CREDENTIAL_STORE = "memory"
+    EBURY_CREDENTIAL_STORE_PATH = "credentials.db"
+
+    # Set when the app is created once and forked into workers (gunicorn --preload, as in
+    # gunicorn.conf.py): the token, client directory and subscription types are loaded
+    # before the fork and the background work is started in each worker.
+    EBURY_PRELOAD = False
+
+    # Maximum number of concurrent calls to the Ebury API when fetching
+    # data for every client (e.g. the balance page)
+    EBURY_MAX_CONCURRENCY = 16
+
+    # Run the pages that mostly wait on the Ebury API (balances, webhooks, pings and
+    # subscription changes) on a shared asyncio event loop instead of a thread per call
+    EBURY_ASYNC_MODE = False
+
+    # Pooled connections to the Ebury API, the pool size is per host and should
+    # be at least EBURY_MAX_CONCURRENCY. Timeouts are in seconds.
+    EBURY_HTTP_POOL_SIZE = 16
+    EBURY_HTTP_CONNECT_TIMEOUT = 5
+    EBURY_HTTP_READ_TIMEOUT = 30
+
+    # Read timeouts per endpoint, others get EBURY_HTTP_READ_TIMEOUT. A call never waits
+    # past the request's deadline, EBURY_REQUEST_DEADLINE seconds after it arrived.
+    EBURY_HTTP_TIMEOUTS = {
+        'balances': 10,
+        'webhooks/graphql': 15,
+        'webhooks/ping': 10,
+        'login': 10,
+        'token': 10,
+    }
+    EBURY_REQUEST_DEADLINE = 25
+    # Calls that are safe to repeat are tried up to EBURY_RETRY_ATTEMPTS times, with an
+    # exponential backoff. Retries are limited to EBURY_RETRY_BUDGET_RATIO of the calls
+    # made, plus EBURY_RETRY_BUDGET_MIN_PER_SECOND.
+    EBURY_RETRY_ATTEMPTS = 3
+    EBURY_RETRY_BACKOFF = 0.1
+    EBURY_RETRY_BACKOFF_MAX = 2.0
+    EBURY_RETRY_BUDGET_RATIO = 0.1
+    EBURY_RETRY_BUDGET_MIN_PER_SECOND = 5
+    # After EBURY_CIRCUIT_FAILURES failures in a row calls to a host fail straight away,
+    # for EBURY_CIRCUIT_RESET_TIMEOUT seconds before a trial call is let through
+    EBURY_CIRCUIT_FAILURES = 5
+    EBURY_CIRCUIT_RESET_TIMEOUT = 30
+
+    # Bulk subscription changes (/subscriptions/bulk): up to EBURY_BULK_MAX_ALIASES
+    # changes for a client go in one GraphQL document, and EBURY_BULK_CONCURRENCY
+    # documents are in flight at a time
+    EBURY_BULK_MAX_ITEMS = 1000
+    EBURY_BULK_MAX_ALIASES = 25
+    EBURY_BULK_CONCURRENCY = 16
+    EBURY_BULK_DEADLINE = 300
+
+    # Health checks of the webhook subscriptions (/webhooks/health): with EBURY_PROBE_ENABLED
+    # every active subscription is pinged every EBURY_PROBE_INTERVAL seconds, at most
+    # EBURY_PROBE_CONCURRENCY at a time. The last EBURY_PROBE_HISTORY latencies are kept,
+    # and a ping whose PING webhook hasn't arrived on /callback within
+    # EBURY_PROBE_DELIVERY_TIMEOUT seconds counts as a missed delivery.
+    EBURY_PROBE_ENABLED = False
+    EBURY_PROBE_INTERVAL = 300
+    EBURY_PROBE_CONCURRENCY = 8
+    EBURY_PROBE_HISTORY = 128
+    EBURY_PROBE_DELIVERY_TIMEOUT = 30
+
+    # While a balance page is open its clients' balances are refreshed every
+    # EBURY_BALANCE_POLL_INTERVAL seconds and only the changes are pushed to it. Webhooks
+    # of these types refresh their client's balances straight away, set them to the
+    # types that move money in your account.
+    EBURY_BALANCE_POLL_INTERVAL = 30
+    EBURY_BALANCE_REFRESH_DELAY = 0.5
+    EBURY_BALANCE_WEBHOOK_TYPES = ["PAYMENT", "TRADE", "FUNDS_RECEIVED"]
+
+    # Number of webhook subscriptions fetched per GraphQL page, and the most pages
+    # fetched for a client
+    EBURY_GRAPHQL_PAGE_SIZE = 100
+    EBURY_GRAPHQL_MAX_PAGES = 100
+
+    # Caching of Ebury API responses, ttls are in seconds per endpoint.
+    # Once an entry is older than its ttl it is still served for EBURY_CACHE_STALE_TTL
+    # seconds while it is refreshed in the background.
+    EBURY_CACHE_TTLS = {
+        'balances': 30,
+        'webhooks': 60,
+    }
+    EBURY_CACHE_STALE_TTL = 300
+    EBURY_CACHE_MAX_ENTRIES = 1024
+
+    # Rendered fragments of the dashboard pages are kept until the data they show changes,
+    # up to EBURY_FRAGMENT_CACHE_MAX_ENTRIES of them, and the last EBURY_PAGE_CACHE_MAX_ENTRIES
+    # pages put together from them (see fragments.py).
+    EBURY_FRAGMENT_CACHE_MAX_ENTRIES = 4096
+    EBURY_PAGE_CACHE_MAX_ENTRIES = 64
+
     # The secret used to verify the webhook signature
     EBURY_WEBHOOK_SECRET = "your webhook secret"
+    # While rotating the secret, webhooks signed with one of these are also accepted
+    EBURY_WEBHOOK_PREVIOUS_SECRETS = []
+    # Secrets for individual subscriptions, keyed by the subscription id sent in the
+    # X-EBURY-SUBSCRIPTION-ID header, e.g. {"subscription id": ["secret", "old secret"]}
+    EBURY_WEBHOOK_SECRETS = {}
+
+    # Webhooks received on /callback are queued and processed by worker threads.
+    # When the queue is full /callback waits EBURY_WEBHOOK_QUEUE_TIMEOUT seconds for
+    # room and then answers 503 with Retry-After so Ebury delivers it again later.
+    # Bodies over EBURY_CALLBACK_MAX_BODY bytes are refused with 413 without being read.
+    EBURY_CALLBACK_MAX_BODY = 1024 * 1024
+    EBURY_WEBHOOK_QUEUE_SIZE = 10000
+    EBURY_WEBHOOK_WORKERS = 4
+    EBURY_WEBHOOK_QUEUE_TIMEOUT = 0.05
+
+    # Redelivered webhooks are acknowledged but not processed again if they arrive
+    # within EBURY_DEDUP_WINDOW seconds. The index holds up to EBURY_DEDUP_CAPACITY
+    # deliveries per window at the given false positive rate (about 3MB per million),
+    # the most recent EBURY_DEDUP_EXACT_ENTRIES are also kept exactly.
+    EBURY_DEDUP_WINDOW = 86400
+    EBURY_DEDUP_CAPACITY = 1000000
+    EBURY_DEDUP_ERROR_RATE = 1e-5
+    EBURY_DEDUP_EXACT_ENTRIES = 100000
+
+    # SQLite database (WAL mode) that keeps every verified webhook for the callbacks page.
+    # When the callbacks page connects it is sent up to EBURY_EVENT_REPLAY_LIMIT events
+    # it has not seen yet.
+    EBURY_EVENT_STORE_PATH = "events.db"
+    EBURY_EVENT_STORE_BATCH_SIZE = 1000
+    EBURY_EVENT_STORE_MAX_PENDING = 100000
+    EBURY_EVENT_REPLAY_LIMIT = 500
+
+    # Callbacks are pushed to the callbacks page in batches, collected for up to
+    # EBURY_FANOUT_WINDOW seconds or until EBURY_FANOUT_BATCH_SIZE are waiting.
+    # A page more than EBURY_FANOUT_MAX_LAG batches behind is skipped until it catches up.
+    EBURY_FANOUT_WINDOW = 0.25
+    EBURY_FANOUT_BATCH_SIZE = 200
+    EBURY_FANOUT_MAX_PENDING = 5000
+    EBURY_FANOUT_MAX_LAG = 10
+    # How the workers pass callbacks to each other, so a page connected to any worker
+    # sees every callback: "local" for a single worker, "unix" for the workers of one
+    # machine, through a broker on the Unix socket EBURY_MESSAGE_BUS_PATH.
+    EBURY_MESSAGE_BUS = "local"
+    EBURY_MESSAGE_BUS_PATH = "ebury-bus.sock"
+
+    # Logs are written as JSON lines by a background thread. Only this share of the
+    # webhook payloads are logged, and records are dropped if EBURY_LOG_QUEUE_SIZE are
+    # waiting to be written.
+    EBURY_LOG_LEVEL = "INFO"
+    EBURY_LOG_PAYLOAD_SAMPLE_RATE = 0.01
+    EBURY_LOG_QUEUE_SIZE = 10000
 
     DEBUG = True  # Set to False in production
     TESTING = False  # Set to True for testing environment
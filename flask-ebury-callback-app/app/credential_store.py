@@ -0,0 +1,261 @@
+import fcntl
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from .token_manager import TokenState
+
+# Where the token manager keeps the current token.
+# - InProcessCredentialStore keeps it in memory, every process has its own token.
+# - SqliteCredentialStore keeps it in a SQLite file shared by every process on the
+#   machine (e.g. gunicorn workers), with a file lock so only one process at a time
+#   talks to the auth server. A login on one worker is seen by all of them.
+#
+# load() is on the request path so it has to be cheap, save() and refresh_lock()
+# are only used when the token changes.
+#
+# The tokens of the operators who log in with their own session (see user_tokens.py)
+# are kept next to it, by user id, with when each user was last seen. load_user() is
+# on the request path as well, user_refresh_lock() is held while renewing one user's
+# token and doesn't hold up the others.
+
+
+class InProcessCredentialStore:
+    def __init__(self):
+        self._state = None
+        self._lock = threading.Lock()
+        # user id -> [state, last used]
+        self._users = {}
+
+    def load(self):
+        return self._state
+
+    def save(self, state):
+        self._state = state
+
+    @contextmanager
+    def refresh_lock(self):
+        with self._lock:
+            yield
+
+    # (state, last used) of a user, None when not logged in
+    def load_user(self, user_id):
+        user = self._users.get(user_id)
+        return tuple(user) if user is not None else None
+
+    def save_user(self, user_id, state):
+        with self._lock:
+            user = self._users.get(user_id)
+            if user is None:
+                self._users[user_id] = [state, time.time()]
+            else:
+                user[0] = state
+
+    def touch_user(self, user_id, now):
+        user = self._users.get(user_id)
+        if user is not None:
+            user[1] = now
+
+    def delete_user(self, user_id):
+        with self._lock:
+            return self._users.pop(user_id, None) is not None
+
+    # Forget the users last seen before idle_before, then the least recently seen ones
+    # over max_users. Returns (expired, evicted).
+    def prune_users(self, idle_before, max_users):
+        with self._lock:
+            expired = [user_id for user_id, (_, last_used) in self._users.items() if last_used < idle_before]
+            for user_id in expired:
+                del self._users[user_id]
+            evicted = sorted(self._users, key=lambda user_id: self._users[user_id][1])[:max(0, len(self._users) - max_users)]
+            for user_id in evicted:
+                del self._users[user_id]
+        return len(expired), len(evicted)
+
+    def count_users(self):
+        return len(self._users)
+
+    # Only this process has the users, the registry's lock per user is enough
+    @contextmanager
+    def user_refresh_lock(self, user_id):
+        yield
+
+    # In a forked worker the token is kept, the lock may have been held by another thread
+    def after_fork(self):
+        self._lock = threading.Lock()
+
+
+class SqliteCredentialStore:
+    SCHEMA = """
+    CREATE TABLE IF NOT EXISTS credentials (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        access_token TEXT,
+        refresh_token TEXT,
+        expires_at REAL NOT NULL,
+        id_claims TEXT NOT NULL
+    )
+    """
+    USERS_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS user_credentials (
+        user_id TEXT PRIMARY KEY,
+        access_token TEXT,
+        refresh_token TEXT,
+        expires_at REAL NOT NULL,
+        id_claims TEXT NOT NULL,
+        last_used REAL NOT NULL
+    )
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + '.lock'
+        self.users_lock_path = path + '.users.lock'
+        self._local = threading.local()
+        self._thread_lock = threading.Lock()
+        self._users_lock_fd = None
+
+        # the tokens are secrets, keep the files private
+        for file_path in (self.path, self.lock_path, self.users_lock_path):
+            os.close(os.open(file_path, os.O_CREAT | os.O_RDWR, 0o600))
+        conn = self._connect()
+        conn.execute(self.SCHEMA)
+        conn.execute(self.USERS_SCHEMA)
+        conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=10, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        return conn
+
+    # Each thread has its own connection and keeps the last state it read.
+    # PRAGMA data_version only changes when another connection has committed, so as
+    # long as it is unchanged the cached state is returned without reading the row.
+    def _thread_local(self):
+        local = self._local
+        conn = getattr(local, 'conn', None)
+        if conn is None:
+            conn = local.conn = self._connect()
+            local.version = None
+            local.state = None
+            local.users = {}
+        version = conn.execute('PRAGMA data_version').fetchone()[0]
+        if version != local.version:
+            local.state = self._read(conn)
+            local.users.clear()
+            local.version = version
+        return local
+
+    def load(self):
+        return self._thread_local().state
+
+    def _read(self, conn):
+        row = conn.execute(
+            'SELECT access_token, refresh_token, expires_at, id_claims FROM credentials WHERE id = 1'
+        ).fetchone()
+        return _token_state(row) if row is not None else None
+
+    def save(self, state):
+        self._write('INSERT OR REPLACE INTO credentials (id, access_token, refresh_token, expires_at, id_claims) '
+                    'VALUES (1, ?, ?, ?, ?)', _token_row(state))
+
+    def _write(self, sql, params=()):
+        conn = self._connect()
+        try:
+            with conn:
+                return conn.execute(sql, params).rowcount
+        finally:
+            conn.close()
+
+    # (state, last used) of a user, None when not logged in
+    def load_user(self, user_id):
+        local = self._thread_local()
+        if user_id not in local.users:
+            row = local.conn.execute(
+                'SELECT access_token, refresh_token, expires_at, id_claims, last_used FROM user_credentials '
+                'WHERE user_id = ?', (user_id,)
+            ).fetchone()
+            local.users[user_id] = (_token_state(row[:4]), row[4]) if row is not None else None
+        return local.users[user_id]
+
+    def save_user(self, user_id, state):
+        self._write('INSERT INTO user_credentials (user_id, access_token, refresh_token, expires_at, id_claims, last_used) '
+                    'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (user_id) DO UPDATE SET access_token = excluded.access_token, '
+                    'refresh_token = excluded.refresh_token, expires_at = excluded.expires_at, id_claims = excluded.id_claims',
+                    (user_id, *_token_row(state), time.time()))
+
+    def touch_user(self, user_id, now):
+        self._write('UPDATE user_credentials SET last_used = MAX(last_used, ?) WHERE user_id = ?', (now, user_id))
+
+    def delete_user(self, user_id):
+        return self._write('DELETE FROM user_credentials WHERE user_id = ?', (user_id,)) > 0
+
+    # Forget the users last seen before idle_before, then the least recently seen ones
+    # over max_users. Returns (expired, evicted).
+    def prune_users(self, idle_before, max_users):
+        expired = self._write('DELETE FROM user_credentials WHERE last_used < ?', (idle_before,))
+        evicted = self._write('DELETE FROM user_credentials WHERE user_id IN (SELECT user_id FROM user_credentials '
+                              'ORDER BY last_used DESC LIMIT -1 OFFSET ?)', (max_users,))
+        return expired, evicted
+
+    def count_users(self):
+        return self._thread_local().conn.execute('SELECT COUNT(*) FROM user_credentials').fetchone()[0]
+
+    # Held while renewing the token, by one thread in one process at a time
+    @contextmanager
+    def refresh_lock(self):
+        with self._thread_lock:
+            with open(self.lock_path, 'a') as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    # Held while renewing one user's token, by one process at a time. Each user has
+    # their own byte of the lock file, locked with a record lock. Record locks belong
+    # to the process and go when any descriptor of the file is closed, so the file is
+    # kept open, and the registry's lock per user keeps the process's threads apart.
+    @contextmanager
+    def user_refresh_lock(self, user_id):
+        with self._thread_lock:
+            if self._users_lock_fd is None:
+                self._users_lock_fd = os.open(self.users_lock_path, os.O_RDWR)
+        fd = self._users_lock_fd
+        offset = zlib.crc32(user_id.encode())
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1, offset)
+        try:
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1, offset)
+
+    # A forked worker opens its own connections, sqlite ones must not be shared across a fork
+    def after_fork(self):
+        self._local = threading.local()
+        self._thread_lock = threading.Lock()
+        # record locks are not inherited, closing the descriptor only drops this process's
+        if self._users_lock_fd is not None:
+            os.close(self._users_lock_fd)
+            self._users_lock_fd = None
+
+
+def _token_row(state):
+    return (state.access_token, state.refresh_token, state.expires_at,
+            json.dumps(state.id_claims or {'clients': state.clients}))
+
+
+def _token_state(row):
+    access_token, refresh_token, expires_at, id_claims = row
+    claims = json.loads(id_claims)
+    return TokenState(access_token, refresh_token, expires_at, claims.get('clients', []), claims)
+
+
+def create_credential_store(config):
+    backend = config.get('EBURY_CREDENTIAL_STORE', 'memory')
+    if backend == 'memory':
+        return InProcessCredentialStore()
+    if backend == 'sqlite':
+        return SqliteCredentialStore(config.get('EBURY_CREDENTIAL_STORE_PATH', 'credentials.db'))
+    raise ValueError(f"Unknown EBURY_CREDENTIAL_STORE: {backend}")
@@ -0,0 +1,144 @@
+import hashlib
+import math
+import threading
+import time
+from collections import OrderedDict
+from flask import current_app
+
+# Index of the webhook deliveries seen recently, used to spot Ebury redelivering
+# a webhook we already have.
+# Two tiers, both with a fixed memory footprint:
+# - a rotating Bloom filter covering the whole window. Two generations are kept and the
+#   older one is dropped every `window` seconds, so a key is remembered for at least `window`.
+# - an exact LRU of the most recent keys, used to confirm a Bloom filter hit so a false
+#   positive doesn't drop a genuinely new webhook.
+# /callback only checks a delivery against the index, it is added once its signature
+# has been verified (see webhooks.py), so a forged delivery reusing a genuine event id
+# can't get the genuine one dropped.
+
+
+class RotatingBloomFilter:
+    def __init__(self, capacity, error_rate, window):
+        self.window = window
+        # standard sizing for `capacity` keys per generation at the given false positive rate
+        self.bits = max(8, int(-capacity * math.log(error_rate) / (math.log(2) ** 2)))
+        self.hashes = max(1, round(self.bits / capacity * math.log(2)))
+        self._current = bytearray((self.bits + 7) // 8)
+        self._previous = bytearray(len(self._current))
+        self._rotated_at = time.monotonic()
+
+    def _rotate(self, now):
+        if now - self._rotated_at >= self.window:
+            self._previous = self._current
+            self._current = bytearray(len(self._previous))
+            self._rotated_at = now
+
+    # bit positions for a key, using double hashing over one 128 bit digest
+    def _positions(self, key):
+        digest = hashlib.blake2b(key, digest_size=16).digest()
+        h1 = int.from_bytes(digest[:8], 'little')
+        h2 = int.from_bytes(digest[8:], 'little') | 1
+        return [(h1 + i * h2) % self.bits for i in range(self.hashes)]
+
+    def _contains(self, bits, positions):
+        return all(bits[p >> 3] & (1 << (p & 7)) for p in positions)
+
+    # Returns True if the key may have been added before
+    def contains(self, key, now):
+        self._rotate(now)
+        positions = self._positions(key)
+        return self._contains(self._current, positions) or self._contains(self._previous, positions)
+
+    # Returns True if the key may have been added before, then adds it
+    def check_and_add(self, key, now):
+        self._rotate(now)
+        positions = self._positions(key)
+        seen = self._contains(self._current, positions) or self._contains(self._previous, positions)
+        for p in positions:
+            self._current[p >> 3] |= 1 << (p & 7)
+        return seen
+
+    @property
+    def memory_bytes(self):
+        return len(self._current) + len(self._previous)
+
+
+class DeliveryIndex:
+    def __init__(self, window=86400, capacity=1000000, error_rate=1e-5, exact_entries=100000):
+        self.window = window
+        self.exact_entries = exact_entries
+        self._bloom = RotatingBloomFilter(capacity, error_rate, window)
+        self._recent = OrderedDict()
+        # time the newest key evicted from the exact tier was last seen
+        self._evicted_at = None
+        self._lock = threading.Lock()
+        self._stats = {'checked': 0, 'added': 0, 'duplicates': 0, 'probable_duplicates': 0, 'bloom_false_positives': 0}
+
+    # Returns True if the key was already seen within the window, without recording it
+    def check(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._stats['checked'] += 1
+            return self._seen(now, self._bloom.contains(key, now), self._recent.get(key))
+
+    # Returns True if the key was already seen within the window, and records it as seen
+    def check_and_add(self, key):
+        now = time.monotonic()
+        with self._lock:
+            self._stats['added'] += 1
+            maybe_seen = self._bloom.check_and_add(key, now)
+
+            seen_at = self._recent.get(key)
+            self._recent[key] = now
+            self._recent.move_to_end(key)
+            if len(self._recent) > self.exact_entries:
+                _, self._evicted_at = self._recent.popitem(last=False)
+            return self._seen(now, maybe_seen, seen_at)
+
+    def _seen(self, now, maybe_seen, seen_at):
+        if not maybe_seen:
+            return False
+        if seen_at is not None and now - seen_at < self.window:
+            self._stats['duplicates'] += 1
+            return True
+        # The Bloom filter has seen it but the exact tier hasn't. If nothing was evicted from the
+        # exact tier within the window, it holds every key of the window and this is a false positive.
+        if self._evicted_at is None or now - self._evicted_at >= self.window:
+            self._stats['bloom_false_positives'] += 1
+            return False
+        self._stats['probable_duplicates'] += 1
+        return True
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['exact_entries'] = len(self._recent)
+        stats['bloom_bytes'] = self._bloom.memory_bytes
+        return stats
+
+
+# Key identifying a webhook delivery. Redeliveries of a webhook have the same event id,
+# webhooks without one are told apart by their body.
+def delivery_key(raw_body, event_id=None):
+    if event_id is not None:
+        return hashlib.blake2b(b'id:' + str(event_id).encode(), digest_size=16).digest()
+    return hashlib.blake2b(raw_body, digest_size=16).digest()
+
+
+_index = None
+_index_lock = threading.Lock()
+
+# Get the process wide delivery index, created on first use from the app config
+def get_delivery_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                config = current_app.config
+                _index = DeliveryIndex(
+                    window=config.get('EBURY_DEDUP_WINDOW', 86400),
+                    capacity=config.get('EBURY_DEDUP_CAPACITY', 1000000),
+                    error_rate=config.get('EBURY_DEDUP_ERROR_RATE', 1e-5),
+                    exact_entries=config.get('EBURY_DEDUP_EXACT_ENTRIES', 100000),
+                )
+    return _index
@@ -1,42 +1,51 @@
-import requests
 from urllib.parse import urlencode, urlparse, parse_qs
 from flask import current_app
-from base64 import b64encode, urlsafe_b64decode
+from base64 import b64encode
+import logging
 import time
 import json
-import threading
-import os
-
-# Note that global variables are not being storing in a flask session, because not expecting
-# to have multiple users logging in at the same time.
-access_token = None
-refresh_token = None
-token_expiration = 0
-clients = []
-# Global variable to control the token watcher thread
-# token_watcher_started = False
-# stop_token_watcher = False
-
-token_refresh_lock = threading.Lock()
+from .concurrency import fetch_all
+from .http_client import get_http_client
+from .cache import cached, invalidate
+from .token_manager import TokenManager, TokenState
+from .user_tokens import current_user, get_user_tokens
+from .client_directory import client_headers, decode_claims
+from . import graphql
+
+logger = logging.getLogger(__name__)
+
+# The app has its own token, kept fresh in the background by the token manager (see
+# token_manager.py), from the host to host login or the first /ebo_login.
+# With EBURY_USER_SESSIONS each operator who logs in through /ebo_login gets their own
+# token instead, kept with their Flask session (see user_tokens.py), and the requests
+# they make use it.
+
+# Get a new token from the auth server, using the refresh token if there is one,
+# otherwise by logging in with the username and password from the config file
+def renew_token(state):
+    if state is not None and state.refresh_token:
+        return refresh_ebury_token(state.refresh_token)
+    logger.info("No valid access token found. Logging in...")
+    return request_ebury_token(login_ebury())
+
+# An operator's token can only be renewed with its refresh token, without one they log in again
+def renew_user_token(state):
+    if not state.refresh_token:
+        raise ValueError("Session expired, log in again")
+    return refresh_ebury_token(state.refresh_token)
+
+token_manager = TokenManager(renew_token)
 
 def get_access_token():
-    global access_token, refresh_token, token_expiration
-    
-    # Debug print to see which thread is calling this function
-    #print(f"get_access_token called from thread: {threading.current_thread().name}")
-    
-    # Ensure only one thread at a time can refresh the token
-    with token_refresh_lock:  
-        # Check fro refresh
-        if access_token is None or time.time() >= token_expiration:
-            if refresh_token:
-                print(f"{time.strftime('%Y-%m-%d %H:%M:%S')} - Refreshing access token using refresh token...")
-                access_token = refresh_ebury_token(refresh_token)
-            else:
-                print("No valid access token found. Logging in...")
-                auth_response = login_ebury()
-                access_token = get_ebury_token(auth_response)
-    return access_token
+    user = current_user()
+    if user is not None:
+        return get_user_tokens().access_token(user)
+    return token_manager.get_access_token()
+
+# The TokenState in use for this request, the operator's or the app's own
+def current_state():
+    user = current_user()
+    return user.state if user is not None else token_manager.current()
 
 # by pass the ebo login screen and use the username and password from the config file
 def login_ebury():
@@ -63,7 +72,7 @@ def login_ebury():
         "client_id": clientid,
         "state": state
     }
-    response = requests.post(url, headers=headers, data=data, allow_redirects=False)
+    response = get_http_client().post(url, headers=headers, data=data, allow_redirects=False)
     
     if response.status_code == 302:
         redirect_url = response.headers.get('Location')
@@ -80,7 +89,18 @@ def login_ebury():
     else: # if response is 200 then need to say that don't support 2fa on host to host logon type
         raise ValueError(f"Unexpected response status code: {response.status_code}")
 
+# Exchange the code from the login for a token and start using it
 def get_ebury_token(auth_response):
+    state = request_ebury_token(auth_response)
+    token_manager.set_state(state)
+    return state.access_token
+
+# Exchange the code from an operator's login for their own token, returns the user id
+# to keep in their session
+def login_user(auth_response):
+    return get_user_tokens().login(request_ebury_token(auth_response))
+
+def request_ebury_token(auth_response):
     code = auth_response.get('code')
     if not code:
         raise ValueError("Login response does not contain 'code'")
@@ -100,7 +120,7 @@ def get_ebury_token(auth_response):
         "redirect_uri": redirecturl
     }
     
-    response = requests.post(url, headers=headers, data=data)
+    response = get_http_client().post(url, headers=headers, data=data)
     
     if response.status_code == 200:
         # get the access token and set the expiration time.
@@ -108,30 +128,31 @@ def get_ebury_token(auth_response):
             token_response = response.json()
         except json.JSONDecodeError:
             raise ValueError("Invalid JSON response received from the server")
-        access_token = process_token_response(token_response)
-        
-        return access_token
+        return process_token_response(token_response)
     else:
         response.raise_for_status()
+        # a status raise_for_status lets through, e.g. a redirect
+        raise ValueError(f"Unexpected response status code: {response.status_code}")
 
+# Turn the token response into a TokenState
 def process_token_response(token_response):
-    global access_token, token_expiration, refresh_token, clients
     # Get the access token and set the expiration time
     access_token = token_response.get('access_token')
     refresh_token = token_response.get('refresh_token')
-    token_expiration = time.time() + token_response.get('expires_in', 3600) - 60  # Refresh 1 minute before expiration
+    token_expiration = time.time() + token_response.get('expires_in', 3600) - 60  # Stop using it 1 minute before expiration
 
     # Extract the clients information from the JSON web token id_token
-    # and store them in a global variable for later use
+    # and keep them with the token for later use. The payload is only decoded
+    # when it differs from the last ones (see client_directory.py)
     id_token = token_response.get('id_token')
     if id_token:
         id_token_parts = id_token.split('.')
-        id_token_payload = json.loads(urlsafe_b64decode(id_token_parts[1] + '==').decode())
+        id_token_payload = decode_claims(id_token_parts[1])
         clients = id_token_payload.get('clients', [])
     else:
         raise ValueError("ID token not found in the response")
-    
-    return access_token
+
+    return TokenState(access_token, refresh_token, token_expiration, clients, id_token_payload)
 
 def refresh_ebury_token(refresh_token):
     auth_clientid = current_app.config['EBURY_AUTH_CLIENT_ID']
@@ -148,296 +169,134 @@ def refresh_ebury_token(refresh_token):
         "scope": "openid"
     }
     
-    response = requests.post(url, headers=headers, data=data)
+    response = get_http_client().post(url, headers=headers, data=data)
     
     if response.status_code == 200:
-        access_token = process_token_response(response.json())
-        return access_token
+        return process_token_response(response.json())
     else:
-        print("Failed to refresh token:", response.status_code, response.text)
-        return access_token # just let the token expire and try again
-    
-# This function will run in a separate thread to monitor the token expiration
-# and refresh it when necessary
-# def token_watcher():
-#     global stop_token_watcher, access_token
-
-#     while not stop_token_watcher:
-#         access_token = get_access_token()
-#         # Sleep for a short interval before checking again
-#         time.sleep(30)  # Check every 30 seconds
-
-# Function to start the token watcher thread
-# def start_token_watcher(app):
-#     global token_watcher_started
-
-    # Debug log to check the environment variable
-    # print(f"FLASK_RUN_FROM_CLI: {os.environ.get('FLASK_RUN_FROM_CLI')}")
-
-    # Prevent multiple threads in development mode with Flask's reloader
-    # if app.debug and os.environ.get('FLASK_RUN_FROM_CLI') != 'true':
-    #     print("Not starting token watcher in reloader process.")
-    #     return
-    
-    # Check if running in Gunicorn
-    # if "gunicorn" in os.environ.get("SERVER_SOFTWARE", ""):
-    #     print("Running in Gunicorn. Skipping token watcher in worker processes.")
-    #     return
-
-    if token_watcher_started:
-        print("Token watcher thread is already running. Skipping...")
-        return
-    
-    def token_watcher_with_context():
-        with app.app_context():
-            token_watcher()
-
-    watcher_thread = threading.Thread(target=token_watcher_with_context, daemon=True)
-    watcher_thread.start()
-    token_watcher_started = True
-    print("Token watcher thread started.")
+        # the token manager keeps using the current token and tries again later
+        logger.warning("Failed to refresh token",
+                       extra={'fields': {'status': response.status_code, 'response': response.text[:500]}})
+        response.raise_for_status()
+        raise ValueError(f"Unexpected response status code: {response.status_code}")
 
-# Function to get a list of clients
-def get_clients():
-    global clients
+# Function to get the clients of the login, indexed by client_id (see client_directory.py)
+def get_client_directory():
     # Get the clients list from the jwt returned with the access token
     # Another way would be to call the clients endpoint on the API
     access_token = get_access_token()
     if access_token is None:
         raise ValueError("Access token not found")
     else:
-        return clients
+        return current_state().directory
 
-# Function to get the balance for each client
-def get_ebury_balance():
-    global clients
+# Function to get a list of clients
+def get_clients():
+    return get_client_directory().clients
+
+# Function to get the balances of a single client
+def get_client_balance(client_id):
     access_token = get_access_token()
+    url = current_app.config['EBURY_API_URL'] + "balances?client_id=" + client_id
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+
+    response = get_http_client().get(url, headers=headers)
+    response.raise_for_status()
+    return response.json()
+
+# Function to get the balance for each client
+# The per client calls are cached (see EBURY_CACHE_TTLS) unless use_cache is False and
+# run concurrently (see EBURY_MAX_CONCURRENCY), a client whose call fails gets
+# {'error': ...} instead of failing the whole page
+def get_ebury_balance(client_ids=None, use_cache=True):
+    if client_ids is None:
+        client_ids = get_client_directory().client_ids
+
+    if use_cache:
+        fetch = lambda client_id: cached('balances', client_id, lambda: get_client_balance(client_id))
+    else:
+        fetch = get_client_balance
+    results = fetch_all(fetch, client_ids)
+
     balances = {}
-    
-    for client in clients:
-        client_id = client.get('client_id')
-        url = current_app.config['EBURY_API_URL'] + "balances?client_id=" + client_id
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-        }
-        
-        response = requests.get(url, headers=headers)
-        
-        if response.status_code == 200:
-            balances[client_id] = response.json()
+    for client_id, result in zip(client_ids, results):
+        if isinstance(result, Exception):
+            balances[client_id] = {'error': str(result)}
         else:
-            response.raise_for_status()
-    
+            balances[client_id] = result
+
     return balances
 
+# Function to get the webhook subscriptions of a single client, all pages of them
+def get_client_webhook_subscriptions(client_id):
+    access_token = get_access_token()
+    page_size = current_app.config.get('EBURY_GRAPHQL_PAGE_SIZE', 100)
+    max_pages = current_app.config.get('EBURY_GRAPHQL_MAX_PAGES', 100)
+    return graphql.fetch_all_subscriptions(access_token, client_id, page_size, max_pages)
+
 # Function to get the webhook subscriptions for each client
+# The per client queries are cached and run concurrently like the balances,
+# a client whose query fails gets {'error': ...}
 def get_webhook_subscriptions():
-    access_token = get_access_token()
+    client_ids = get_client_directory().client_ids
+
+    results = fetch_all(
+        lambda client_id: cached('webhooks', client_id, lambda: get_client_webhook_subscriptions(client_id)),
+        client_ids
+    )
+
     webhooks = {}
-    url = current_app.config['EBURY_API_URL'] + "webhooks/graphql"
-    global clients
-    for client in clients:
-        client_id = client.get('client_id')
-        headers = {
-            "Authorization": f"Bearer {access_token}",
-            "Content-Type": "application/json",
-            "X-Client-ID": client_id
-        }
-        query = {
-            "query": """
-            {
-                subscriptions {
-                    totalCount
-                    nodes {
-                        id
-                        clientId
-                        createdAt
-                        url
-                        active
-                        types
-                    }
-                }
-            }
-            """
-        }
-        
-        response = requests.post(url, headers=headers, json=query)
-        
-        if response.status_code == 200:
-            webhooks[client_id] = response.json()
+    for client_id, result in zip(client_ids, results):
+        if isinstance(result, Exception):
+            webhooks[client_id] = {'error': str(result)}
         else:
-            response.raise_for_status()
+            webhooks[client_id] = result
 
     return webhooks
 
+# Run a subscription mutation for a client, the client's subscription list
+# has changed afterwards so it is dropped from the cache
+def mutate_subscription(client_id, document, mutation_input):
+    access_token = get_access_token()
+    try:
+        return graphql.execute(access_token, client_id, document, {"input": mutation_input})
+    finally:
+        invalidate('webhooks', client_id)
+
 # note that the delete function is currently broken on the api side
 def delete_webhook_subscription(client_id, subscription_id):
-    access_token = get_access_token()
-    # need to update this and pass in the client_id
-    url = current_app.config['EBURY_API_URL'] + "webhooks/graphql?client_id=" + client_id
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    
-    query = {
-        "query": """
-        mutation {
-            deleteSubscription(input: {id: "%s"}) {
-                subscription {
-                    id
-                }
-            }
-        }
-        """ % subscription_id
-    }
-    
-    response = requests.post(url, headers=headers, json=query)
-    
-    if response.status_code == 200:
-        return {'status': 'success'}
-    else:
-        response.raise_for_status()
+    mutate_subscription(client_id, graphql.DELETE_SUBSCRIPTION_MUTATION, {"id": subscription_id})
+    return {'status': 'success'}
 
 def disable_webhook_subscription(client_id, subscription_id):
-    access_token = get_access_token()
-    url = current_app.config['EBURY_API_URL'] + "webhooks/graphql?client_id=" + client_id
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    
-    query = {
-        "query": """
-        mutation {
-            updateSubscription(input: {id: "%s", patch: {active: false}}) {
-                subscription {
-                    id
-                    active
-                }
-            }
-        }
-        """ % subscription_id
-    }
-    
-    response = requests.post(url, headers=headers, json=query)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
+    return mutate_subscription(client_id, graphql.UPDATE_SUBSCRIPTION_MUTATION,
+                               {"id": subscription_id, "patch": {"active": False}})
 
 def enable_webhook_subscription(client_id, subscription_id):
-    access_token = get_access_token()
-    url = current_app.config['EBURY_API_URL'] + "webhooks/graphql?client_id=" + client_id
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-    
-    query = {
-        "query": """
-        mutation {
-            updateSubscription(input: {id: "%s", patch: {active: true}}) {
-                subscription {
-                    id
-                    active
-                }
-            }
-        }
-        """ % subscription_id
-    }
-    
-    response = requests.post(url, headers=headers, json=query)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
+    return mutate_subscription(client_id, graphql.UPDATE_SUBSCRIPTION_MUTATION,
+                               {"id": subscription_id, "patch": {"active": True}})
 
+# The subscription types are fetched once and then kept for the life of the process
 def get_subscription_types():
     access_token = get_access_token()
-    url = current_app.config['EBURY_API_URL'] + "webhooks/graphql?client_id=" + clients[0].get('client_id')
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json"
-    }
-    
-    query = {
-            "query": """
-            {
-                __type(name: "WebhookType") {
-                    name
-                    enumValues {
-                        name
-                    }
-                }
-                webhookTypes
-            }
-            """
-        }
-    
-    response = requests.post(url, headers=headers, json=query)
-    
-    if response.status_code == 200:
-        response_json = response.json()
-        print("Subscription Types Response:", response_json)  # Log the response
-        return response_json
-    else:
-        response.raise_for_status()
+    return graphql.fetch_subscription_types(access_token, get_client_directory().first().client_id)
 
 def create_subscription(client_id, callback_url, types, secret):
-    access_token = get_access_token()
-    url = current_app.config['EBURY_API_URL'] + "webhooks/graphql?client_id=" + client_id
-    
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-    }
-
-    # Format the types array as a list of enum values
-    formatted_types = "["+ ', '.join([f'{type}' for type in types])+"]"
-    
-    
-    query = {
-        "query": """
-        mutation {
-            createSubscription(input: {subscription: {url: "%s", types: %s, active: true, secret: "%s"}}) {
-                subscription {
-                    id
-                    url
-                    types
-                    active
-                }
-            }
-        }
-        """ % (callback_url, formatted_types, secret)
-    }
-    
-    response = requests.post(url, headers=headers, json=query)
-    
-    if response.status_code == 200:
-        return response.json()
-    else:
-        response.raise_for_status()
+    # types is a list of WebhookType enum values, sent as a JSON list of their names
+    return mutate_subscription(client_id, graphql.CREATE_SUBSCRIPTION_MUTATION, {
+        "subscription": {"url": callback_url, "types": list(types), "active": True, "secret": secret}
+    })
 
 def ping_subscription(client_id, subscription_id):
     access_token = get_access_token()
     url = current_app.config['EBURY_API_URL'] + "webhooks/ping/" + subscription_id
-
-    headers = {
-        "Authorization": f"Bearer {access_token}",
-        "Content-Type": "application/json",
-        "X-Client-ID": client_id
-    }
+    headers = client_headers(access_token, client_id)
 
     # Fetch the subscription details
-    response = requests.post(url, headers=headers)
+    response = get_http_client().post(url, headers=headers)
     if response.status_code == 204: # 204 No Content indicates a successful ping
         return {'status': 'success', 'message': 'Ping successful'}
     else:
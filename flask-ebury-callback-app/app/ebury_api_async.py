@@ -0,0 +1,211 @@
+from urllib.parse import urlparse, parse_qs
+from flask import current_app
+from base64 import b64encode
+import asyncio
+from .concurrency import gather_all
+from .async_runtime import request, request_json
+from .cache import cached_async, invalidate
+from .ebury_api import token_manager, current_state, process_token_response
+from .client_directory import client_headers
+from .user_tokens import current_user, get_user_tokens
+from . import graphql
+
+# asyncio version of ebury_api.py, with the same functions as coroutines.
+# They run on the async runtime (see async_runtime.py), e.g.
+#   run_async(ebury_api_async.get_ebury_balance())
+# and share the token manager, the cache and the GraphQL documents with ebury_api.
+# The token is still renewed by the token manager's thread (or, for an operator's own
+# token, by the registry in user_tokens.py), a coroutine only calls them on a worker
+# thread when the token can't be used as it is.
+
+async def get_access_token():
+    user = current_user()
+    if user is not None:
+        tokens = get_user_tokens()
+        token = tokens.current_token(user)
+        if token is not None:
+            return token
+        return await asyncio.to_thread(tokens.access_token, user)
+    state = token_manager.current()
+    if state is not None and state.is_valid():
+        return state.access_token
+    return await asyncio.to_thread(token_manager.get_access_token)
+
+def _basic_auth():
+    auth_clientid = current_app.config['EBURY_AUTH_CLIENT_ID']
+    clientsecret = current_app.config['EBURY_AUTH_CLIENT_SECRET']
+    return f"Basic {b64encode(f'{auth_clientid}:{clientsecret}'.encode()).decode()}"
+
+# by pass the ebo login screen and use the username and password from the config file
+async def login_ebury():
+    email = current_app.config['EBURY_USERNAME']
+    password = current_app.config['EBURY_PASSWORD']
+    clientid = current_app.config['EBURY_AUTH_CLIENT_ID']
+    url = current_app.config['EBURY_AUTHENTICATION_URL'] + "login"
+
+    if email is None or password is None:
+        raise ValueError("Email and password must be provided in the config file")
+    if clientid is None:
+        raise ValueError("Client ID must be provided in the config file")
+
+    headers = {
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    data = {
+        "email": email,
+        "password": password,
+        "client_id": clientid,
+        "state": "random_state"
+    }
+    status, response_headers, _ = await request('POST', url, headers=headers, data=data, allow_redirects=False)
+
+    if status != 302:
+        raise ValueError(f"Unexpected response status code: {status}")
+    redirect_url = response_headers.get('Location')
+    if not redirect_url:
+        raise ValueError("Redirect URL not found in the response headers")
+    code = parse_qs(urlparse(redirect_url).query).get('code', [None])[0]
+    if not code:
+        raise ValueError("Code not found in the redirect URL")
+    return {'code': code}
+
+# Exchange the code from the login for a token and start using it
+async def get_ebury_token(auth_response):
+    state = await request_ebury_token(auth_response)
+    await asyncio.to_thread(token_manager.set_state, state)
+    return state.access_token
+
+async def request_ebury_token(auth_response):
+    code = auth_response.get('code')
+    if not code:
+        raise ValueError("Login response does not contain 'code'")
+
+    url = current_app.config['EBURY_AUTHENTICATION_URL'] + "token"
+    headers = {
+        "Authorization": _basic_auth(),
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    data = {
+        "grant_type": "authorization_code",
+        "code": code,
+        "redirect_uri": current_app.config['EBURY_REDIRECT_URL']
+    }
+    return process_token_response(await request_json('POST', url, headers=headers, data=data))
+
+async def refresh_ebury_token(refresh_token):
+    url = current_app.config['EBURY_AUTHENTICATION_URL'] + "token"
+    headers = {
+        "Authorization": _basic_auth(),
+        "Content-Type": "application/x-www-form-urlencoded"
+    }
+    data = {
+        "grant_type": "refresh_token",
+        "refresh_token": refresh_token,
+        "scope": "openid"
+    }
+    return process_token_response(await request_json('POST', url, headers=headers, data=data))
+
+async def get_client_directory():
+    access_token = await get_access_token()
+    if access_token is None:
+        raise ValueError("Access token not found")
+    return current_state().directory
+
+async def get_clients():
+    return (await get_client_directory()).clients
+
+async def get_client_balance(client_id):
+    access_token = await get_access_token()
+    url = current_app.config['EBURY_API_URL'] + "balances?client_id=" + client_id
+    headers = {
+        "Authorization": f"Bearer {access_token}",
+        "Content-Type": "application/json",
+    }
+    return await request_json('GET', url, headers=headers)
+
+# Balances for each client, cached unless use_cache is False and at most
+# EBURY_MAX_CONCURRENCY in flight like ebury_api.get_ebury_balance, a client whose
+# call fails gets {'error': ...}
+async def get_ebury_balance(client_ids=None, use_cache=True):
+    if client_ids is None:
+        client_ids = (await get_client_directory()).client_ids
+
+    if use_cache:
+        fetch = lambda client_id: cached_async('balances', client_id, lambda: get_client_balance(client_id))
+    else:
+        fetch = get_client_balance
+    results = await gather_all(fetch, client_ids)
+
+    balances = {}
+    for client_id, result in zip(client_ids, results):
+        if isinstance(result, Exception):
+            balances[client_id] = {'error': str(result)}
+        else:
+            balances[client_id] = result
+
+    return balances
+
+async def get_client_webhook_subscriptions(client_id):
+    access_token = await get_access_token()
+    page_size = current_app.config.get('EBURY_GRAPHQL_PAGE_SIZE', 100)
+    max_pages = current_app.config.get('EBURY_GRAPHQL_MAX_PAGES', 100)
+    return await graphql.fetch_all_subscriptions_async(access_token, client_id, page_size, max_pages)
+
+async def get_webhook_subscriptions():
+    client_ids = (await get_client_directory()).client_ids
+
+    results = await gather_all(
+        lambda client_id: cached_async('webhooks', client_id, lambda: get_client_webhook_subscriptions(client_id)),
+        client_ids
+    )
+
+    webhooks = {}
+    for client_id, result in zip(client_ids, results):
+        if isinstance(result, Exception):
+            webhooks[client_id] = {'error': str(result)}
+        else:
+            webhooks[client_id] = result
+
+    return webhooks
+
+async def mutate_subscription(client_id, document, mutation_input):
+    access_token = await get_access_token()
+    try:
+        return await graphql.execute_async(access_token, client_id, document, {"input": mutation_input})
+    finally:
+        invalidate('webhooks', client_id)
+
+async def delete_webhook_subscription(client_id, subscription_id):
+    await mutate_subscription(client_id, graphql.DELETE_SUBSCRIPTION_MUTATION, {"id": subscription_id})
+    return {'status': 'success'}
+
+async def disable_webhook_subscription(client_id, subscription_id):
+    return await mutate_subscription(client_id, graphql.UPDATE_SUBSCRIPTION_MUTATION,
+                                     {"id": subscription_id, "patch": {"active": False}})
+
+async def enable_webhook_subscription(client_id, subscription_id):
+    return await mutate_subscription(client_id, graphql.UPDATE_SUBSCRIPTION_MUTATION,
+                                     {"id": subscription_id, "patch": {"active": True}})
+
+async def get_subscription_types():
+    access_token = await get_access_token()
+    directory = await get_client_directory()
+    return await graphql.fetch_subscription_types_async(access_token, directory.first().client_id)
+
+async def create_subscription(client_id, callback_url, types, secret):
+    return await mutate_subscription(client_id, graphql.CREATE_SUBSCRIPTION_MUTATION, {
+        "subscription": {"url": callback_url, "types": list(types), "active": True, "secret": secret}
+    })
+
+async def ping_subscription(client_id, subscription_id):
+    access_token = await get_access_token()
+    url = current_app.config['EBURY_API_URL'] + "webhooks/ping/" + subscription_id
+    headers = client_headers(access_token, client_id)
+
+    status, _, _ = await request('POST', url, headers=headers)
+    if status == 204: # 204 No Content indicates a successful ping
+        return {'status': 'success', 'message': 'Ping successful'}
+    else:
+        return {'status': 'error',
+                'message': f'Ping failed with status code {status}'
+        }
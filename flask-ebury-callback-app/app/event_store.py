@@ -0,0 +1,220 @@
+import json
+import logging
+import queue
+import sqlite3
+import threading
+import time
+from flask import current_app
+from .broadcaster import get_broadcaster
+
+logger = logging.getLogger(__name__)
+
+# Durable log of the verified webhooks, so the callbacks page can show what arrived
+# while nobody was looking at it.
+# Events are kept in a SQLite database in WAL mode. Each event gets a monotonic
+# sequence number (the seq column), appends are queued and written by a single
+# writer thread that commits everything waiting in one transaction (group commit).
+# The body of a webhook is stored as the bytes it came as (payload BLOB), with the
+# header info as JSON next to it (headers).
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    received_at REAL NOT NULL,
+    client_id TEXT,
+    webhook_type TEXT,
+    payload BLOB NOT NULL,
+    headers TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS events_client_id ON events (client_id, seq);
+CREATE INDEX IF NOT EXISTS events_webhook_type ON events (webhook_type, seq);
+CREATE INDEX IF NOT EXISTS events_received_at ON events (received_at);
+"""
+
+
+class EventStore:
+    def __init__(self, path, batch_size=1000, max_pending=100000):
+        self.path = path
+        self.batch_size = batch_size
+        self._pending = queue.Queue(maxsize=max_pending)
+        # called with the list of committed events after every commit
+        self._listeners = []
+        self._local = threading.local()
+        self._writer = None
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'appended': 0, 'committed': 0, 'commits': 0, 'dropped': 0, 'failed': 0}
+
+        conn = self._connect()
+        conn.executescript(SCHEMA)
+        conn.commit()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=5, check_same_thread=False)
+        conn.execute('PRAGMA journal_mode=WAL')
+        # in WAL mode NORMAL only syncs at checkpoints, a commit stays durable across app crashes
+        conn.execute('PRAGMA synchronous=NORMAL')
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    # Connection used for reads, one per thread
+    def _reader(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = self._local.conn = self._connect()
+        return conn
+
+    def add_listener(self, listener):
+        self._listeners.append(listener)
+
+    def start(self):
+        with self._start_lock:
+            if self._writer is None:
+                self._writer = threading.Thread(target=self._write_loop, name='event-store-writer', daemon=True)
+                self._writer.start()
+
+    # Queue a webhook body (bytes) and its header info for writing, this never blocks.
+    # Returns False if the event was dropped because the writer has fallen too far behind.
+    def append(self, body, header_info=None, client_id=None, webhook_type=None, received_at=None):
+        if self._writer is None:
+            self.start()
+        event = {
+            'received_at': received_at if received_at is not None else time.time(),
+            'client_id': client_id,
+            'webhook_type': webhook_type,
+            'header_info': header_info,
+            'body': body,
+        }
+        try:
+            self._pending.put_nowait(event)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['dropped'] += 1
+            return False
+        with self._stats_lock:
+            self._stats['appended'] += 1
+        return True
+
+    def _write_loop(self):
+        conn = self._connect()
+        while True:
+            batch = [self._pending.get()]
+            # everything that arrived while the last commit was running goes in this one
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self._pending.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                with conn:
+                    for event in batch:
+                        cursor = conn.execute(
+                            'INSERT INTO events (received_at, client_id, webhook_type, payload, headers) '
+                            'VALUES (?, ?, ?, ?, ?)',
+                            (event['received_at'], event['client_id'], event['webhook_type'],
+                             event['body'], json.dumps(event['header_info'])),
+                        )
+                        event['seq'] = cursor.lastrowid
+            except sqlite3.Error as e:
+                logger.exception("Failed to write webhook events", extra={'fields': {'events': len(batch)}})
+                with self._stats_lock:
+                    self._stats['failed'] += len(batch)
+                for event in batch:
+                    event['seq'] = None
+            else:
+                with self._stats_lock:
+                    self._stats['committed'] += len(batch)
+                    self._stats['commits'] += 1
+
+            for listener in self._listeners:
+                try:
+                    listener(batch)
+                except Exception as e:
+                    logger.exception("Event store listener failed")
+
+    # Page through the stored events.
+    # With `after` events are returned oldest first starting after that seq, otherwise
+    # newest first, starting before `before` when given. Filters are optional.
+    # Events have the parsed body with the header info merged in as 'payload', or with
+    # `raw` the 'header_info' and the 'body' bytes as the browsers are sent them.
+    def query(self, after=None, before=None, limit=100, client_id=None, webhook_type=None,
+              since=None, until=None, raw=False):
+        conditions = []
+        params = []
+        if after is not None:
+            conditions.append('seq > ?')
+            params.append(after)
+        if before is not None:
+            conditions.append('seq < ?')
+            params.append(before)
+        if client_id is not None:
+            conditions.append('client_id = ?')
+            params.append(client_id)
+        if webhook_type is not None:
+            conditions.append('webhook_type = ?')
+            params.append(webhook_type)
+        if since is not None:
+            conditions.append('received_at >= ?')
+            params.append(since)
+        if until is not None:
+            conditions.append('received_at < ?')
+            params.append(until)
+
+        sql = 'SELECT seq, received_at, client_id, webhook_type, payload, headers FROM events'
+        if conditions:
+            sql += ' WHERE ' + ' AND '.join(conditions)
+        sql += ' ORDER BY seq ' + ('ASC' if after is not None else 'DESC') + ' LIMIT ?'
+        params.append(limit)
+
+        rows = self._reader().execute(sql, params).fetchall()
+        return [stored_event(row, raw) for row in rows]
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['pending'] = self._pending.qsize()
+        return stats
+
+
+def stored_event(row, raw=False):
+    event = {
+        'seq': row['seq'],
+        'received_at': row['received_at'],
+        'client_id': row['client_id'],
+        'webhook_type': row['webhook_type'],
+    }
+    payload = row['payload']
+    header_info = json.loads(row['headers'])
+    if raw:
+        event['header_info'] = header_info
+        event['body'] = payload
+        return event
+    try:
+        data = json.loads(payload)
+    except ValueError:
+        data = payload.decode('utf-8', 'replace')
+    if isinstance(data, dict):
+        event['payload'] = {'header info': header_info, **data}
+    else:
+        event['payload'] = {'header info': header_info, 'body': data}
+    return event
+
+
+_store = None
+_store_lock = threading.Lock()
+
+# Get the process wide event store, opened on first use from the app config
+def get_event_store():
+    global _store
+    if _store is None:
+        with _store_lock:
+            if _store is None:
+                config = current_app.config
+                _store = EventStore(
+                    config.get('EBURY_EVENT_STORE_PATH', 'events.db'),
+                    batch_size=config.get('EBURY_EVENT_STORE_BATCH_SIZE', 1000),
+                    max_pending=config.get('EBURY_EVENT_STORE_MAX_PENDING', 100000),
+                )
+                # committed events are pushed to the 'callbacks' page
+                _store.add_listener(get_broadcaster().publish)
+    return _store
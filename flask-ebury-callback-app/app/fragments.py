@@ -0,0 +1,124 @@
+import hashlib
+import itertools
+import threading
+from collections import OrderedDict
+from flask import current_app, make_response, render_template, request
+from markupsafe import Markup
+
+# Render cache for the dashboard pages (balance, webhooks, clients, new subscription).
+# A page is put together from fragments, e.g. the column of one client, each rendered
+# from the data it shows. The data comes from the API cache (or the balance snapshots),
+# which hands out the same object until it is refreshed or invalidated, so a fragment
+# is only rendered again when it is given a different object than last time.
+# Every rendered fragment gets a new version, and the ETag of a page is a hash of the
+# versions of its fragments: a browser that already has the page gets a 304 without
+# anything being rendered, and the last pages rendered are kept for the others.
+#
+# Fragment templates live in templates/fragments and are rendered with `key` (what the
+# fragment is cached under, e.g. the client id) and `data`, nothing else, so the key and
+# the data are all a fragment can depend on.
+
+
+class Fragment:
+    __slots__ = ('data', 'version', 'html')
+
+    def __init__(self, data, version, html):
+        # held on to so the identity check can't match a new object at the same address
+        self.data = data
+        self.version = version
+        self.html = html
+
+
+class FragmentCache:
+    def __init__(self, max_entries=4096, max_pages=64):
+        self.max_entries = max_entries
+        self.max_pages = max_pages
+        self._fragments = OrderedDict()
+        self._pages = OrderedDict()
+        self._versions = itertools.count(1)
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'page_hits': 0, 'pages_rendered': 0, 'not_modified': 0}
+
+    # The fragment of template_name for key showing data, rendered only when data is
+    # not the object it was last rendered from
+    def fragment(self, template_name, key, data):
+        cache_key = (template_name, key)
+        with self._lock:
+            entry = self._fragments.get(cache_key)
+            if entry is not None and entry.data is data:
+                self._fragments.move_to_end(cache_key)
+                self._stats['hits'] += 1
+                return entry
+
+        html = Markup(current_app.jinja_env.get_template(template_name).render(key=key, data=data))
+        entry = Fragment(data, next(self._versions), html)
+        with self._lock:
+            self._fragments[cache_key] = entry
+            self._fragments.move_to_end(cache_key)
+            while len(self._fragments) > self.max_entries:
+                self._fragments.popitem(last=False)
+            self._stats['misses'] += 1
+        return entry
+
+    # Response for a page made of fragments ({name: Fragment}, in page order). The page
+    # template gets them as `fragments`, {name: html}.
+    def page(self, template_name, fragments):
+        digest = hashlib.blake2b(template_name.encode(), digest_size=16)
+        for name, entry in fragments.items():
+            digest.update(f'\0{name}\0{entry.version}'.encode())
+        etag = digest.hexdigest()
+
+        if request.if_none_match.contains(etag):
+            with self._lock:
+                self._stats['not_modified'] += 1
+            response = make_response('', 304)
+        else:
+            with self._lock:
+                html = self._pages.get(etag)
+                if html is not None:
+                    self._pages.move_to_end(etag)
+                    self._stats['page_hits'] += 1
+            if html is None:
+                html = render_template(template_name,
+                                       fragments={name: entry.html for name, entry in fragments.items()})
+                with self._lock:
+                    self._pages[etag] = html
+                    while len(self._pages) > self.max_pages:
+                        self._pages.popitem(last=False)
+                    self._stats['pages_rendered'] += 1
+            response = make_response(html)
+        response.set_etag(etag)
+        # the browser asks every time, and gets a 304 while nothing has changed
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['fragments'] = len(self._fragments)
+            stats['pages'] = len(self._pages)
+        return stats
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+# Get the process wide fragment cache, created on first use from the app config
+def get_fragment_cache():
+    global _cache
+    if _cache is None:
+        with _cache_lock:
+            if _cache is None:
+                config = current_app.config
+                _cache = FragmentCache(
+                    max_entries=config.get('EBURY_FRAGMENT_CACHE_MAX_ENTRIES', 4096),
+                    max_pages=config.get('EBURY_PAGE_CACHE_MAX_ENTRIES', 64),
+                )
+    return _cache
+
+# Response for a page showing one fragment per item of {name: data}
+def render_fragments(template_name, fragment_template, items):
+    cache = get_fragment_cache()
+    return cache.page(template_name, {
+        name: cache.fragment(fragment_template, name, data) for name, data in items.items()
+    })
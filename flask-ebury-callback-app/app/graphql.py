@@ -0,0 +1,200 @@
+import logging
+import threading
+from functools import lru_cache
+from flask import current_app
+from .http_client import get_http_client
+from .async_runtime import request_json
+from .client_directory import client_headers
+
+logger = logging.getLogger(__name__)
+
+# GraphQL documents for the Ebury webhooks API and a small helper to run them.
+# The documents are built once and take their inputs as variables, nothing is
+# interpolated into the query text.
+
+SUBSCRIPTIONS_QUERY = """
+query Subscriptions($first: Int, $after: Cursor) {
+    subscriptions(first: $first, after: $after) {
+        totalCount
+        pageInfo {
+            hasNextPage
+            endCursor
+        }
+        nodes {
+            id
+            clientId
+            createdAt
+            url
+            active
+            types
+        }
+    }
+}
+"""
+
+SUBSCRIPTION_TYPES_QUERY = """
+{
+    __type(name: "WebhookType") {
+        name
+        enumValues {
+            name
+        }
+    }
+    webhookTypes
+}
+"""
+
+CREATE_SUBSCRIPTION_MUTATION = """
+mutation CreateSubscription($input: CreateSubscriptionInput!) {
+    createSubscription(input: $input) {
+        subscription {
+            id
+            url
+            types
+            active
+        }
+    }
+}
+"""
+
+UPDATE_SUBSCRIPTION_MUTATION = """
+mutation UpdateSubscription($input: UpdateSubscriptionInput!) {
+    updateSubscription(input: $input) {
+        subscription {
+            id
+            active
+        }
+    }
+}
+"""
+
+DELETE_SUBSCRIPTION_MUTATION = """
+mutation DeleteSubscription($input: DeleteSubscriptionInput!) {
+    deleteSubscription(input: $input) {
+        subscription {
+            id
+        }
+    }
+}
+"""
+
+# The subscription mutations as (field, input type, selection), used to put several
+# of them in one document, each under its own alias
+SUBSCRIPTION_MUTATIONS = {
+    'create': ('createSubscription', 'CreateSubscriptionInput', '{ subscription { id url types active } }'),
+    'enable': ('updateSubscription', 'UpdateSubscriptionInput', '{ subscription { id active } }'),
+    'disable': ('updateSubscription', 'UpdateSubscriptionInput', '{ subscription { id active } }'),
+    'delete': ('deleteSubscription', 'DeleteSubscriptionInput', '{ subscription { id } }'),
+}
+
+# A document running the operations in order, the n-th under the alias m<n> with its
+# input in the variable $m<n>. Only the names of the operations go into the text, so
+# the same list of operations always gives the same document and it is built once.
+@lru_cache(maxsize=256)
+def aliased_mutation(operations):
+    variables = []
+    fields = []
+    for n, operation in enumerate(operations):
+        field, input_type, selection = SUBSCRIPTION_MUTATIONS[operation]
+        variables.append(f"$m{n}: {input_type}!")
+        fields.append(f"    m{n}: {field}(input: $m{n}) {selection}")
+    return "mutation Bulk(" + ", ".join(variables) + ") {\n" + "\n".join(fields) + "\n}"
+
+
+# Queries can be retried, mutations can't
+def is_query(document):
+    return not document.lstrip().startswith('mutation')
+
+def _graphql_request(access_token, client_id, document, variables):
+    url = current_app.config['EBURY_API_URL'] + "webhooks/graphql?client_id=" + client_id
+    headers = client_headers(access_token, client_id)
+    body = {"query": document}
+    if variables:
+        body["variables"] = variables
+    return url, headers, body
+
+# Run a GraphQL document against webhooks/graphql for a client and return the response JSON.
+# The client goes in the X-Client-ID header and, as the mutations have always sent it, the
+# client_id query parameter.
+def execute(access_token, client_id, document, variables=None):
+    url, headers, body = _graphql_request(access_token, client_id, document, variables)
+    response = get_http_client().post(url, headers=headers, json=body, idempotent=is_query(document))
+    response.raise_for_status()
+    return response.json()
+
+# The same on the async runtime (see async_runtime.py)
+async def execute_async(access_token, client_id, document, variables=None):
+    url, headers, body = _graphql_request(access_token, client_id, document, variables)
+    return await request_json('POST', url, headers=headers, json=body, idempotent=is_query(document))
+
+# Add page number `page` of subscriptions, fetched with the cursor `after`, to nodes.
+# Returns (cursor of the next page, None), or (None, the result) when it was the last
+# page or has no subscriptions. Paging stops at max_pages, or when the API hands back
+# the cursor the page was fetched with, so a broken cursor can't loop forever.
+def _add_page(result, nodes, client_id, after, page, max_pages):
+    subscriptions = (result.get('data') or {}).get('subscriptions')
+    if subscriptions is None:
+        # errors, or a response without the subscriptions
+        return None, result
+    nodes.extend(subscriptions.get('nodes', []))
+    page_info = subscriptions.get('pageInfo') or {}
+    cursor = page_info.get('endCursor')
+    last = not page_info.get('hasNextPage') or not cursor
+    if not last and (cursor == after or page >= max_pages):
+        logger.warning("Stopped paging through subscriptions", extra={'fields': {
+            'client_id': client_id, 'pages': page, 'subscriptions': len(nodes), 'repeated_cursor': cursor == after}})
+        last = True
+    if last:
+        return None, {'data': {'subscriptions': {
+            'totalCount': subscriptions.get('totalCount', len(nodes)), 'nodes': nodes}}}
+    return cursor, None
+
+# Get every subscription of a client, following the cursor while there are more pages,
+# at most max_pages of them. Returns the same shape as a single unpaginated subscriptions query.
+def fetch_all_subscriptions(access_token, client_id, page_size=100, max_pages=100):
+    nodes = []
+    after = None
+    page = 0
+    while True:
+        page += 1
+        result = execute(access_token, client_id, SUBSCRIPTIONS_QUERY, {"first": page_size, "after": after})
+        after, done = _add_page(result, nodes, client_id, after, page, max_pages)
+        if done is not None:
+            return done
+
+async def fetch_all_subscriptions_async(access_token, client_id, page_size=100, max_pages=100):
+    nodes = []
+    after = None
+    page = 0
+    while True:
+        page += 1
+        result = await execute_async(access_token, client_id, SUBSCRIPTIONS_QUERY, {"first": page_size, "after": after})
+        after, done = _add_page(result, nodes, client_id, after, page, max_pages)
+        if done is not None:
+            return done
+
+
+# The WebhookType enum only changes with an Ebury release, it is fetched once per process
+_subscription_types = None
+_subscription_types_lock = threading.Lock()
+
+def fetch_subscription_types(access_token, client_id):
+    global _subscription_types
+    if _subscription_types is None:
+        with _subscription_types_lock:
+            if _subscription_types is None:
+                result = execute(access_token, client_id, SUBSCRIPTION_TYPES_QUERY)
+                if not result.get('errors'):
+                    _subscription_types = result
+                return result
+    return _subscription_types
+
+# On the event loop there is only ever one caller running at a time, no lock needed
+async def fetch_subscription_types_async(access_token, client_id):
+    global _subscription_types
+    if _subscription_types is None:
+        result = await execute_async(access_token, client_id, SUBSCRIPTION_TYPES_QUERY)
+        if not result.get('errors'):
+            _subscription_types = result
+        return result
+    return _subscription_types
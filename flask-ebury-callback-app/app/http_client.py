@@ -0,0 +1,163 @@
+import threading
+import time
+from http.cookiejar import DefaultCookiePolicy
+from urllib.parse import urlsplit
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.connectionpool import HTTPConnectionPool, HTTPSConnectionPool
+from flask import current_app
+from .metrics import upstream_requests
+from .resilience import UpstreamPolicy, get_upstream_policy
+
+# Shared HTTP client for every call made to the Ebury API.
+# All calls go through one pooled requests.Session, so connections to
+# sandbox.ebury.io and auth-sandbox.ebury.io are kept alive and reused instead of
+# paying for a new TCP connection and TLS handshake on every call.
+# Timeouts, retries and circuit breaking are up to the UpstreamPolicy (see resilience.py).
+
+
+class ConnectionStats:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._hosts = {}
+
+    def _host(self, host):
+        stats = self._hosts.get(host)
+        if stats is None:
+            stats = self._hosts.setdefault(host, {'requests': 0, 'new_connections': 0})
+        return stats
+
+    def record_request(self, host):
+        with self._lock:
+            self._host(host)['requests'] += 1
+
+    def record_new_connection(self, host):
+        with self._lock:
+            self._host(host)['new_connections'] += 1
+
+    # Counters per host, a request that didn't need a new connection reused a pooled one
+    def snapshot(self):
+        with self._lock:
+            hosts = {host: dict(stats) for host, stats in self._hosts.items()}
+        for stats in hosts.values():
+            stats['reused_connections'] = max(0, stats['requests'] - stats['new_connections'])
+        totals = {
+            key: sum(stats[key] for stats in hosts.values())
+            for key in ('requests', 'new_connections', 'reused_connections')
+        }
+        return {'hosts': hosts, **totals}
+
+
+# The endpoint a call is counted under in /metrics, the path without ids,
+# e.g. 'balances', 'webhooks/graphql' or 'webhooks/ping'
+def endpoint_name(url):
+    path = urlsplit(url).path.strip('/')
+    if path.startswith('webhooks/ping/'):
+        return 'webhooks/ping'
+    return path or '/'
+
+# Time a call to the Ebury API for /metrics, by endpoint and status
+def observe_upstream(url, start, status):
+    upstream_requests.observe(time.perf_counter() - start, (endpoint_name(url), status))
+
+
+# Connection pool classes that report to a ConnectionStats object
+def _counting_pool_class(base, stats):
+    class CountingConnectionPool(base):
+        def _new_conn(self):
+            stats.record_new_connection(self.host)
+            return super()._new_conn()
+
+        def urlopen(self, *args, **kwargs):
+            stats.record_request(self.host)
+            return super().urlopen(*args, **kwargs)
+
+    return CountingConnectionPool
+
+
+class CountingHTTPAdapter(HTTPAdapter):
+    def __init__(self, stats, **kwargs):
+        # must be set before HTTPAdapter.__init__ as that builds the pool manager
+        self.stats = stats
+        super().__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        super().init_poolmanager(*args, **kwargs)
+        self.poolmanager.pool_classes_by_scheme = {
+            'http': _counting_pool_class(HTTPConnectionPool, self.stats),
+            'https': _counting_pool_class(HTTPSConnectionPool, self.stats),
+        }
+
+
+class EburyHttpClient:
+    def __init__(self, pool_size=16, max_hosts=10, connect_timeout=5, read_timeout=30, policy=None):
+        self.stats = ConnectionStats()
+        self.policy = policy or UpstreamPolicy(connect_timeout=connect_timeout, read_timeout=read_timeout)
+
+        self.session = requests.Session()
+        # The API is stateless, don't let one call's cookies leak into another
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        self.session.headers.update({
+            'Accept-Encoding': 'gzip',
+            'Connection': 'keep-alive',
+        })
+
+        # pool_maxsize is the number of connections kept alive per host, it should be
+        # at least EBURY_MAX_CONCURRENCY so concurrent fetches don't open extra connections
+        adapter = CountingHTTPAdapter(self.stats, pool_connections=max_hosts, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    # idempotent says whether the call can be retried, by default only GETs are
+    def request(self, method, url, idempotent=None, **kwargs):
+        call = self.policy.start(method, url, endpoint_name(url), idempotent)
+        while True:
+            kwargs['timeout'] = call.before_attempt()
+            start = time.perf_counter()
+            try:
+                try:
+                    response = self.session.request(method, url, **kwargs)
+                except requests.RequestException as e:
+                    observe_upstream(url, start, type(e).__name__)
+                    delay = call.after_attempt(error=e)
+                    if delay is None:
+                        raise
+                    time.sleep(delay)
+                    continue
+                # for a streamed response this is the time until the headers arrived
+                observe_upstream(url, start, response.status_code)
+                delay = call.after_attempt(status=response.status_code)
+            finally:
+                call.end_attempt()
+            if delay is None:
+                return response
+            response.close()
+            time.sleep(delay)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def close(self):
+        self.session.close()
+
+
+_client = None
+_client_lock = threading.Lock()
+
+# Get the process wide client, it is created on first use from the app config
+def get_http_client():
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                config = current_app.config
+                _client = EburyHttpClient(
+                    pool_size=config.get('EBURY_HTTP_POOL_SIZE', 16),
+                    connect_timeout=config.get('EBURY_HTTP_CONNECT_TIMEOUT', 5),
+                    read_timeout=config.get('EBURY_HTTP_READ_TIMEOUT', 30),
+                    policy=get_upstream_policy(),
+                )
+    return _client
@@ -0,0 +1,124 @@
+import json
+import re
+
+# Reading and looking into webhook bodies on /callback without copying or parsing them.
+# The raw bytes are what gets verified, stored and pushed to the callbacks page, the
+# only fields taken out of them are the few needed to route the webhook, found by one
+# scan over the top level of the JSON object that stops once it has them.
+
+
+class BodyTooLarge(Exception):
+    pass
+
+
+# Read a request body of at most `limit` bytes from the WSGI input, raises BodyTooLarge
+# as soon as it is known to be bigger, before reading the rest of it
+def read_body(stream, content_length, limit, chunk_size=64 * 1024):
+    if content_length is not None:
+        if content_length > limit:
+            raise BodyTooLarge(f"Body of {content_length} bytes is over the limit of {limit}")
+        # read in one go so the body is only held once
+        return stream.read(content_length)
+    chunks = []
+    size = 0
+    while True:
+        chunk = stream.read(min(chunk_size, limit + 1 - size))
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > limit:
+            raise BodyTooLarge(f"Body is over the limit of {limit} bytes")
+        chunks.append(chunk)
+    if len(chunks) == 1:
+        return chunks[0]
+    return b''.join(chunks)
+
+
+# The next quote or bracket, strings are then skipped with bytes.find which is much
+# faster over a long string than a regular expression
+_STRUCTURE = re.compile(rb'["{}\[\]]')
+_COLON = re.compile(rb'\s*:\s*')
+_SCALAR = re.compile(rb'-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?|true|false|null')
+# keys longer than this are not looked at
+MAX_KEY = 64
+
+# The end of the JSON string starting at `start`, -1 if it doesn't end
+def _string_end(raw, start):
+    i = start + 1
+    while True:
+        i = raw.find(b'"', i)
+        if i < 0:
+            return -1
+        # a quote after an odd number of backslashes is part of the string
+        j = i - 1
+        while raw[j] == 0x5c:
+            j -= 1
+        if (i - 1 - j) % 2 == 0:
+            return i + 1
+        i += 1
+
+# The values of the named top level fields of a JSON object body, for the ones that
+# are strings, numbers, booleans or null. Missing fields, ones whose value isn't valid
+# JSON (e.g. a bad escape) and a body that isn't a JSON object are left out.
+def scan_fields(raw, names):
+    wanted = {name.encode(): name for name in names}
+    found = {}
+    depth = 0
+    pos = 0
+    while True:
+        match = _STRUCTURE.search(raw, pos)
+        if match is None:
+            break
+        start = match.start()
+        first = raw[start]
+        if first == 0x7b or first == 0x5b:  # { [
+            depth += 1
+            pos = start + 1
+            continue
+        if first == 0x7d or first == 0x5d:  # } ]
+            depth -= 1
+            if depth <= 0:
+                break
+            pos = start + 1
+            continue
+        end = _string_end(raw, start)
+        if end < 0:
+            break
+        pos = end
+        if depth != 1 or end - start > MAX_KEY + 2:
+            continue
+        colon = _COLON.match(raw, end)
+        if colon is None:
+            # a value, not a key
+            continue
+        name = wanted.get(raw[start + 1:end - 1])
+        if name is None or name in found:
+            continue
+        at = colon.end()
+        if raw[at:at + 1] == b'"':
+            value_end = _string_end(raw, at)
+            if value_end < 0:
+                break
+            pos = value_end
+            try:
+                found[name] = json.loads(raw[at:value_end])
+            except ValueError:
+                continue
+        else:
+            value = _SCALAR.match(raw, at)
+            if value is None:
+                continue
+            try:
+                found[name] = json.loads(value.group())
+            except ValueError:
+                continue
+        if len(found) == len(wanted):
+            break
+    return found
+
+
+# The fields a webhook is routed by
+ROUTING_FIELDS = ('id', 'type', 'client_id')
+
+def routing_fields(raw):
+    return scan_fields(raw, ROUTING_FIELDS)
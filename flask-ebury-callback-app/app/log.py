@@ -0,0 +1,122 @@
+import copy
+import json
+import logging
+import queue
+import random
+import sys
+import time
+from logging.handlers import QueueHandler, QueueListener
+from .metrics import log_records_dropped
+
+# Logging for the app, replacing the prints on the request and webhook paths.
+# Records are put on a bounded queue and written as one JSON object per line by a
+# listener thread, so a slow stdout never holds up a request thread. When the queue
+# is full records are dropped (and counted in /metrics) rather than waited for.
+# Records logged with extra={'sample': True} (e.g. whole webhook payloads) are only
+# kept for a share of EBURY_LOG_PAYLOAD_SAMPLE_RATE of them.
+#
+# Modules log with logging.getLogger(__name__), which are children of the 'app' logger.
+
+LOGGER_NAME = 'app'
+
+
+# Raw webhook bodies are logged as the text they came as
+def _json_default(value):
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return bytes(value).decode('utf-8', 'replace')
+    return str(value)
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        fields = getattr(record, 'fields', None)
+        if fields:
+            entry.update(fields)
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry['exception'] = record.exc_text
+        return json.dumps(entry, default=_json_default)
+
+
+_exception_formatter = logging.Formatter()
+
+
+class SampleFilter(logging.Filter):
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+
+    def filter(self, record):
+        if getattr(record, 'sample', False):
+            return self.rate >= 1 or random.random() < self.rate
+        return True
+
+
+class DroppingQueueHandler(QueueHandler):
+    # put_nowait instead of waiting for room. Like QueueHandler.prepare the message is
+    # merged with its args and the exception rendered to text before the record is
+    # queued, as the objects they refer to may have changed (or hold a traceback's
+    # frames alive) by the time the listener gets to it. The JSON is still written by
+    # the listener.
+    def prepare(self, record):
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = _exception_formatter.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            log_records_dropped.inc()
+
+
+_listener = None
+_config = None
+
+# Set up the 'app' logger from the config, called once by create_app
+def configure_logging(config):
+    global _listener, _config
+    logger = logging.getLogger(LOGGER_NAME)
+    if _listener is not None:
+        return logger
+    _config = config
+
+    records = queue.Queue(maxsize=config.get('EBURY_LOG_QUEUE_SIZE', 10000))
+    handler = DroppingQueueHandler(records)
+    handler.addFilter(SampleFilter(config.get('EBURY_LOG_PAYLOAD_SAMPLE_RATE', 0.01)))
+
+    output = logging.StreamHandler(sys.stdout)
+    output.setFormatter(JsonFormatter())
+    _listener = QueueListener(records, output, respect_handler_level=True)
+    _listener.start()
+
+    logger.handlers[:] = [handler]
+    logger.setLevel(config.get('EBURY_LOG_LEVEL', 'INFO'))
+    logger.propagate = False
+    return logger
+
+# Write out the records still on the queue, e.g. at exit
+def stop_logging():
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+# A forked worker has no listener thread, and the queue's lock may have been held by
+# it at the fork, so it gets a new queue and listener
+def restart_logging_after_fork():
+    global _listener
+    if _listener is not None:
+        _listener = None
+        configure_logging(_config)
@@ -0,0 +1,330 @@
+import fcntl
+import json
+import logging
+import os
+import selectors
+import socket
+import struct
+import threading
+import time
+from flask import current_app
+
+logger = logging.getLogger(__name__)
+
+# Carries the callbacks pushed to the 'callbacks' page between the processes serving it,
+# so a webhook that arrives on one gunicorn worker reaches the browsers connected to the
+# others. Each broadcaster (see broadcaster.py) publishes the events that arrived on its
+# own worker, one message per batch, and gets the events of the other workers to push to
+# its own browsers.
+#
+# Backends, picked with EBURY_MESSAGE_BUS:
+# - "local": no other processes, for a single worker
+# - "unix": a broker on the Unix socket EBURY_MESSAGE_BUS_PATH, for the workers on one
+#   machine. The first worker to find no broker starts one on a thread (one worker at a
+#   time, under a file lock), the others connect to it. When that worker goes away the
+#   others start a new one and reconnect, what was sent in between is lost (the page
+#   gets it again from the event store when it reconnects).
+#
+# A message is a batch of events. The webhook bodies are sent as the bytes they came as,
+# next to the rest of the event as JSON:
+#   count, then per event: JSON length, JSON, body length (or NO_BODY), body
+
+_LENGTH = struct.Struct('>I')
+NO_BODY = 0xFFFFFFFF
+
+
+def encode_events(events):
+    parts = [_LENGTH.pack(len(events))]
+    for event in events:
+        body = event.get('body')
+        fields = json.dumps({name: value for name, value in event.items() if name != 'body'}).encode()
+        parts.append(_LENGTH.pack(len(fields)))
+        parts.append(fields)
+        if body is None:
+            parts.append(_LENGTH.pack(NO_BODY))
+        else:
+            parts.append(_LENGTH.pack(len(body)))
+            parts.append(body)
+    return b''.join(parts)
+
+
+def decode_events(data):
+    view = memoryview(data)
+    count, = _LENGTH.unpack_from(view, 0)
+    pos = 4
+    events = []
+    for _ in range(count):
+        size, = _LENGTH.unpack_from(view, pos)
+        event = json.loads(view[pos + 4:pos + 4 + size].tobytes())
+        pos += 4 + size
+        size, = _LENGTH.unpack_from(view, pos)
+        pos += 4
+        if size == NO_BODY:
+            event['body'] = None
+        else:
+            event['body'] = view[pos:pos + size].tobytes()
+            pos += size
+        events.append(event)
+    return events
+
+
+class LocalBus:
+    def __init__(self):
+        self.stats = {'published': 0, 'messages_sent': 0, 'received': 0, 'messages_received': 0}
+
+    def subscribe(self, handler):
+        pass
+
+    # Nobody else to tell
+    def publish(self, events):
+        pass
+
+    def snapshot(self):
+        return dict(self.stats, backend='local')
+
+
+# Reads and writes length prefixed messages on a stream socket
+def _send_message(sock, data):
+    sock.sendall(_LENGTH.pack(len(data)) + data)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(min(size, 1024 * 1024))
+        if not chunk:
+            raise ConnectionError("Bus connection closed")
+        chunks.append(chunk)
+        size -= len(chunk)
+    return b''.join(chunks)
+
+
+class UnixSocketBroker:
+    # Forwards every message to every other connection. A connection whose unsent
+    # messages go over max_buffer bytes is dropped rather than holding up the others.
+
+    def __init__(self, listener, max_buffer=64 * 1024 * 1024):
+        self.listener = listener
+        self.max_buffer = max_buffer
+        self._selector = selectors.DefaultSelector()
+        self._selector.register(listener, selectors.EVENT_READ, None)
+        # per connection: [bytes read, bytes to send]
+        self._connections = {}
+        self.stats = {'connections': 0, 'messages': 0, 'dropped_connections': 0}
+
+    def serve_forever(self):
+        while True:
+            for key, mask in self._selector.select():
+                if key.data is None:
+                    self._accept()
+                    continue
+                # it may have been dropped while forwarding an earlier message
+                if key.fileobj not in self._connections:
+                    continue
+                if mask & selectors.EVENT_READ:
+                    self._read(key.fileobj)
+                if mask & selectors.EVENT_WRITE and key.fileobj in self._connections:
+                    self._write(key.fileobj)
+
+    def _accept(self):
+        conn, _ = self.listener.accept()
+        conn.setblocking(False)
+        self._connections[conn] = [bytearray(), bytearray()]
+        self._selector.register(conn, selectors.EVENT_READ, True)
+        self.stats['connections'] += 1
+
+    def _close(self, conn):
+        self._selector.unregister(conn)
+        del self._connections[conn]
+        conn.close()
+
+    def _read(self, conn):
+        try:
+            data = conn.recv(1024 * 1024)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self._close(conn)
+            return
+        incoming = self._connections[conn][0]
+        incoming += data
+        # forward each whole message as it came
+        while len(incoming) >= 4:
+            size, = _LENGTH.unpack_from(incoming, 0)
+            if len(incoming) < 4 + size:
+                break
+            message = bytes(incoming[:4 + size])
+            del incoming[:4 + size]
+            self.stats['messages'] += 1
+            for other in list(self._connections):
+                if other is not conn:
+                    self._queue(other, message)
+
+    def _queue(self, conn, message):
+        outgoing = self._connections[conn][1]
+        if len(outgoing) + len(message) > self.max_buffer:
+            logger.warning("Dropping a message bus connection that fell behind")
+            self.stats['dropped_connections'] += 1
+            self._close(conn)
+            return
+        if not outgoing:
+            self._selector.modify(conn, selectors.EVENT_READ | selectors.EVENT_WRITE, True)
+        outgoing += message
+
+    def _write(self, conn):
+        outgoing = self._connections[conn][1]
+        try:
+            sent = conn.send(outgoing)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            self._close(conn)
+            return
+        del outgoing[:sent]
+        if not outgoing:
+            self._selector.modify(conn, selectors.EVENT_READ, True)
+
+
+class UnixSocketBus:
+    def __init__(self, path, reconnect_interval=0.5):
+        self.path = path
+        self.reconnect_interval = reconnect_interval
+        self._handlers = []
+        self._sock = None
+        self._send_lock = threading.Lock()
+        self._connected = threading.Event()
+        self._thread = None
+        self._broker = None
+        self._start_lock = threading.Lock()
+        self.stats = {'published': 0, 'messages_sent': 0, 'received': 0, 'messages_received': 0,
+                      'send_failures': 0, 'connects': 0}
+
+    def subscribe(self, handler):
+        self._handlers.append(handler)
+        self.start()
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._receive_loop, name='message-bus', daemon=True)
+                self._thread.start()
+        # the first messages are not lost while the connection is being made
+        self._connected.wait(2)
+
+    # Send a batch of events to the other processes, as one message. Never raises, the
+    # events are only lost for the other processes while there is no broker.
+    def publish(self, events):
+        if not events:
+            return
+        if self._thread is None:
+            self.start()
+        message = encode_events(events)
+        with self._send_lock:
+            sock = self._sock
+            try:
+                if sock is None:
+                    raise ConnectionError("Not connected to the message bus")
+                _send_message(sock, message)
+            except OSError:
+                self.stats['send_failures'] += 1
+                return
+            self.stats['published'] += len(events)
+            self.stats['messages_sent'] += 1
+
+    def _connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            sock.connect(self.path)
+        except OSError:
+            sock.close()
+            self._start_broker()
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+        return sock
+
+    # Start a broker on a thread of this process, unless another process has one
+    def _start_broker(self):
+        with open(self.path + '.lock', 'a') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    probe.connect(self.path)
+                    return
+                except OSError:
+                    pass
+                finally:
+                    probe.close()
+                # nobody is listening, the socket file is left from a broker that went away
+                if os.path.exists(self.path):
+                    os.unlink(self.path)
+                listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                listener.bind(self.path)
+                os.chmod(self.path, 0o600)
+                listener.listen(128)
+                self._broker = UnixSocketBroker(listener)
+                threading.Thread(target=self._broker.serve_forever, name='message-bus-broker', daemon=True).start()
+                logger.info("Started the message bus broker", extra={'fields': {'path': self.path}})
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _receive_loop(self):
+        while True:
+            try:
+                sock = self._connect()
+            except OSError as e:
+                logger.warning("Can't connect to the message bus", extra={'fields': {'error': repr(e)}})
+                time.sleep(self.reconnect_interval)
+                continue
+            with self._send_lock:
+                self._sock = sock
+                self.stats['connects'] += 1
+            self._connected.set()
+            try:
+                while True:
+                    size, = _LENGTH.unpack(_recv_exactly(sock, 4))
+                    events = decode_events(_recv_exactly(sock, size))
+                    self.stats['received'] += len(events)
+                    self.stats['messages_received'] += 1
+                    for handler in self._handlers:
+                        try:
+                            handler(events)
+                        except Exception:
+                            logger.exception("Message bus handler failed")
+            except (OSError, ValueError) as e:
+                logger.warning("Lost the message bus connection", extra={'fields': {'error': repr(e)}})
+            with self._send_lock:
+                self._sock = None
+            self._connected.clear()
+            sock.close()
+            time.sleep(self.reconnect_interval)
+
+    def snapshot(self):
+        stats = dict(self.stats, backend='unix', connected=self._connected.is_set())
+        if self._broker is not None:
+            stats['broker'] = dict(self._broker.stats, clients=len(self._broker._connections))
+        return stats
+
+
+def create_message_bus(config):
+    backend = config.get('EBURY_MESSAGE_BUS', 'local')
+    if backend == 'local':
+        return LocalBus()
+    if backend == 'unix':
+        return UnixSocketBus(config.get('EBURY_MESSAGE_BUS_PATH', 'ebury-bus.sock'))
+    raise ValueError(f"Unknown EBURY_MESSAGE_BUS: {backend}")
+
+
+_bus = None
+_bus_lock = threading.Lock()
+
+# Get the process wide message bus, created on first use from the app config
+def get_message_bus():
+    global _bus
+    if _bus is None:
+        with _bus_lock:
+            if _bus is None:
+                _bus = create_message_bus(current_app.config)
+    return _bus
@@ -0,0 +1,217 @@
+import bisect
+import threading
+import time
+
+# Counters and histograms for the /metrics endpoint, in the Prometheus text format.
+# They are updated on the request and webhook hot paths, so each metric is split in
+# STRIPES parts with a lock each and a thread only ever updates the part picked by
+# its (sequential, OS) thread id. Threads rarely wait on each other, and the parts are only added
+# up when /metrics is read.
+
+STRIPES = 16
+
+# Seconds, from a fast local call to a slow upstream one
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class _Stripe:
+    __slots__ = ('lock', 'values')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.values = {}
+
+
+class _StripedMetric:
+    type = None
+
+    def __init__(self, name, help, labelnames=()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+        self._stripes = [_Stripe() for _ in range(STRIPES)]
+
+    def _stripe(self):
+        return self._stripes[threading.get_native_id() % STRIPES]
+
+    def _labels(self, labels):
+        return ','.join(f'{name}="{_escape(value)}"' for name, value in zip(self.labelnames, labels))
+
+    # In a forked worker the values are kept, a lock may have been held by another thread
+    def after_fork(self):
+        for stripe in self._stripes:
+            stripe.lock = threading.Lock()
+
+
+class Counter(_StripedMetric):
+    type = 'counter'
+
+    # labels are the values for labelnames, in the same order
+    def inc(self, labels=(), amount=1):
+        stripe = self._stripe()
+        with stripe.lock:
+            stripe.values[labels] = stripe.values.get(labels, 0) + amount
+
+    def collect(self):
+        totals = {}
+        for stripe in self._stripes:
+            with stripe.lock:
+                for labels, value in stripe.values.items():
+                    totals[labels] = totals.get(labels, 0) + value
+        return totals
+
+    def render(self):
+        for labels, value in sorted(self.collect().items()):
+            label_text = self._labels(labels)
+            yield f'{self.name}{{{label_text}}} {value}' if label_text else f'{self.name} {value}'
+
+
+class Histogram(_StripedMetric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = bisect.bisect_left(self.buckets, value)
+        stripe = self._stripe()
+        with stripe.lock:
+            # per bucket counts (the last one is +Inf), then the sum
+            counts = stripe.values.get(labels)
+            if counts is None:
+                counts = stripe.values[labels] = [0] * (len(self.buckets) + 1) + [0.0]
+            counts[index] += 1
+            counts[-1] += value
+
+    def collect(self):
+        totals = {}
+        for stripe in self._stripes:
+            with stripe.lock:
+                for labels, counts in stripe.values.items():
+                    total = totals.get(labels)
+                    if total is None:
+                        totals[labels] = list(counts)
+                    else:
+                        for i, count in enumerate(counts):
+                            total[i] += count
+        return totals
+
+    def render(self):
+        for labels, counts in sorted(self.collect().items()):
+            label_text = self._labels(labels)
+            prefix = label_text + ',' if label_text else ''
+            cumulative = 0
+            for bound, count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += count
+                yield f'{self.name}_bucket{{{prefix}le="{bound}"}} {cumulative}'
+            braces = f'{{{label_text}}}' if label_text else ''
+            yield f'{self.name}_sum{braces} {counts[-1]}'
+            yield f'{self.name}_count{braces} {cumulative}'
+
+    # Time a block, e.g. with histogram.time(('balances',)): ...
+    def time(self, labels=()):
+        return _Timer(self, labels)
+
+
+class _Timer:
+    __slots__ = ('histogram', 'labels', 'start')
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.histogram.observe(time.perf_counter() - self.start, self.labels)
+
+
+# A value read when /metrics is scraped, e.g. the depth of the webhook queue
+class Gauge:
+    type = 'gauge'
+
+    def __init__(self, name, help, read):
+        self.name = name
+        self.help = help
+        self.read = read
+
+    def render(self):
+        try:
+            value = self.read()
+        except Exception:
+            return
+        if value is not None:
+            yield f'{self.name} {value}'
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def register(self, metric):
+        with self._lock:
+            self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.register(Counter(name, help, labelnames))
+
+    def histogram(self, name, help, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, help, labelnames, buckets))
+
+    def gauge(self, name, help, read):
+        return self.register(Gauge(name, help, read))
+
+    def after_fork(self):
+        self._lock = threading.Lock()
+        for metric in self._metrics.values():
+            if isinstance(metric, _StripedMetric):
+                metric.after_fork()
+
+    # Every metric in the Prometheus text exposition format
+    def render(self):
+        with self._lock:
+            metrics = list(self._metrics.values())
+        lines = []
+        for metric in metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.type}')
+            lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+# Calls to the Ebury API and auth server, by endpoint and response status
+# (or the exception name when there was no response)
+upstream_requests = registry.histogram(
+    'ebury_upstream_request_seconds', 'Time taken by calls to the Ebury API', ('endpoint', 'status'))
+
+# Webhooks
+callback_ack = registry.histogram(
+    'ebury_callback_ack_seconds', 'Time taken to acknowledge a webhook on /callback', ('result',))
+webhook_verify = registry.histogram(
+    'ebury_webhook_verify_seconds', 'Time taken to verify the signature of a webhook', ('valid',))
+webhook_emit = registry.histogram(
+    'ebury_webhook_emit_seconds', 'Time taken to push a batch of callbacks to a room of browsers')
+webhooks_processed = registry.counter(
+    'ebury_webhooks_processed_total', 'Webhooks processed by the webhook queue workers', ('result',))
+
+# Token
+token_refreshes = registry.counter(
+    'ebury_token_refreshes_total', 'Renewals of the access token', ('mode', 'result'))
+token_lock_wait = registry.histogram(
+    'ebury_token_refresh_lock_wait_seconds', 'Time waited for the token refresh lock', ('mode',))
+
+# Logging
+log_records_dropped = registry.counter(
+    'ebury_log_records_dropped_total', 'Log records dropped because the log queue was full')
+
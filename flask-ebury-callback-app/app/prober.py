@@ -0,0 +1,264 @@
+import logging
+import threading
+import time
+from array import array
+from flask import current_app
+from . import ebury_api
+from .concurrency import fetch_all
+from .metrics import registry
+
+logger = logging.getLogger(__name__)
+
+# Health checks of the webhook subscriptions. Every EBURY_PROBE_INTERVAL seconds every
+# active subscription is pinged (at most EBURY_PROBE_CONCURRENCY at a time) and the time
+# the ping call took is kept. Ebury answers a ping by delivering a PING webhook to the
+# subscription's url, when that arrives on /callback the time from sending the ping to
+# receiving the webhook is kept too, so the health shows how long Ebury takes to deliver.
+# A ping whose webhook hasn't arrived after EBURY_PROBE_DELIVERY_TIMEOUT seconds counts
+# as a missed delivery.
+#
+# The last EBURY_PROBE_HISTORY times of each kind are kept per subscription.
+# Pings are matched to their webhook within a process, with several workers a PING
+# webhook that lands on another worker than the one that pinged counts as missed.
+
+ping_seconds = registry.histogram(
+    'ebury_webhook_ping_seconds', 'Time taken by the Ebury API to answer a health check ping', ('result',))
+ping_delivery_seconds = registry.histogram(
+    'ebury_webhook_ping_delivery_seconds', 'Time from a health check ping to its PING webhook arriving on /callback')
+
+
+class LatencyRing:
+    # The last `size` latencies in seconds, as 4 byte floats
+    __slots__ = ('_values', '_next', 'count')
+
+    def __init__(self, size):
+        self._values = array('f', bytes(4 * size))
+        self._next = 0
+        self.count = 0
+
+    def add(self, seconds):
+        self._values[self._next] = seconds
+        self._next = (self._next + 1) % len(self._values)
+        self.count += 1
+
+    def percentiles_ms(self):
+        values = sorted(self._values[:min(self.count, len(self._values))])
+        if not values:
+            return None
+        return {
+            'p50': round(values[len(values) // 2] * 1000, 3),
+            'p99': round(values[min(len(values) - 1, int(len(values) * 0.99))] * 1000, 3),
+            'samples': len(values),
+        }
+
+
+class SubscriptionHealth:
+    __slots__ = ('client_id', 'subscription_id', 'url', 'round_trip', 'delivery', 'pings', 'failures',
+                 'missed_deliveries', 'last_ok_at', 'last_failure_at', 'last_failure')
+
+    def __init__(self, client_id, subscription_id, url, history):
+        self.client_id = client_id
+        self.subscription_id = subscription_id
+        self.url = url
+        self.round_trip = LatencyRing(history)
+        self.delivery = LatencyRing(history)
+        self.pings = 0
+        self.failures = 0
+        self.missed_deliveries = 0
+        self.last_ok_at = None
+        self.last_failure_at = None
+        self.last_failure = None
+
+    def failed(self, error):
+        self.failures += 1
+        self.last_failure_at = time.time()
+        self.last_failure = error
+
+    def snapshot(self):
+        return {
+            'client_id': self.client_id,
+            'subscription_id': self.subscription_id,
+            'url': self.url,
+            'pings': self.pings,
+            'failures': self.failures,
+            'missed_deliveries': self.missed_deliveries,
+            'round_trip_ms': self.round_trip.percentiles_ms(),
+            'delivery_ms': self.delivery.percentiles_ms(),
+            'last_ok_at': self.last_ok_at,
+            'last_failure_at': self.last_failure_at,
+            'last_failure': self.last_failure,
+        }
+
+
+# The active subscriptions of every client, as (client_id, subscription_id, url)
+def active_subscriptions():
+    subscriptions = []
+    for client_id, result in ebury_api.get_webhook_subscriptions().items():
+        nodes = ((result.get('data') or {}).get('subscriptions') or {}).get('nodes') or []
+        for node in nodes:
+            if node.get('active') and node.get('id'):
+                subscriptions.append((client_id, node['id'], node.get('url')))
+    return subscriptions
+
+
+class WebhookProber:
+    def __init__(self, interval=300, concurrency=8, history=128, delivery_timeout=30):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.history = history
+        self.delivery_timeout = delivery_timeout
+        # subscription id -> SubscriptionHealth, and -> time.monotonic() of the ping
+        # still waiting for its webhook, guarded by _lock
+        self._health = {}
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._app = None
+        self.rounds = 0
+        self.last_round_at = None
+        self.last_round_seconds = None
+
+    def start(self, app):
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._app = app
+            self._thread = threading.Thread(target=self._probe_loop, name='webhook-prober', daemon=True)
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _probe_loop(self):
+        with self._app.app_context():
+            while not self._stop.is_set():
+                started = time.monotonic()
+                try:
+                    self.run_once()
+                except Exception as e:
+                    logger.warning("Webhook health check round failed", extra={'fields': {'error': repr(e)}})
+                self._stop.wait(max(0, self.interval - (time.monotonic() - started)))
+
+    # Ping every active subscription once, returns the number pinged
+    def run_once(self):
+        started = time.monotonic()
+        subscriptions = active_subscriptions()
+        with self._lock:
+            self._expire_pending(started)
+            # forget the subscriptions that are gone or no longer active
+            active = {subscription_id for _, subscription_id, _ in subscriptions}
+            for subscription_id in list(self._health):
+                if subscription_id not in active:
+                    del self._health[subscription_id]
+                    self._pending.pop(subscription_id, None)
+            for client_id, subscription_id, url in subscriptions:
+                if subscription_id not in self._health:
+                    self._health[subscription_id] = SubscriptionHealth(client_id, subscription_id, url, self.history)
+
+        fetch_all(self.ping, subscriptions, max_workers=self.concurrency)
+        self.rounds += 1
+        self.last_round_at = time.time()
+        self.last_round_seconds = round(time.monotonic() - started, 3)
+        return len(subscriptions)
+
+    def ping(self, subscription):
+        client_id, subscription_id, _ = subscription
+        health = self._health.get(subscription_id)
+        if health is None:
+            return
+        sent = time.monotonic()
+        with self._lock:
+            # the previous ping's webhook never came
+            if self._pending.pop(subscription_id, None) is not None:
+                self._missed(health)
+            self._pending[subscription_id] = sent
+        try:
+            result = ebury_api.ping_subscription(client_id, subscription_id)
+            error = None if result.get('status') == 'success' else result.get('message')
+        except Exception as e:
+            error = str(e)
+        elapsed = time.monotonic() - sent
+
+        ping_seconds.observe(elapsed, ('failed' if error else 'ok',))
+        with self._lock:
+            health.pings += 1
+            if error:
+                # no webhook is coming for a failed ping
+                if self._pending.get(subscription_id) == sent:
+                    del self._pending[subscription_id]
+                health.failed(error)
+            else:
+                health.round_trip.add(elapsed)
+                health.last_ok_at = time.time()
+
+    # A PING webhook for the subscription arrived on /callback at received_at (time.monotonic()),
+    # returns False when it wasn't for one of our pings
+    def delivered(self, subscription_id, received_at):
+        with self._lock:
+            sent = self._pending.pop(subscription_id, None)
+            health = self._health.get(subscription_id)
+            if sent is None or health is None:
+                return False
+            latency = max(0.0, received_at - sent)
+            health.delivery.add(latency)
+        ping_delivery_seconds.observe(latency)
+        return True
+
+    def _missed(self, health):
+        health.missed_deliveries += 1
+        health.failed(f"No PING webhook within {self.delivery_timeout}s of the ping")
+
+    def _expire_pending(self, now):
+        for subscription_id, sent in list(self._pending.items()):
+            if now - sent > self.delivery_timeout:
+                del self._pending[subscription_id]
+                health = self._health.get(subscription_id)
+                if health is not None:
+                    self._missed(health)
+
+    def snapshot(self):
+        with self._lock:
+            self._expire_pending(time.monotonic())
+            subscriptions = [health.snapshot() for health in self._health.values()]
+            waiting = len(self._pending)
+        return {
+            'running': self._thread is not None and not self._stop.is_set(),
+            'interval': self.interval,
+            'rounds': self.rounds,
+            'last_round_at': self.last_round_at,
+            'last_round_seconds': self.last_round_seconds,
+            'awaiting_delivery': waiting,
+            'subscriptions': subscriptions,
+        }
+
+
+_prober = None
+_prober_lock = threading.Lock()
+
+# Get the process wide prober, created on first use from the app config
+def get_webhook_prober():
+    global _prober
+    if _prober is None:
+        with _prober_lock:
+            if _prober is None:
+                config = current_app.config
+                _prober = WebhookProber(
+                    interval=config.get('EBURY_PROBE_INTERVAL', 300),
+                    concurrency=config.get('EBURY_PROBE_CONCURRENCY', 8),
+                    history=config.get('EBURY_PROBE_HISTORY', 128),
+                    delivery_timeout=config.get('EBURY_PROBE_DELIVERY_TIMEOUT', 30),
+                )
+    return _prober
+
+# Start the health checks when EBURY_PROBE_ENABLED is set, called by create_app
+def start_webhook_prober(app):
+    if app.config.get('EBURY_PROBE_ENABLED'):
+        with app.app_context():
+            get_webhook_prober().start(app)
+
+# Called by the webhook processing for every verified PING webhook
+def record_ping_delivery(subscription_id, received_at):
+    prober = _prober
+    if prober is not None and subscription_id:
+        prober.delivered(subscription_id, received_at)
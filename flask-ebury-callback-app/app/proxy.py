@@ -0,0 +1,119 @@
+import hashlib
+import threading
+from concurrent.futures import Future
+from flask import Response, current_app, request, stream_with_context
+from .http_client import get_http_client
+
+# Reverse proxy for Ebury's GraphiQL page (webhooks/) and the queries it makes
+# (webhooks/graphql), so the page can be used with our login.
+# Bodies are streamed in chunks in both directions through the pooled HTTP client,
+# so memory per request stays the same whatever the size of the response.
+# Responses are passed through still compressed, as they came from Ebury.
+
+CHUNK_SIZE = 64 * 1024
+# request bodies up to this size are read in one go, larger ones are streamed
+MAX_BUFFERED_BODY = 64 * 1024
+
+# Headers that only apply to a single connection and must not be forwarded
+HOP_BY_HOP_HEADERS = {
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade',
+}
+# Request headers we set ourselves or that must not reach Ebury
+DROPPED_REQUEST_HEADERS = HOP_BY_HOP_HEADERS | {
+    'host', 'cookie', 'authorization', 'x-client-id', 'content-length',
+}
+
+
+def filter_headers(headers, dropped):
+    # headers named in the Connection header are hop-by-hop too
+    connection = {name.strip().lower() for name in headers.get('Connection', '').split(',') if name.strip()}
+    return [(name, value) for name, value in headers.items()
+            if name.lower() not in dropped and name.lower() not in connection]
+
+
+class RequestCoalescer:
+    # Identical requests that are in flight at the same time share one upstream call
+
+    def __init__(self):
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        self.stats = {'leaders': 0, 'followers': 0}
+
+    def run(self, key, fetch):
+        with self._lock:
+            future = self._in_flight.get(key)
+            leader = future is None
+            if leader:
+                future = self._in_flight[key] = Future()
+                self.stats['leaders'] += 1
+            else:
+                self.stats['followers'] += 1
+        if not leader:
+            return future.result()
+        try:
+            result = fetch()
+            future.set_result(result)
+            return result
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[key]
+
+
+coalescer = RequestCoalescer()
+
+
+# Only a body read in one go is looked at, a streamed one is passed on untouched
+def is_introspection(body):
+    return isinstance(body, bytes) and b'__schema' in body
+
+# Proxy the current request to webhooks/<path> for the client
+def proxy_to_ebury(path, access_token, client_id):
+    url = current_app.config['EBURY_API_URL'] + 'webhooks/' + path
+    if request.query_string:
+        url += '?' + request.query_string.decode('latin-1')
+
+    headers = dict(filter_headers(request.headers, DROPPED_REQUEST_HEADERS))
+    headers['Authorization'] = f'Bearer {access_token}'
+    headers['X-Client-ID'] = client_id
+    # pass on what the browser accepts, as the response is passed back without decoding
+    headers['Accept-Encoding'] = request.headers.get('Accept-Encoding', 'identity')
+
+    body = None
+    if request.method == 'POST':
+        length = request.content_length
+        if length is not None and length <= MAX_BUFFERED_BODY:
+            body = request.get_data()
+        else:
+            body = iter(lambda: request.stream.read(CHUNK_SIZE), b'')
+
+    # The introspection query GraphiQL sends on load is the same for everybody,
+    # concurrent ones are answered by one upstream call
+    if request.method == 'POST' and is_introspection(body):
+        key = (client_id, headers['Accept-Encoding'], hashlib.sha256(body).hexdigest())
+
+        def fetch():
+            upstream = get_http_client().request('POST', url, headers=headers, data=body, stream=True)
+            try:
+                content = upstream.raw.read(decode_content=False)
+            finally:
+                upstream.close()
+            return upstream.status_code, filter_headers(upstream.headers, HOP_BY_HOP_HEADERS), content
+
+        status, response_headers, content = coalescer.run(key, fetch)
+        return Response(content, status, response_headers)
+
+    upstream = get_http_client().request(request.method, url, headers=headers, data=body, stream=True)
+
+    def generate():
+        try:
+            for chunk in upstream.raw.stream(CHUNK_SIZE, decode_content=False):
+                yield chunk
+        finally:
+            upstream.close()
+
+    return Response(stream_with_context(generate()), upstream.status_code,
+                    filter_headers(upstream.headers, HOP_BY_HOP_HEADERS), direct_passthrough=True)
@@ -0,0 +1,287 @@
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from urllib.parse import urlsplit
+from flask import current_app
+from .metrics import registry
+
+# Rules for calls to the Ebury API, so a slow or failing Ebury can't use up all the
+# request threads:
+# - every call has a timeout, per endpoint (EBURY_HTTP_TIMEOUTS), and never longer
+#   than what is left of the request's deadline
+# - calls that are safe to repeat (GETs and GraphQL queries) are retried with
+#   exponential backoff on connection errors, timeouts and 429/502/503/504, as long
+#   as the retry budget allows it. The budget is shared by the whole process and
+#   grows with the number of calls, so retries can never multiply the load on an
+#   Ebury that is already struggling
+# - a circuit breaker per host fails calls straight away after a run of failures,
+#   and lets a single trial call through once the reset timeout has passed
+#
+# The deadline is set for each request by the routes (EBURY_REQUEST_DEADLINE) and
+# kept in a context variable, fetch_all and gather_all pass it on to their workers.
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# Statuses worth trying again, and those that count as a failure of the host
+RETRY_STATUSES = {429, 502, 503, 504}
+FAILURE_STATUSES = {500, 502, 503, 504}
+IDEMPOTENT_METHODS = {'GET', 'HEAD', 'OPTIONS'}
+
+retries = registry.counter('ebury_upstream_retries_total', 'Calls to the Ebury API that were retried', ('endpoint',))
+retries_denied = registry.counter(
+    'ebury_upstream_retries_denied_total', 'Retries not made because the retry budget was used up', ('endpoint',))
+circuit_opened = registry.counter('ebury_circuit_opened_total', 'Times a circuit breaker opened', ('host',))
+
+
+# --- deadline ---
+
+_deadline = ContextVar('ebury_deadline', default=None)
+
+# The deadline (time.monotonic()) of the current request, None when there is none
+def current_deadline():
+    return _deadline.get()
+
+def time_left():
+    deadline = _deadline.get()
+    return None if deadline is None else deadline - time.monotonic()
+
+# Run the block with the deadline set, e.g. on a worker thread with the caller's deadline
+@contextmanager
+def deadline_scope(deadline):
+    token = _deadline.set(deadline)
+    try:
+        yield
+    finally:
+        _deadline.reset(token)
+
+# Start a deadline `seconds` from now, or keep the current one if it is sooner
+def start_deadline(seconds):
+    deadline = time.monotonic() + seconds
+    current = _deadline.get()
+    if current is not None and current < deadline:
+        deadline = current
+    return _deadline.set(deadline)
+
+def end_deadline(token):
+    _deadline.reset(token)
+
+
+# --- retry budget ---
+
+class RetryBudget:
+    # Every call adds `ratio` of a retry to the budget, and min_per_second are added
+    # every second so there is always something for when traffic is low. A retry takes one.
+    def __init__(self, ratio=0.1, min_per_second=5, max_balance=None):
+        self.ratio = ratio
+        self.min_per_second = min_per_second
+        self.max_balance = max_balance or max(10, min_per_second * 10)
+        self._balance = float(self.max_balance)
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self._balance = min(self.max_balance, self._balance + (now - self._updated) * self.min_per_second)
+        self._updated = now
+
+    def deposit(self):
+        with self._lock:
+            self._balance = min(self.max_balance, self._balance + self.ratio)
+
+    def withdraw(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            if self._balance < 1:
+                return False
+            self._balance -= 1
+            return True
+
+    @property
+    def balance(self):
+        with self._lock:
+            self._refill(time.monotonic())
+            return round(self._balance, 2)
+
+
+# --- circuit breaker ---
+
+class CircuitBreaker:
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half_open'
+
+    def __init__(self, host, failure_threshold=5, reset_timeout=30):
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    # Raises CircuitOpenError when the call must not be made, returns True when the
+    # call is the trial of a half open circuit
+    def before_call(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return False
+            if self.state == self.OPEN and time.monotonic() - self.opened_at >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                self._trial_in_flight = False
+            if self.state == self.HALF_OPEN and not self._trial_in_flight:
+                self._trial_in_flight = True
+                return True
+        raise CircuitOpenError(f"Circuit open for {self.host}, not calling it")
+
+    # The trial ended without telling whether the host is up (e.g. it was cancelled),
+    # let the next call be the trial
+    def release_trial(self):
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                self._trial_in_flight = False
+
+    def record(self, success):
+        with self._lock:
+            if success:
+                self.state = self.CLOSED
+                self.failures = 0
+                self._trial_in_flight = False
+                return
+            self.failures += 1
+            if self.state == self.HALF_OPEN or self.failures >= self.failure_threshold:
+                if self.state != self.OPEN:
+                    circuit_opened.inc((self.host,))
+                self.state = self.OPEN
+                self.opened_at = time.monotonic()
+                self._trial_in_flight = False
+
+
+# --- policy ---
+
+class UpstreamPolicy:
+    def __init__(self, timeouts=None, connect_timeout=5, read_timeout=30, attempts=3, backoff=0.1,
+                 backoff_max=2.0, budget=None, failure_threshold=5, reset_timeout=30):
+        self.timeouts = timeouts or {}
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.attempts = attempts
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.budget = budget or RetryBudget()
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def breaker(self, host):
+        breaker = self._breakers.get(host)
+        if breaker is None:
+            with self._lock:
+                breaker = self._breakers.setdefault(
+                    host, CircuitBreaker(host, self.failure_threshold, self.reset_timeout))
+        return breaker
+
+    def start(self, method, url, endpoint, idempotent=None):
+        if idempotent is None:
+            idempotent = method.upper() in IDEMPOTENT_METHODS
+        return UpstreamCall(self, urlsplit(url).netloc, endpoint, idempotent)
+
+    def snapshot(self):
+        with self._lock:
+            breakers = list(self._breakers.values())
+        return {
+            'retry_budget': self.budget.balance,
+            'circuits': {breaker.host: {'state': breaker.state, 'failures': breaker.failures} for breaker in breakers},
+        }
+
+
+class UpstreamCall:
+    # One call to the API, with its attempts. Used by the sync and the async client:
+    #   call = policy.start(method, url, endpoint)
+    #   loop: timeout = call.before_attempt(), make the request, then
+    #         delay = call.after_attempt(status=...) or call.after_attempt(error=...)
+    #         and stop when delay is None, otherwise wait `delay` and go again,
+    #         with call.end_attempt() in a finally around each attempt
+    def __init__(self, policy, host, endpoint, idempotent):
+        self.policy = policy
+        self.endpoint = endpoint
+        self.idempotent = idempotent
+        self.breaker = policy.breaker(host)
+        self.attempt = 0
+        # the attempt in flight is the circuit's trial and hasn't been recorded yet
+        self._trial = False
+        policy.budget.deposit()
+
+    # (connect, read) timeouts for the next attempt, raises when it must not be made
+    def before_attempt(self):
+        left = time_left()
+        if left is not None and left <= 0:
+            raise DeadlineExceeded(f"Deadline exceeded before calling {self.endpoint}")
+        self._trial = self.breaker.before_call()
+        self.attempt += 1
+        connect = self.policy.connect_timeout
+        read = self.policy.timeouts.get(self.endpoint, self.policy.read_timeout)
+        if left is not None:
+            connect, read = min(connect, left), min(read, left)
+        return connect, read
+
+    # Record how an attempt went, returns the seconds to wait before retrying or None
+    def after_attempt(self, status=None, error=None):
+        failed = error is not None or status in FAILURE_STATUSES
+        self._trial = False
+        self.breaker.record(not failed)
+        retryable = error is not None or status in RETRY_STATUSES
+        if not retryable or not self.idempotent or self.attempt >= self.policy.attempts:
+            return None
+
+        # full jitter, and only if there is time for another attempt after the wait
+        delay = random.uniform(0, min(self.policy.backoff_max, self.policy.backoff * 2 ** (self.attempt - 1)))
+        left = time_left()
+        if left is not None and delay >= left:
+            return None
+        if not self.policy.budget.withdraw():
+            retries_denied.inc((self.endpoint,))
+            return None
+        retries.inc((self.endpoint,))
+        return delay
+
+    # An attempt that ended with neither a status nor a recorded error, e.g. on an
+    # unexpected exception, must not keep the circuit's trial
+    def end_attempt(self):
+        if self._trial:
+            self._trial = False
+            self.breaker.release_trial()
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+# Get the process wide policy, shared by the sync and async clients
+def get_upstream_policy():
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                config = current_app.config
+                _policy = UpstreamPolicy(
+                    timeouts=config.get('EBURY_HTTP_TIMEOUTS', {}),
+                    connect_timeout=config.get('EBURY_HTTP_CONNECT_TIMEOUT', 5),
+                    read_timeout=config.get('EBURY_HTTP_READ_TIMEOUT', 30),
+                    attempts=config.get('EBURY_RETRY_ATTEMPTS', 3),
+                    backoff=config.get('EBURY_RETRY_BACKOFF', 0.1),
+                    backoff_max=config.get('EBURY_RETRY_BACKOFF_MAX', 2.0),
+                    budget=RetryBudget(
+                        ratio=config.get('EBURY_RETRY_BUDGET_RATIO', 0.1),
+                        min_per_second=config.get('EBURY_RETRY_BUDGET_MIN_PER_SECOND', 5),
+                    ),
+                    failure_threshold=config.get('EBURY_CIRCUIT_FAILURES', 5),
+                    reset_timeout=config.get('EBURY_CIRCUIT_RESET_TIMEOUT', 30),
+                )
+    return _policy
@@ -1,12 +1,72 @@
-from flask import Blueprint, request, jsonify, redirect, url_for, render_template, Response, current_app, make_response
-import requests
-from .ebury_api import get_ebury_balance, get_access_token, get_webhook_subscriptions, ping_subscription, delete_webhook_subscription, disable_webhook_subscription, enable_webhook_subscription, get_subscription_types, create_subscription, get_ebury_token, get_clients
+import time
+import uuid
+from flask import Blueprint, request, jsonify, redirect, url_for, render_template, Response, current_app, make_response, g, session
+from .ebury_api import get_access_token, get_subscription_types, create_subscription, get_ebury_token, get_clients, get_client_directory, login_user, token_manager
+from . import client_directory, ebury_api, ebury_api_async
+from .async_runtime import async_mode_enabled, get_async_runtime, run_async
+from .http_client import get_http_client
+from .cache import get_api_cache
+from .webhook_queue import WebhookEvent, get_webhook_queue
+from .event_store import get_event_store
+from .dedup import delivery_key, get_delivery_index
+from .ingest import BodyTooLarge, read_body, routing_fields
+from .broadcaster import ALL_ROOM, get_broadcaster
+from .proxy import proxy_to_ebury
+from .metrics import callback_ack, registry
+from .resilience import deadline_scope, end_deadline, get_upstream_policy, start_deadline
+from .bulk import bulk_room, run_bulk
+from .prober import get_webhook_prober
+from .user_tokens import SESSION_KEY, end_user, get_user_tokens, start_user, user_scope
+from .balances import BALANCE_NAMESPACE, balance_room, get_balance_snapshots
+from .fragments import get_fragment_cache, render_fragments
+from flask_socketio import emit, join_room, leave_room, rooms
 from app import socketio
-import hmac
-import hashlib
 
 bp = Blueprint('ebury', __name__)
 
+# Headers of an Ebury webhook that are kept for processing it
+WEBHOOK_HEADERS = ('X-EBURY-SIGNATURE', 'X_EBURY_CLIENT_ID', 'X_EBURY_WEBHOOK', 'X-EBURY-SUBSCRIPTION-ID')
+
+# The error response for a client_id the login has no access to, None when it has.
+# The routes that change subscriptions check this before calling the Ebury API.
+def unknown_client(client_id, status=404):
+    if client_id in get_client_directory():
+        return None
+    return jsonify({'error': f'Unknown client_id: {client_id}'}), status
+
+# Call an ebury_api function, with EBURY_ASYNC_MODE its ebury_api_async version is
+# run on the event loop instead (see async_runtime.py). Used by the routes that
+# mostly wait on the Ebury API.
+def call_api(name, *args):
+    if async_mode_enabled():
+        return run_async(getattr(ebury_api_async, name)(*args))
+    return getattr(ebury_api, name)(*args)
+
+# Every request gets EBURY_REQUEST_DEADLINE seconds for its calls to the Ebury API,
+# including the ones made for it on the fan-out threads (see resilience.py)
+@bp.before_request
+def set_request_deadline():
+    g.deadline_token = start_deadline(current_app.config.get('EBURY_REQUEST_DEADLINE', 25))
+
+@bp.teardown_request
+def clear_request_deadline(exc=None):
+    token = g.pop('deadline_token', None)
+    if token is not None:
+        end_deadline(token)
+
+# An operator who logged in through /ebo_login uses their own token (see user_tokens.py)
+@bp.before_request
+def set_request_user():
+    user_id = session.get(SESSION_KEY)
+    user = get_user_tokens().get(user_id) if user_id else None
+    g.user_token = start_user(user)
+
+@bp.teardown_request
+def clear_request_user(exc=None):
+    token = g.pop('user_token', None)
+    if token is not None:
+        end_user(token)
+
 # Add health check route
 @bp.route('/health', methods=['GET'])
 def health_check():
@@ -30,6 +90,10 @@ def ebo_login():
 def auth_callback():
     code = request.args.get('code')
     if code:
+        # with EBURY_USER_SESSIONS the token is the operator's own, kept with their session
+        if current_app.config.get('EBURY_USER_SESSIONS', False):
+            session[SESSION_KEY] = login_user({'code': code})
+            return redirect(url_for('ebury.clients'))
         access_token = get_ebury_token({'code': code})
         if access_token:
             return redirect(url_for('ebury.clients'))
@@ -38,17 +102,22 @@ def auth_callback():
     else:
         return jsonify({'login status': 'failed', 'error': 'No code provided'}), 400
 
+# Forget the operator's token
+@bp.route('/ebo_logout', methods=['GET'])
+def ebo_logout():
+    user_id = session.pop(SESSION_KEY, None)
+    if user_id:
+        get_user_tokens().logout(user_id)
+    return redirect(url_for('ebury.root'))
+
     
 # Add a route to receive callbacks from Ebury's API
+# The webhook is only captured here and put on the webhook queue, verification and
+# pushing to the 'callbacks' page happen on the queue workers (see webhooks.py)
 @bp.route('/callback', methods=['POST'])
 def callback():
-    # Extract the JSON payload and signature from the request
-    data = request.json
+    start = time.perf_counter()
     received_signature = request.headers.get('X-EBURY-SIGNATURE', '')
-    if received_signature.startswith("sha3-256="):
-        received_hash = received_signature.split("=", 1)[1]
-    else:
-        received_hash = ""
 
     # if using a proxy to forward to running on a localhost
     # we need to construct the URL from the headers, because flask
@@ -58,71 +127,183 @@ def callback():
     path = request.path
     constructed_url = f"{scheme}://{host}{path}"
 
-    # Retrieve the secret for HMAC computation (use an empty string if no secret is set)
-    secret = current_app.config.get('EBURY_WEBHOOK_SECRET', '')
-
-    # Construct the payload for HMAC computation
-    raw_body = request.data # Get raw body as bytes
-    payload = constructed_url.encode('utf-8') + raw_body  # Concatenate URL (encoded) and raw body
-
-    # Compute the expected signature
-    computed_hash = hmac.new(
-        key=secret.encode('utf-8'),
-        msg=payload,
-        digestmod=hashlib.sha3_256
-    ).hexdigest()
-
-    # Add verification result to the header_info
-    header_info = {
-        'X_EBURY_CLIENT_ID': request.headers.get('X_EBURY_CLIENT_ID'),
-        'X_EBURY_WEBHOOK': request.headers.get('X_EBURY_WEBHOOK'),
-        'X_EBURY_SIGNATURE': received_signature,
-        'Signature Valid': hmac.compare_digest(received_hash, computed_hash),
-    }
-
-    # Merge the header_info into the data object
-    data = {
-        'header info': header_info,
-        **data  # Merge the original data into the new object
-    }
-
-    # Debug information
-    print("callback headers and data:", data)
-
-    # Push data to the 'callbacks' page using SocketIO
-    socketio.emit('new_callback', data)
-
-    return jsonify({'status': 'success', 'X_EBURY_SIGNATURE': received_signature}), 200
- 
- # Add a route to display balances for each client_id the login contact has access to.
+    # The body is kept as the bytes that came, read up to EBURY_CALLBACK_MAX_BODY
+    try:
+        raw_body = read_body(request.stream, request.content_length,
+                             current_app.config.get('EBURY_CALLBACK_MAX_BODY', 1024 * 1024))
+    except BodyTooLarge:
+        callback_ack.observe(time.perf_counter() - start, ('too_large',))
+        return jsonify({'status': 'error', 'error': 'Body too large'}), 413
+    fields = routing_fields(raw_body)
+
+    # Ebury redelivers webhooks it isn't sure we got, acknowledge those again
+    # but don't process them a second time. A delivery is only recorded once its
+    # signature has been verified (see webhooks.py).
+    key = delivery_key(raw_body, fields.get('id'))
+    if get_delivery_index().check(key):
+        callback_ack.observe(time.perf_counter() - start, ('duplicate',))
+        return jsonify({'status': 'success', 'duplicate': True, 'X_EBURY_SIGNATURE': received_signature}), 200
+
+    event = WebhookEvent(
+        raw_body=raw_body,
+        headers={name: request.headers.get(name) for name in WEBHOOK_HEADERS},
+        url=constructed_url,
+        fields=fields,
+        key=key,
+    )
+
+    # When the queue is full ask Ebury to retry later rather than holding the request
+    if not get_webhook_queue().submit(event):
+        callback_ack.observe(time.perf_counter() - start, ('busy',))
+        return jsonify({'status': 'busy'}), 503, {'Retry-After': '1'}
+
+    callback_ack.observe(time.perf_counter() - start, ('accepted',))
+    return jsonify({'status': 'success', 'duplicate': False, 'X_EBURY_SIGNATURE': received_signature}), 200
+
+# Add a route to show internal counters, e.g. how many upstream connections were reused
+@bp.route('/stats', methods=['GET'])
+def stats():
+    return jsonify({
+        'http': get_http_client().stats.snapshot(),
+        'http_async': get_async_runtime().stats.snapshot() if async_mode_enabled() else None,
+        'resilience': get_upstream_policy().snapshot(),
+        'token': token_manager.snapshot(),
+        'user_tokens': get_user_tokens().snapshot(),
+        'cache': get_api_cache().snapshot(),
+        'fragments': get_fragment_cache().snapshot(),
+        'webhook_queue': get_webhook_queue().snapshot(),
+        'event_store': get_event_store().snapshot(),
+        'dedup': get_delivery_index().snapshot(),
+        'fanout': get_broadcaster().snapshot(),
+        'client_directory': client_directory.snapshot(),
+        'balances': get_balance_snapshots().snapshot(),
+    })
+
+# Add a route for Prometheus to scrape: upstream call, webhook and token metrics
+@bp.route('/metrics', methods=['GET'])
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+# Add a route to display balances for each client_id the login contact has access to.
+# The page is rendered from the balance snapshots, only the clients missing from them or
+# older than the 'balances' cache ttl are fetched, past the API cache. Changes are then pushed to the page
+# over Socket.IO (see balances.py). Only the columns of clients whose balances changed
+# are rendered again (see fragments.py).
 @bp.route('/balance', methods=['GET'])
 def balance():
-    balance_info = get_ebury_balance()
-    return render_template('balance.html', balances=balance_info)
+    snapshots = get_balance_snapshots()
+    client_ids = get_client_directory().client_ids
+    stale = snapshots.stale(client_ids, current_app.config.get('EBURY_CACHE_TTLS', {}).get('balances', 0))
+    if stale:
+        snapshots.apply(call_api('get_ebury_balance', stale, False))
+    return render_fragments('balance.html', 'fragments/balance_client.html', snapshots.view(client_ids))
+
+# A balance page gets the changes to its clients' balances
+@socketio.on('connect', namespace=BALANCE_NAMESPACE)
+def watch_balances(auth=None):
+    user_id = session.get(SESSION_KEY)
+    with user_scope(get_user_tokens().get(user_id) if user_id else None):
+        client_ids = get_client_directory().client_ids
+    for client_id in client_ids:
+        join_room(balance_room(client_id))
+    get_balance_snapshots().watch(request.sid, client_ids, current_app._get_current_object(), user_id)
+
+@socketio.on('disconnect', namespace=BALANCE_NAMESPACE)
+def unwatch_balances():
+    get_balance_snapshots().unwatch(request.sid)
 
 # Add a route to display webhooks and subscription types
 @bp.route('/webhooks', methods=['GET'])
 def webhooks():
-    webhooks_data = get_webhook_subscriptions()
-    return render_template('webhooks.html', webhooks=webhooks_data)
+    webhooks_data = call_api('get_webhook_subscriptions')
+    return render_fragments('webhooks.html', 'fragments/webhooks_client.html', webhooks_data)
 
 # Add a route to display incoming callbacks
 @bp.route('/callbacks', methods=['GET'])
 def callbacks():
     return render_template('callbacks.html')
 
+# Add a route to page through the stored callbacks, newest first.
+# Use ?before=<seq> to get older pages, or ?after=<seq> to get newer events oldest first.
+# Can be filtered by client_id, type (the webhook type) and since/until (unix timestamps).
+@bp.route('/callbacks/history', methods=['GET'])
+def callbacks_history():
+    args = request.args
+    limit = min(args.get('limit', 100, type=int), 1000)
+    events = get_event_store().query(
+        after=args.get('after', type=int),
+        before=args.get('before', type=int),
+        limit=limit,
+        client_id=args.get('client_id'),
+        webhook_type=args.get('type'),
+        since=args.get('since', type=float),
+        until=args.get('until', type=float),
+    )
+    return jsonify({'events': events})
+
+# When the 'callbacks' page connects, send it the stored events it has missed.
+# The page passes the last seq it has seen as ?since=, without it the latest events are sent
+@socketio.on('connect')
+def replay_callbacks(auth=None):
+    join_room(ALL_ROOM)
+    get_broadcaster().join(request.sid, [ALL_ROOM])
+
+    limit = current_app.config.get('EBURY_EVENT_REPLAY_LIMIT', 500)
+    since = request.args.get('since', type=int)
+    if since is not None:
+        events = get_event_store().query(after=since, limit=limit, raw=True)
+    else:
+        events = get_event_store().query(limit=limit, raw=True)
+        events.reverse()
+    if events:
+        emit('callback_batch', {'room': 'replay', 'events': events})
+
+@socketio.on('disconnect')
+def callbacks_disconnect():
+    get_broadcaster().remove(request.sid)
+
+# The 'callbacks' page picks the client ids and webhook types it wants to see,
+# with neither it gets everything
+@socketio.on('subscribe')
+def subscribe_callbacks(data):
+    client_ids = [client_id for client_id in (data or {}).get('client_ids', []) if client_id]
+    types = [webhook_type for webhook_type in (data or {}).get('types', []) if webhook_type]
+    new_rooms = [f"client:{client_id}" for client_id in client_ids] + [f"type:{webhook_type}" for webhook_type in types]
+    if not new_rooms:
+        new_rooms = [ALL_ROOM]
+
+    for room in rooms():
+        if room != request.sid:
+            leave_room(room)
+    for room in new_rooms:
+        join_room(room)
+    get_broadcaster().join(request.sid, new_rooms)
+
+# The 'callbacks' page has rendered a batch
+@socketio.on('ack_batch')
+def ack_callback_batch():
+    missed = get_broadcaster().ack(request.sid)
+    if missed:
+        emit('callbacks_missed', {'count': missed})
+
 @bp.route('/webhooks/delete/<client_id>/<subscription_id>', methods=['DELETE'])
 def delete_webhook(client_id, subscription_id):
+    error = unknown_client(client_id)
+    if error:
+        return error
     # Use client_id and subscription_id to delete the subscription
-    result = delete_webhook_subscription(client_id, subscription_id)
+    result = call_api('delete_webhook_subscription', client_id, subscription_id)
     return jsonify(result)
 
 @bp.route('/webhooks/<action>/<client_id>/<subscription_id>', methods=['PATCH'])
 def toggle_webhook(action, client_id, subscription_id):
+    error = unknown_client(client_id)
+    if error:
+        return error
     if action == 'enable':
-        result = enable_webhook_subscription(client_id, subscription_id)
+        result = call_api('enable_webhook_subscription', client_id, subscription_id)
     elif action == 'disable':
-        result = disable_webhook_subscription(client_id, subscription_id)
+        result = call_api('disable_webhook_subscription', client_id, subscription_id)
     else:
         return jsonify({'error': 'Invalid action'}), 400
     return jsonify(result)
@@ -132,6 +313,9 @@ def toggle_webhook(action, client_id, subscription_id):
 def new_subscription():
     if request.method == 'POST':
         client_id = request.form['client_id']
+        error = unknown_client(client_id, 400)
+        if error:
+            return error
         url = request.form['url']
         secret = request.form['secret']
         types = request.form.getlist('types')
@@ -141,38 +325,76 @@ def new_subscription():
     subscription_types = get_subscription_types()
     enum_values = subscription_types['data']['__type']['enumValues']
     clients_list = get_clients()
-    return render_template('new_subscription.html', subscription_types=enum_values, clients=clients_list)
+    cache = get_fragment_cache()
+    return cache.page('new_subscription.html', {
+        'clients': cache.fragment('fragments/client_options.html', 'clients', clients_list),
+        'types': cache.fragment('fragments/subscription_types.html', 'types', enum_values),
+    })
+
+# Add a route to make many subscription changes at once, e.g. to move every client to a
+# new callback url. Takes {"job_id": optional, "items": [{"client_id", "operation", "params"}]}
+# (see bulk.py) and returns the result of every item. Progress is pushed as 'bulk_progress'
+# to Socket.IO clients that sent 'bulk_watch' with the job id.
+@bp.route('/subscriptions/bulk', methods=['POST'])
+def bulk_subscriptions():
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'the body must be a JSON object'}), 400
+    items = data.get('items')
+    if not isinstance(items, list) or not items:
+        return jsonify({'error': 'items must be a non empty list'}), 400
+    max_items = current_app.config.get('EBURY_BULK_MAX_ITEMS', 1000)
+    if len(items) > max_items:
+        return jsonify({'error': f'at most {max_items} items at a time'}), 400
+
+    job_id = str(data.get('job_id') or uuid.uuid4().hex)
+    # a bulk change gets longer than a page load
+    with deadline_scope(time.monotonic() + current_app.config.get('EBURY_BULK_DEADLINE', 300)):
+        return jsonify(run_bulk(job_id, items))
+
+@socketio.on('bulk_watch')
+def watch_bulk_job(data):
+    job_id = (data or {}).get('job_id')
+    if job_id:
+        join_room(bulk_room(str(job_id)))
 
 @bp.route('/clients', methods=['GET'])
 def clients():
     clients_list = get_clients()
-    return render_template('clients.html', clients=clients_list)
+    return render_fragments('clients.html', 'fragments/client_list.html', {'clients': clients_list})
 
 @bp.route('/webhooks/ping/<client_id>/<subscription_id>', methods=['POST'])
 def ping_webhook(client_id, subscription_id):
-    result = ping_subscription(client_id, subscription_id)
+    error = unknown_client(client_id)
+    if error:
+        return error
+    result = call_api('ping_subscription', client_id, subscription_id)
     return jsonify(result), 200 if result['status'] == 'success' else 500
 
-# Proxy route to fetch data from Ebury API
-# This current only works for the initial graphiql page
-# I have not worked out how to proxy the requests made on the page yet
-@bp.route('/proxy/ebury_graphql', methods=['GET'])
-def proxy_ebury_graphql():
+# Add a route to show the health of the webhook subscriptions from the background pings:
+# ping and delivery latency p50/p99 and the last failure of each (see prober.py)
+@bp.route('/webhooks/health', methods=['GET'])
+def webhooks_health():
+    return jsonify(get_webhook_prober().snapshot())
+
+# Proxy routes for Ebury's GraphiQL page (webhooks/) and its queries (webhooks/graphql).
+# The client can be picked with ?client_id= or the X-Client-ID header, by default it is the first one.
+@bp.route('/proxy/ebury_graphql', defaults={'path': ''}, methods=['GET', 'POST'])
+@bp.route('/proxy/ebury_graphql/', defaults={'path': ''}, methods=['GET', 'POST'])
+@bp.route('/proxy/ebury_graphql/<path:path>', methods=['GET', 'POST'])
+def proxy_ebury_graphql(path):
+    if path not in ('', 'graphql'):
+        return jsonify({'error': 'Not found'}), 404
+
     access_token = get_access_token()
     if not access_token:
         return jsonify({'error': 'Access token not found'}), 401
 
-    # needs to be updated to pass in client_id
-    client_id = get_clients()[0].get('client_id')
-    url = current_app.config['EBURY_API_URL'] + 'webhooks/'
-
-    headers = {
-        'Authorization': f'Bearer {access_token}',
-        'X-Client-ID': client_id
-    }
-
-    response = requests.get(url, headers=headers)
-    return Response(response.content, response.status_code, response.headers.items())
+    client_id = request.args.get('client_id') or request.headers.get('X-Client-ID') or get_client_directory().first().client_id
+    error = unknown_client(client_id, 400)
+    if error:
+        return error
+    return proxy_to_ebury(path, access_token, client_id)
 
 # Show the GraphiQL page supported by Ebury's API
 @bp.route('/ebury_graphql', methods=['GET'])
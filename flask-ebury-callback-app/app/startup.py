@@ -0,0 +1,121 @@
+import gc
+import logging
+import os
+import sys
+import threading
+
+logger = logging.getLogger(__name__)
+
+# Starting the app, in one process or as gunicorn workers forked from a preloaded app
+# (gunicorn.conf.py). With EBURY_PRELOAD the app is created once in the gunicorn master:
+# the imports, config and templates, plus the token, the client directory and the
+# subscription types, are loaded before the workers are forked and shared with them.
+# Nothing holding a thread, a connection or a lock may cross the fork, so the singletons
+# below are dropped in every forked child and created again on first use, and the
+# background work is started in each worker instead of the master.
+
+# (module, singleton, its lock) for the singletons a forked worker makes its own of
+SINGLETONS = (
+    ('app.http_client', '_client', '_client_lock'),
+    ('app.async_runtime', '_runtime', '_runtime_lock'),
+    ('app.resilience', '_policy', '_policy_lock'),
+    ('app.cache', '_cache', '_cache_lock'),
+    ('app.fragments', '_cache', '_cache_lock'),
+    ('app.user_tokens', '_registry', '_registry_lock'),
+    ('app.webhook_queue', '_queue', '_queue_lock'),
+    ('app.webhook_verifier', '_verifier', '_verifier_lock'),
+    ('app.dedup', '_index', '_index_lock'),
+    ('app.event_store', '_store', '_store_lock'),
+    ('app.broadcaster', '_broadcaster', '_broadcaster_lock'),
+    ('app.message_bus', '_bus', '_bus_lock'),
+    ('app.balances', '_snapshots', '_snapshots_lock'),
+    ('app.prober', '_prober', '_prober_lock'),
+)
+# (module, lock) of state that is kept, the lock may have been held by another thread
+SHARED_LOCKS = (
+    ('app.client_directory', '_lock'),
+    ('app.graphql', '_subscription_types_lock'),
+)
+
+
+# Config from app/config.py, then the file named by the EBURY_SETTINGS environment
+# variable if set, then FLASK_ prefixed environment variables (FLASK_EBURY_API_URL=...,
+# values are parsed as JSON when they can be)
+def load_config(app):
+    app.config.from_object('app.config.Config')
+    app.config.from_envvar('EBURY_SETTINGS', silent=True)
+    app.config.from_prefixed_env()
+
+
+# With operator sessions the session cookie picks whose Ebury token a request uses,
+# so it must not be signed with a key everybody knows
+def check_config(app):
+    from .config import Config
+    if app.config.get('EBURY_USER_SESSIONS') and app.config.get('SECRET_KEY') in (None, '', Config.SECRET_KEY):
+        raise RuntimeError("EBURY_USER_SESSIONS needs a SECRET_KEY of your own, e.g. FLASK_SECRET_KEY")
+
+
+def start_background(app):
+    from .prober import start_webhook_prober
+    start_webhook_prober(app)
+
+
+# Load what every worker would otherwise fetch on its first requests. Only possible
+# once the app has a token (e.g. in the shared credential store), without one there
+# is nothing to warm.
+def warm(app):
+    from . import ebury_api
+    with app.app_context():
+        state = ebury_api.token_manager.current()
+        if state is None:
+            logger.info("Not logged in, nothing to warm")
+            return
+        try:
+            if not state.is_valid():
+                state = ebury_api.token_manager.refresh(state, background=False)
+            directory = ebury_api.get_client_directory()
+            if len(directory):
+                ebury_api.get_subscription_types()
+        except Exception as e:
+            logger.warning("Warming before fork failed", extra={'fields': {'error': repr(e)}})
+            return
+        logger.info("Warmed before fork", extra={'fields': {'clients': len(directory)}})
+
+
+def _reset_after_fork():
+    for module_name, name, lock_name in SINGLETONS:
+        module = sys.modules.get(module_name)
+        if module is not None:
+            setattr(module, name, None)
+            setattr(module, lock_name, threading.Lock())
+    for module_name, lock_name in SHARED_LOCKS:
+        module = sys.modules.get(module_name)
+        if module is not None:
+            setattr(module, lock_name, threading.Lock())
+    if 'app.ebury_api' in sys.modules:
+        sys.modules['app.ebury_api'].token_manager.after_fork()
+    if 'app.log' in sys.modules:
+        sys.modules['app.log'].restart_logging_after_fork()
+    if 'app.metrics' in sys.modules:
+        sys.modules['app.metrics'].registry.after_fork()
+
+_fork_reset_registered = False
+
+# Reset the singletons in every child forked from now on. Only a process that forks
+# an app it has already used needs this, like the gunicorn master with EBURY_PRELOAD.
+def register_fork_reset():
+    global _fork_reset_registered
+    if not _fork_reset_registered:
+        os.register_at_fork(after_in_child=_reset_after_fork)
+        _fork_reset_registered = True
+
+
+# Get the app ready to be forked: warm it, start its background work in every child
+# and move what has been loaded out of the garbage collector's way, so the collector
+# doesn't write to (and unshare) the pages the workers share with the master
+def prepare_preload(app):
+    warm(app)
+    register_fork_reset()
+    os.register_at_fork(after_in_child=lambda: start_background(app))
+    gc.collect()
+    gc.freeze()
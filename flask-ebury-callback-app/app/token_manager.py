@@ -0,0 +1,165 @@
+import logging
+import random
+import threading
+import time
+from flask import current_app
+from .client_directory import directory_for
+from .metrics import token_lock_wait, token_refreshes
+
+logger = logging.getLogger(__name__)
+
+# Keeps the Ebury access token fresh in the background.
+# The current token is held in an immutable TokenState that is swapped in whole when
+# a new token arrives, so request threads read it without taking a lock. A refresher
+# thread renews the token `refresh_ahead` seconds (minus some random jitter) before it
+# expires, so request threads never wait on the auth server unless there is no valid
+# token at all (before the first login, or when refreshing has failed until expiry).
+#
+# Each process has its own manager and refresher thread. Where the token is kept is
+# up to the credential store (see credential_store.py): with the default in-process
+# store every gunicorn worker has its own token, with the shared store all workers
+# use one token and only one of them renews it at a time.
+
+
+class TokenState:
+    __slots__ = ('access_token', 'refresh_token', 'expires_at', 'clients', 'id_claims', 'directory')
+
+    def __init__(self, access_token, refresh_token, expires_at, clients, id_claims=None):
+        self.access_token = access_token
+        self.refresh_token = refresh_token
+        self.expires_at = expires_at
+        self.clients = clients
+        self.id_claims = id_claims or {}
+        # the clients indexed by client id, see client_directory.py
+        self.directory = directory_for(clients)
+
+    def is_valid(self, now=None):
+        return self.access_token is not None and (now or time.time()) < self.expires_at
+
+
+class TokenManager:
+    def __init__(self, renew, refresh_ahead=120, jitter=30, retry_interval=5):
+        # renew(state) gets a new token from the auth server and returns its TokenState,
+        # state is the current one (or None) so it can use its refresh token
+        self.renew = renew
+        self.refresh_ahead = refresh_ahead
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        self._store = None
+        self._start_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._app = None
+        self._thread = None
+        self._stats_lock = threading.Lock()
+        self._stats = {'background_refreshes': 0, 'blocking_refreshes': 0, 'failed_refreshes': 0}
+
+    @property
+    def store(self):
+        if self._store is None:
+            from .credential_store import create_credential_store
+            with self._start_lock:
+                if self._store is None:
+                    self._store = create_credential_store(current_app.config)
+        return self._store
+
+    def current(self):
+        return self.store.load()
+
+    def set_state(self, state):
+        store = self.store
+        with store.refresh_lock():
+            store.save(state)
+        self._changed.set()
+        if self._thread is None:
+            self.start(current_app._get_current_object())
+
+    # Get a valid access token. This only blocks when there is no valid token to hand out.
+    def get_access_token(self):
+        state = self.store.load()
+        if state is not None and state.is_valid():
+            return state.access_token
+        state = self.refresh(state, background=False)
+        if self._thread is None:
+            self.start(current_app._get_current_object())
+        return state.access_token
+
+    # Renew the token, only one thread (in one process, with a shared store) at a time
+    # does this. If another one has replaced `stale` while we waited, its token is used instead.
+    def refresh(self, stale, background=True):
+        store = self.store
+        mode = 'background' if background else 'blocking'
+        waiting_since = time.perf_counter()
+        with store.refresh_lock():
+            token_lock_wait.observe(time.perf_counter() - waiting_since, (mode,))
+            state = store.load()
+            replaced = state is not None and (stale is None or state.access_token != stale.access_token)
+            if replaced and state.is_valid():
+                token_refreshes.inc((mode, 'replaced'))
+                return state
+            logger.info("Renewing access token", extra={'fields': {'mode': mode}})
+            try:
+                new_state = self.renew(state)
+            except Exception:
+                token_refreshes.inc((mode, 'failed'))
+                with self._stats_lock:
+                    self._stats['failed_refreshes'] += 1
+                raise
+            token_refreshes.inc((mode, 'renewed'))
+            with self._stats_lock:
+                self._stats['background_refreshes' if background else 'blocking_refreshes'] += 1
+            store.save(new_state)
+            self._changed.set()
+            return new_state
+
+    def start(self, app):
+        with self._start_lock:
+            if self._thread is not None:
+                return
+            self._app = app
+            self.refresh_ahead = app.config.get('EBURY_TOKEN_REFRESH_AHEAD', self.refresh_ahead)
+            self.jitter = app.config.get('EBURY_TOKEN_REFRESH_JITTER', self.jitter)
+            self._thread = threading.Thread(target=self._refresh_loop, name='token-refresher', daemon=True)
+            self._thread.start()
+
+    # In a worker forked from a preloaded app the token is kept but the refresher thread
+    # is not there, it is started again by the first request
+    def after_fork(self):
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._changed = threading.Event()
+        self._thread = None
+        if self._store is not None:
+            self._store.after_fork()
+
+    def _next_refresh_in(self, state):
+        refresh_at = state.expires_at - self.refresh_ahead - random.uniform(0, self.jitter)
+        return max(0, refresh_at - time.time())
+
+    def _refresh_loop(self):
+        with self._app.app_context():
+            while True:
+                state = self.store.load()
+                if state is None:
+                    self._changed.wait()
+                    self._changed.clear()
+                    continue
+                # sleep until it is time to refresh, or until a new token arrives
+                if self._changed.wait(self._next_refresh_in(state)):
+                    self._changed.clear()
+                    continue
+                try:
+                    self.refresh(state)
+                except Exception as e:
+                    logger.warning("Background token refresh failed", extra={'fields': {'error': repr(e)}})
+                    # keep the current token and try again shortly
+                    self._changed.wait(self.retry_interval)
+                    self._changed.clear()
+
+    def snapshot(self):
+        state = self.store.load()
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['store'] = type(self.store).__name__
+        stats['logged_in'] = state is not None
+        stats['expires_in'] = round(state.expires_at - time.time(), 1) if state else None
+        return stats
@@ -0,0 +1,273 @@
+import logging
+import random
+import secrets
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from flask import current_app
+from .metrics import registry, token_lock_wait, token_refreshes
+
+logger = logging.getLogger(__name__)
+
+# Tokens of the operators who log in through /ebo_login, one per Flask session, so
+# several people can use the app at the same time without replacing each other's token.
+# The session cookie only carries a random user id, the tokens stay on the server, in
+# the credential store (see credential_store.py): with the shared store a login on one
+# gunicorn worker is seen by all of them.
+#
+# Each worker keeps the users it has served lately, with a lock per user, and renews
+# their tokens on a background thread refresh_ahead seconds (minus some random jitter)
+# before they expire, like the token manager does for the app's token. One process at
+# a time renews a user's token, the others pick the new one up from the store. A request
+# only waits for the auth server when the user's token has expired. Users who haven't
+# been seen by any worker for idle_timeout are logged out, and the least recently seen
+# ones over max_sessions.
+#
+# The routes look up the user once per request and put them in a context variable,
+# which fetch_all, the cache refresh and the async runtime pass on to their workers
+# like the deadline (see resilience.py). Without a user the app's own token manager
+# is used, as for the host to host login and background work.
+
+SESSION_KEY = 'ebury_user'
+# how often a worker writes down that it has seen a user
+TOUCH_INTERVAL = 60
+
+
+class UserToken:
+    __slots__ = ('user_id', 'state', 'lock', 'last_used', 'touched')
+
+    def __init__(self, user_id, state, touched):
+        self.user_id = user_id
+        self.state = state
+        self.lock = threading.Lock()
+        self.last_used = time.monotonic()
+        # when the store was last told about this user, wall clock as it is shared
+        self.touched = touched
+
+
+class UserTokenRegistry:
+    def __init__(self, renew, store, max_sessions=1000, idle_timeout=8 * 3600, refresh_ahead=120,
+                 jitter=30, retry_interval=5):
+        # renew(state) gets a new TokenState for the user from the auth server
+        self.renew = renew
+        self.store = store
+        self.max_sessions = max_sessions
+        self.idle_timeout = idle_timeout
+        self.refresh_ahead = refresh_ahead
+        self.jitter = jitter
+        self.retry_interval = retry_interval
+        # user id -> UserToken of the users this process has served, least recently used first
+        self._users = OrderedDict()
+        self._lock = threading.Lock()
+        self._changed = threading.Event()
+        self._app = None
+        self._thread = None
+        self._stats = {'logins': 0, 'logouts': 0, 'evicted': 0, 'expired': 0,
+                       'background_refreshes': 0, 'blocking_refreshes': 0, 'failed_refreshes': 0}
+
+    # Add a user with a newly issued token, returns their user id for the session
+    def login(self, state):
+        user_id = secrets.token_urlsafe(16)
+        self.store.save_user(user_id, state)
+        expired, evicted = self.store.prune_users(time.time() - self.idle_timeout, self.max_sessions)
+        with self._lock:
+            self._stats['logins'] += 1
+            self._stats['expired'] += expired
+            self._stats['evicted'] += evicted
+        self._start()
+        return user_id
+
+    def logout(self, user_id):
+        if self.store.delete_user(user_id):
+            with self._lock:
+                self._stats['logouts'] += 1
+        with self._lock:
+            self._users.pop(user_id, None)
+
+    # The user for a session's user id, None when unknown or idle for too long
+    def get(self, user_id):
+        stored = self.store.load_user(user_id)
+        with self._lock:
+            if stored is None:
+                self._users.pop(user_id, None)
+                return None
+            state, touched = stored
+            now = time.time()
+            if now - touched > self.idle_timeout:
+                self._users.pop(user_id, None)
+                self._stats['expired'] += 1
+                expired = True
+            else:
+                expired = False
+                user = self._users.get(user_id)
+                if user is None:
+                    user = self._users[user_id] = UserToken(user_id, state, touched)
+                    while len(self._users) > self.max_sessions:
+                        self._users.popitem(last=False)
+                else:
+                    self._users.move_to_end(user_id)
+                    user.touched = max(user.touched, touched)
+                user.state = state
+                user.last_used = time.monotonic()
+                touch = now - user.touched > TOUCH_INTERVAL
+                if touch:
+                    user.touched = now
+        if expired:
+            self.store.delete_user(user_id)
+            return None
+        if touch:
+            self.store.touch_user(user_id, now)
+        self._start()
+        return user
+
+    # The user's access token when it isn't due for renewal yet, without taking a lock
+    def current_token(self, user):
+        state = user.state
+        if state.expires_at - time.time() > self.refresh_ahead:
+            return state.access_token
+        return None
+
+    # Get a valid access token for the user. A token that is due is renewed by the
+    # background thread, a request only renews it itself when it has expired.
+    def access_token(self, user):
+        token = self.current_token(user)
+        if token is not None:
+            return token
+        if user.state.is_valid():
+            self._changed.set()
+            return user.state.access_token
+        waiting_since = time.perf_counter()
+        with user.lock:
+            token_lock_wait.observe(time.perf_counter() - waiting_since, ('user',))
+            state = self._refresh(user, background=False)
+        return state.access_token
+
+    # Renew the user's token, holding user.lock, unless another thread or process has
+    # already replaced it
+    def _refresh(self, user, background=True):
+        mode = 'user_background' if background else 'user'
+        stale = user.state
+        with self.store.user_refresh_lock(user.user_id):
+            stored = self.store.load_user(user.user_id)
+            if stored is None:
+                raise ValueError("Session expired, log in again")
+            state = stored[0]
+            if state.access_token != stale.access_token and state.expires_at - time.time() > self.refresh_ahead:
+                token_refreshes.inc((mode, 'replaced'))
+                user.state = state
+                return state
+            try:
+                state = self.renew(state)
+            except Exception:
+                token_refreshes.inc((mode, 'failed'))
+                with self._lock:
+                    self._stats['failed_refreshes'] += 1
+                raise
+            self.store.save_user(user.user_id, state)
+        token_refreshes.inc((mode, 'renewed'))
+        with self._lock:
+            self._stats['background_refreshes' if background else 'blocking_refreshes'] += 1
+        user.state = state
+        return state
+
+    def _start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._app = current_app._get_current_object()
+            self._thread = threading.Thread(target=self._refresh_loop, name='user-token-refresher', daemon=True)
+            self._thread.start()
+
+    def _refresh_at(self, user):
+        return user.state.expires_at - self.refresh_ahead - random.uniform(0, self.jitter)
+
+    def _refresh_loop(self):
+        with self._app.app_context():
+            while True:
+                # the users seen lately, the others are left to expire
+                seen_after = time.monotonic() - self.idle_timeout
+                with self._lock:
+                    users = [user for user in self._users.values() if user.last_used > seen_after]
+                now = time.time()
+                due = [user for user in users if self._refresh_at(user) <= now]
+                failed = False
+                for user in due:
+                    # a request renewing it itself holds the lock
+                    if not user.lock.acquire(blocking=False):
+                        continue
+                    try:
+                        self._refresh(user)
+                    except Exception as e:
+                        failed = True
+                        logger.warning("Background user token refresh failed", extra={'fields': {'error': repr(e)}})
+                    finally:
+                        user.lock.release()
+                wait = min((self._refresh_at(user) for user in users if user not in due), default=now + 3600) - now
+                if failed:
+                    wait = min(wait, self.retry_interval)
+                # sleep until the next one is due, or until a request finds one due
+                if self._changed.wait(max(wait, 0.1)):
+                    self._changed.clear()
+
+    def __len__(self):
+        return self.store.count_users()
+
+    def snapshot(self):
+        with self._lock:
+            stats = dict(self._stats)
+            stats['served'] = len(self._users)
+        stats['sessions'] = len(self)
+        stats['max_sessions'] = self.max_sessions
+        stats['store'] = type(self.store).__name__
+        return stats
+
+
+# --- the user of the current request ---
+
+_user = ContextVar('ebury_user', default=None)
+
+def current_user():
+    return _user.get()
+
+@contextmanager
+def user_scope(user):
+    token = _user.set(user)
+    try:
+        yield
+    finally:
+        _user.reset(token)
+
+def start_user(user):
+    return _user.set(user)
+
+def end_user(token):
+    _user.reset(token)
+
+
+_registry = None
+_registry_lock = threading.Lock()
+
+# Get the process wide registry, created on first use from the app config
+def get_user_tokens():
+    global _registry
+    if _registry is None:
+        with _registry_lock:
+            if _registry is None:
+                from .ebury_api import renew_user_token, token_manager
+                config = current_app.config
+                _registry = UserTokenRegistry(
+                    renew_user_token,
+                    token_manager.store,
+                    max_sessions=config.get('EBURY_USER_SESSIONS_MAX', 1000),
+                    idle_timeout=config.get('EBURY_USER_SESSION_IDLE_TIMEOUT', 8 * 3600),
+                    refresh_ahead=config.get('EBURY_TOKEN_REFRESH_AHEAD', 120),
+                    jitter=config.get('EBURY_TOKEN_REFRESH_JITTER', 30),
+                )
+    return _registry
+
+registry.gauge('ebury_user_sessions', 'Operators logged in with their own token',
+               lambda: len(_registry) if _registry is not None else None)
@@ -0,0 +1,127 @@
+import logging
+import queue
+import threading
+import time
+from collections import deque
+from flask import current_app
+from .metrics import registry, webhooks_processed
+
+logger = logging.getLogger(__name__)
+
+# In process queue between the /callback route and the webhook processing.
+# /callback only captures the raw request and puts it on the queue, so Ebury gets
+# its acknowledgement straight away, worker threads then do the verification,
+# logging and pushing to the callbacks page.
+
+
+class WebhookEvent:
+    __slots__ = ('raw_body', 'headers', 'url', 'fields', 'key', 'received_at')
+
+    def __init__(self, raw_body, headers, url, fields=None, key=None, received_at=None):
+        self.raw_body = raw_body
+        self.headers = headers
+        self.url = url
+        # the routing fields scanned from the body (see ingest.py) and the delivery key
+        self.fields = fields if fields is not None else {}
+        self.key = key
+        self.received_at = received_at if received_at is not None else time.monotonic()
+
+
+class WebhookQueue:
+    def __init__(self, handler, maxsize=10000, workers=4, put_timeout=0.05):
+        self.handler = handler
+        self.workers = workers
+        self.put_timeout = put_timeout
+        self._queue = queue.Queue(maxsize=maxsize)
+        self._app = None
+        self._threads = []
+        self._start_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {'accepted': 0, 'rejected': 0, 'processed': 0, 'failed': 0}
+        # recent queue wait + processing times, in seconds
+        self._latencies = deque(maxlen=2048)
+
+    def start(self, app):
+        with self._start_lock:
+            if self._threads:
+                return
+            self._app = app
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work, name=f'webhook-worker-{i}', daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    # Put an event on the queue, waiting at most put_timeout seconds for room.
+    # Returns False when the queue is full so the caller can ask Ebury to retry later.
+    def submit(self, event):
+        if not self._threads:
+            self.start(current_app._get_current_object())
+        try:
+            self._queue.put(event, timeout=self.put_timeout)
+        except queue.Full:
+            with self._stats_lock:
+                self._stats['rejected'] += 1
+            return False
+        with self._stats_lock:
+            self._stats['accepted'] += 1
+        return True
+
+    def _work(self):
+        while True:
+            event = self._queue.get()
+            try:
+                with self._app.app_context():
+                    self.handler(event)
+                failed = False
+            except Exception as e:
+                logger.exception("Failed to process webhook")
+                failed = True
+            finally:
+                self._queue.task_done()
+            latency = time.monotonic() - event.received_at
+            webhooks_processed.inc(('failed' if failed else 'processed',))
+            with self._stats_lock:
+                self._stats['failed' if failed else 'processed'] += 1
+                self._latencies.append(latency)
+
+    # Block until every queued event has been processed, used by the load test
+    def join(self):
+        self._queue.join()
+
+    def snapshot(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+            latencies = sorted(self._latencies)
+        stats['depth'] = self._queue.qsize()
+        stats['max_depth'] = self._queue.maxsize
+        stats['workers'] = len(self._threads)
+        if latencies:
+            stats['latency_ms'] = {
+                'p50': round(latencies[len(latencies) // 2] * 1000, 3),
+                'p99': round(latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))] * 1000, 3),
+                'max': round(latencies[-1] * 1000, 3),
+            }
+        return stats
+
+
+_queue = None
+_queue_lock = threading.Lock()
+
+# Get the process wide webhook queue, created on first use from the app config
+def get_webhook_queue():
+    global _queue
+    if _queue is None:
+        with _queue_lock:
+            if _queue is None:
+                from .webhooks import process_webhook
+                config = current_app.config
+                _queue = WebhookQueue(
+                    process_webhook,
+                    maxsize=config.get('EBURY_WEBHOOK_QUEUE_SIZE', 10000),
+                    workers=config.get('EBURY_WEBHOOK_WORKERS', 4),
+                    put_timeout=config.get('EBURY_WEBHOOK_QUEUE_TIMEOUT', 0.05),
+                )
+    return _queue
+
+registry.gauge('ebury_webhook_queue_depth', 'Webhooks waiting on the webhook queue',
+               lambda: _queue._queue.qsize() if _queue is not None else None)
@@ -0,0 +1,94 @@
+import hmac
+import hashlib
+import threading
+from flask import current_app
+
+# Verification of the X-EBURY-SIGNATURE header of webhooks.
+# Ebury signs the callback url followed by the raw body with HMAC-SHA3-256.
+# The keyed HMAC state is prepared once per secret (and per secret and url, as the
+# url is the same for every delivery) and copied for each webhook, and the body is
+# fed in chunks rather than concatenated with the url.
+
+SIGNATURE_PREFIX = "sha3-256="
+CHUNK_SIZE = 64 * 1024
+
+
+class WebhookVerifier:
+    def __init__(self, secrets=(), subscription_secrets=None, max_prefixes=64):
+        # secrets tried for every webhook, e.g. the current and the previous one while rotating
+        self.secrets = [secret for secret in secrets if secret is not None]
+        # extra secrets per subscription id
+        self.subscription_secrets = subscription_secrets or {}
+        self.max_prefixes = max_prefixes
+        self._keyed = {}
+        self._prefixed = {}
+        self._lock = threading.Lock()
+
+    def _keyed_state(self, secret):
+        state = self._keyed.get(secret)
+        if state is None:
+            state = hmac.new(secret.encode('utf-8'), digestmod=hashlib.sha3_256)
+            with self._lock:
+                self._keyed[secret] = state
+        return state
+
+    # HMAC state with the secret and the url already fed in
+    def _prefixed_state(self, secret, url):
+        state = self._prefixed.get((secret, url))
+        if state is None:
+            state = self._keyed_state(secret).copy()
+            state.update(url.encode('utf-8'))
+            with self._lock:
+                if len(self._prefixed) >= self.max_prefixes:
+                    self._prefixed.clear()
+                self._prefixed[(secret, url)] = state
+        return state
+
+    def secrets_for(self, subscription_id=None):
+        if subscription_id and subscription_id in self.subscription_secrets:
+            return list(self.subscription_secrets[subscription_id]) + self.secrets
+        return self.secrets
+
+    # Check a signature header against the url and body.
+    # body is bytes, or an iterable of byte chunks when it is streamed.
+    def verify(self, url, body, signature, subscription_id=None):
+        if not signature or not signature.startswith(SIGNATURE_PREFIX):
+            return False
+        received_hash = signature[len(SIGNATURE_PREFIX):]
+
+        if isinstance(body, (bytes, bytearray, memoryview)):
+            if len(body) <= CHUNK_SIZE:
+                chunks = (body,)
+            else:
+                view = memoryview(body)
+                chunks = (view[i:i + CHUNK_SIZE] for i in range(0, len(view), CHUNK_SIZE))
+        else:
+            chunks = body
+
+        # every secret is fed the body in the same pass, so a streamed body is only read once
+        macs = [self._prefixed_state(secret, url).copy() for secret in self.secrets_for(subscription_id)]
+        for chunk in chunks:
+            for mac in macs:
+                mac.update(chunk)
+
+        valid = False
+        for mac in macs:
+            valid |= hmac.compare_digest(received_hash, mac.hexdigest())
+        return valid
+
+
+_verifier = None
+_verifier_lock = threading.Lock()
+
+# Get the process wide verifier, built on first use from the app config
+def get_webhook_verifier():
+    global _verifier
+    if _verifier is None:
+        with _verifier_lock:
+            if _verifier is None:
+                config = current_app.config
+                # use an empty string if no secret is set, as Ebury does
+                secrets = [config.get('EBURY_WEBHOOK_SECRET') or '']
+                secrets += config.get('EBURY_WEBHOOK_PREVIOUS_SECRETS', [])
+                _verifier = WebhookVerifier(secrets, config.get('EBURY_WEBHOOK_SECRETS', {}))
+    return _verifier
@@ -0,0 +1,99 @@
+import logging
+import time
+from .balances import webhook_received
+from .broadcaster import get_broadcaster
+from .dedup import get_delivery_index
+from .event_store import get_event_store
+from .ingest import scan_fields
+from .metrics import webhook_verify
+from .prober import record_ping_delivery
+from .webhook_verifier import get_webhook_verifier
+
+# Processing of the webhooks received on /callback, run on the webhook queue workers
+
+logger = logging.getLogger(__name__)
+
+
+def process_webhook(event):
+    received_signature = event.headers.get('X-EBURY-SIGNATURE') or ''
+
+    # Check the signature before doing anything with the body
+    start = time.perf_counter()
+    valid = get_webhook_verifier().verify(
+        event.url,
+        event.raw_body,
+        received_signature,
+        subscription_id=event.headers.get('X-EBURY-SUBSCRIPTION-ID'),
+    )
+    webhook_verify.observe(time.perf_counter() - start, ('true' if valid else 'false',))
+
+    # Add verification result to the header_info
+    header_info = {
+        'X_EBURY_CLIENT_ID': event.headers.get('X_EBURY_CLIENT_ID'),
+        'X_EBURY_WEBHOOK': event.headers.get('X_EBURY_WEBHOOK'),
+        'X_EBURY_SIGNATURE': received_signature,
+        'Signature Valid': valid,
+    }
+
+    client_id = header_info['X_EBURY_CLIENT_ID'] or event.fields.get('client_id')
+    webhook_type = header_info['X_EBURY_WEBHOOK'] or event.fields.get('type')
+
+    # A webhook failing verification is not parsed, the 'callbacks' page is only
+    # told that it arrived. Its delivery is not recorded, so a genuine webhook with
+    # the same event id is still processed.
+    if not valid:
+        logger.warning("callback rejected, invalid signature", extra={'fields': header_info})
+        get_broadcaster().publish([{
+            'seq': None,
+            'received_at': time.time(),
+            'client_id': client_id,
+            'webhook_type': webhook_type,
+            'header_info': header_info,
+            'body': None,
+        }])
+        return
+
+    # Record the delivery now that it is known to be genuine. Two deliveries of the same
+    # webhook that arrived before either was recorded are both on the queue, the second
+    # one stops here.
+    if event.key is not None and get_delivery_index().check_and_add(event.key):
+        logger.info("callback already processed", extra={'fields': {'event_id': event.fields.get('id')}})
+        return
+
+    # Webhooks that change balances refresh the client's balances, see balances.py
+    webhook_received(client_id, webhook_type)
+
+    # A PING may be the answer to one of the health check pings, see prober.py
+    if webhook_type == 'PING':
+        subscription_id = event.headers.get('X-EBURY-SUBSCRIPTION-ID')
+        if not subscription_id:
+            subscription_id = scan_fields(event.raw_body, ('subscription_id',)).get('subscription_id')
+        record_ping_delivery(subscription_id, event.received_at)
+
+    # Only a sample of the payloads are logged, see EBURY_LOG_PAYLOAD_SAMPLE_RATE
+    logger.info("callback received", extra={'sample': True, 'fields': {
+        'client_id': client_id,
+        'webhook_type': webhook_type,
+        'event_id': event.fields.get('id'),
+        'bytes': len(event.raw_body),
+        'payload': event.raw_body,
+    }})
+
+    # Verified webhooks are written to the event store, they are pushed to the
+    # 'callbacks' page once committed so they carry their sequence number.
+    # Any the store has no room for are pushed straight away without one.
+    stored = get_event_store().append(
+        event.raw_body,
+        header_info,
+        client_id=client_id,
+        webhook_type=webhook_type,
+    )
+    if not stored:
+        get_broadcaster().publish([{
+            'seq': None,
+            'received_at': time.time(),
+            'client_id': client_id,
+            'webhook_type': webhook_type,
+            'header_info': header_info,
+            'body': event.raw_body,
+        }])
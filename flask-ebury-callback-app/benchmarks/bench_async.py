@@ -0,0 +1,121 @@
+# Benchmark of /balance with the thread model (a thread per upstream call) against
+# EBURY_ASYNC_MODE (tasks on one event loop), at a number of concurrent page loads.
+# The app and the stub each run in their own process, the app's peak RSS and thread
+# count are read from /proc.
+#
+#   python -m benchmarks.bench_async
+import argparse
+import subprocess
+import sys
+import threading
+import time
+import requests
+
+from benchmarks.common import make_app, fake_login, percentile, proc_status, serve
+from benchmarks.stub_server import StubServer
+
+LATENCY = 0.05
+CLIENTS = 20
+DURATION = 5
+
+
+def run_stub(port):
+    server = StubServer(latency=LATENCY, port=port)
+    print(server.url, flush=True)
+    server.serve_forever()
+
+
+def run_app(stub_url, async_mode):
+    app = make_app(
+        EBURY_API_URL=stub_url,
+        EBURY_ASYNC_MODE=async_mode,
+        # measure the upstream calls, not the cache
+        EBURY_CACHE_TTLS={},
+        # enough pooled connections for every concurrent page load in both models
+        EBURY_HTTP_POOL_SIZE=1024,
+        EBURY_EVENT_STORE_PATH=':memory:',
+    )
+    with app.app_context():
+        fake_login([f'CLIENT{i:04d}' for i in range(CLIENTS)])
+    server, base_url = serve(app)
+    print(base_url, flush=True)
+    threading.Event().wait()
+
+
+def spawn(*args):
+    process = subprocess.Popen([sys.executable, '-m', 'benchmarks.bench_async', *args],
+                               stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+def load(base_url, concurrency, pid):
+    latencies = []
+    lock = threading.Lock()
+    stop = time.perf_counter() + DURATION
+    peak_threads = 0
+    errors = 0
+
+    def page_loader():
+        nonlocal errors
+        session = requests.Session()
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            response = session.get(base_url + '/balance')
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200 or 'error' in response.text:
+                    errors += 1
+
+    loaders = [threading.Thread(target=page_loader, daemon=True) for _ in range(concurrency)]
+    for loader in loaders:
+        loader.start()
+    while any(loader.is_alive() for loader in loaders):
+        peak_threads = max(peak_threads, int(proc_status(pid)['Threads']))
+        time.sleep(0.05)
+    return latencies, peak_threads, errors
+
+
+def bench(stub_url, mode, concurrency):
+    process, base_url = spawn('--serve-app', stub_url, '--mode', mode)
+    try:
+        # one page load to warm up, then measure from there
+        requests.get(base_url + '/balance').raise_for_status()
+        base_rss = int(proc_status(process.pid)['VmRSS'])
+        latencies, peak_threads, errors = load(base_url, concurrency, process.pid)
+        peak_rss = int(proc_status(process.pid)['VmHWM'])
+    finally:
+        process.kill()
+        process.wait()
+    per_request = (peak_rss - base_rss) / concurrency
+    print(f"{mode:>7} {concurrency:>12} {len(latencies) / DURATION:>7.1f} "
+          f"{percentile(latencies, 50) * 1000:>7.0f} {percentile(latencies, 99) * 1000:>7.0f} "
+          f"{peak_threads:>8} {peak_rss / 1024:>8.1f} {per_request:>12.0f} {errors:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve-app')
+    parser.add_argument('--serve-stub', type=int)
+    parser.add_argument('--mode', default='thread')
+    parser.add_argument('--concurrency', type=int, nargs='+', default=[10, 50, 200])
+    args = parser.parse_args()
+    if args.serve_stub is not None:
+        return run_stub(args.serve_stub)
+    if args.serve_app:
+        return run_app(args.serve_app, args.mode == 'async')
+
+    stub, stub_url = spawn('--serve-stub', '0')
+    print(f"{CLIENTS} clients per page, stub latency {LATENCY * 1000:.0f} ms per call, {DURATION}s per run")
+    print(f"{'mode':>7} {'page loads':>12} {'req/s':>7} {'p50 ms':>7} {'p99 ms':>7} "
+          f"{'threads':>8} {'rss MB':>8} {'KB/request':>12} {'errors':>7}")
+    try:
+        for concurrency in args.concurrency:
+            for mode in ('thread', 'async'):
+                bench(stub_url, mode, concurrency)
+    finally:
+        stub.kill()
+
+
+if __name__ == '__main__':
+    main()
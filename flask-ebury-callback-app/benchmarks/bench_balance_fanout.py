@@ -0,0 +1,54 @@
+# Benchmark of get_ebury_balance against a local stub with a fixed latency per call.
+# Wall time should scale with clients / EBURY_MAX_CONCURRENCY, not with the client count.
+#
+#   python -m benchmarks.bench_balance_fanout
+import time
+from flask import Flask
+
+from app import ebury_api
+from app.http_client import get_http_client
+from app.config import Config
+from benchmarks.common import fake_login
+from benchmarks.stub_server import StubServer
+
+LATENCY = 0.05
+
+
+def run(app, client_count, concurrency):
+    app.config['EBURY_MAX_CONCURRENCY'] = concurrency
+    with app.app_context():
+        fake_login([f'CLIENT{i:04d}' for i in range(client_count)])
+        start = time.perf_counter()
+        balances = ebury_api.get_ebury_balance()
+        elapsed = time.perf_counter() - start
+    assert len(balances) == client_count
+    errors = sum(1 for b in balances.values() if isinstance(b, dict) and 'error' in b)
+    return elapsed, errors
+
+
+def main():
+    server = StubServer(latency=LATENCY).start()
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    app.config['EBURY_API_URL'] = server.url
+    # measure the upstream calls, not the cache
+    app.config['EBURY_CACHE_TTLS'] = {}
+
+    print(f"stub latency {LATENCY * 1000:.0f} ms per call")
+    print(f"{'clients':>8} {'concurrency':>12} {'wall s':>8} {'ideal s':>8} {'errors':>7}")
+    for client_count in (25, 50, 150):
+        for concurrency in (1, 4, 16, 64):
+            elapsed, errors = run(app, client_count, concurrency)
+            ideal = -(-client_count // concurrency) * LATENCY
+            print(f"{client_count:>8} {concurrency:>12} {elapsed:>8.2f} {ideal:>8.2f} {errors:>7}")
+
+    with app.app_context():
+        stats = get_http_client().stats.snapshot()
+    print(f"connections: {stats['requests']} requests, {stats['new_connections']} new, "
+          f"{stats['reused_connections']} reused")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,81 @@
+# Benchmark of the balance snapshots (app/balances.py) for 200 clients: what it takes to
+# show a change in one client's balance by reloading /balance, against a PAYMENT webhook
+# refreshing only that client and pushing the changed row to an open balance page, and
+# a background poll of every client where 5 balances changed.
+#
+#   python -m benchmarks.bench_balance_push
+import json
+import threading
+import time
+
+from app import balances
+from benchmarks.common import make_app, fake_login, serve
+from benchmarks.stub_server import StubServer
+from benchmarks.webhook_generator import WebhookGenerator
+
+LATENCY = 0.02
+CLIENTS = [f'CLIENT{i:04d}' for i in range(200)]
+SECRET = 'bench secret'
+
+
+def main():
+    server = StubServer(latency=LATENCY).start()
+    app = make_app(EBURY_API_URL=server.url, EBURY_EVENT_STORE_PATH=':memory:', EBURY_WEBHOOK_SECRET=SECRET,
+                   EBURY_CACHE_TTLS={}, EBURY_BALANCE_POLL_INTERVAL=3600, EBURY_BALANCE_REFRESH_DELAY=0.05)
+    with app.app_context():
+        fake_login(CLIENTS)
+    http_server, base_url = serve(app)
+    client = app.test_client()
+    print(f"{len(CLIENTS)} clients, stub latency {LATENCY * 1000:.0f} ms")
+
+    # reloading the page to see a change
+    server.calls.clear()
+    start = time.perf_counter()
+    page = client.get('/balance').data
+    elapsed = time.perf_counter() - start
+    print(f"page reload:        {elapsed * 1000:7.1f} ms  {server.calls['/balances']:3d} balance calls  "
+          f"{len(page):6d} bytes sent")
+
+    # an open page, with the pushes counted instead of sent
+    pushed = []
+    arrived = threading.Event()
+
+    def emit(event, data, **kwargs):
+        pushed.append(data)
+        arrived.set()
+
+    balances.socketio.emit = emit
+    with app.app_context():
+        snapshots = balances.get_balance_snapshots()
+        snapshots.watch('bench-page', CLIENTS, app)
+
+    server.calls.clear()
+    server.balances[CLIENTS[7]] = {'GBP': 250.0, 'EUR': 10.0}
+    webhooks = WebhookGenerator(base_url + '/callback', SECRET)
+    start = time.perf_counter()
+    webhooks.send(webhooks.payload(CLIENTS[7], 'PAYMENT'), CLIENTS[7], 'PAYMENT')
+    arrived.wait(10)
+    elapsed = time.perf_counter() - start
+    size = sum(len(json.dumps(data)) for data in pushed)
+    print(f"payment webhook:    {elapsed * 1000:7.1f} ms  {server.calls['/balances']:3d} balance calls  "
+          f"{size:6d} bytes pushed  {pushed}")
+
+    pushed.clear()
+    server.calls.clear()
+    for client_id in CLIENTS[100:105]:
+        server.balances[client_id] = {'GBP': 99.0}
+    start = time.perf_counter()
+    with app.app_context():
+        changes = snapshots.refresh(CLIENTS)
+    elapsed = time.perf_counter() - start
+    size = sum(len(json.dumps(data)) for data in pushed)
+    print(f"poll, 5 changed:    {elapsed * 1000:7.1f} ms  {server.calls['/balances']:3d} balance calls  "
+          f"{size:6d} bytes pushed in {len(pushed)} messages, {len(changes)} rows")
+    with app.app_context():
+        print("snapshots:", snapshots.snapshot())
+    http_server.shutdown()
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
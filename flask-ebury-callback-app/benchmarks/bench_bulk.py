@@ -0,0 +1,68 @@
+# Benchmark of moving 200 clients to a new callback url (create the new subscription
+# and delete the old one, 400 changes): one mutation at a time like the single change
+# routes, against /subscriptions/bulk with aliased mutations and concurrent clients.
+# A few of the deletes name a subscription that doesn't exist, to show per item errors.
+#
+#   python -m benchmarks.bench_bulk
+import time
+
+from app import bulk, ebury_api
+from benchmarks.common import make_app, fake_login
+from benchmarks.stub_server import StubServer
+
+LATENCY = 0.05
+CLIENTS = [f'CLIENT{i:04d}' for i in range(200)]
+NEW_URL = 'https://example.com/new-callback'
+
+
+def items():
+    result = []
+    for i, client_id in enumerate(CLIENTS):
+        old_subscription = 'missing' if i % 50 == 0 else f'{client_id}-sub-0'
+        result.append({'client_id': client_id, 'operation': 'create',
+                       'params': {'url': NEW_URL, 'types': ['PAYMENT'], 'secret': 'secret'}})
+        result.append({'client_id': client_id, 'operation': 'delete',
+                       'params': {'subscription_id': old_subscription}})
+    return result
+
+
+def main():
+    server = StubServer(latency=LATENCY).start()
+    app = make_app(EBURY_API_URL=server.url, EBURY_EVENT_STORE_PATH=':memory:')
+    with app.app_context():
+        fake_login(CLIENTS)
+    print(f"{len(CLIENTS)} clients, {len(items())} changes, stub latency {LATENCY * 1000:.0f} ms")
+
+    # one change at a time, as the single change routes do
+    with app.app_context():
+        start = time.perf_counter()
+        failed = 0
+        for item in items():
+            try:
+                if item['operation'] == 'create':
+                    params = item['params']
+                    ebury_api.create_subscription(item['client_id'], params['url'], params['types'], params['secret'])
+                else:
+                    ebury_api.delete_webhook_subscription(item['client_id'], item['params']['subscription_id'])
+            except Exception:
+                failed += 1
+        elapsed = time.perf_counter() - start
+    print(f"one at a time:   {elapsed:6.2f}s  {server.graphql_requests} GraphQL requests")
+
+    # count the progress messages instead of sending them
+    progress = []
+    bulk.socketio.emit = lambda event, data, **kwargs: progress.append(data)
+    requests_before = server.graphql_requests
+    start = time.perf_counter()
+    response = app.test_client().post('/subscriptions/bulk', json={'job_id': 'bench', 'items': items()})
+    elapsed = time.perf_counter() - start
+    report = response.get_json()
+    print(f"bulk:            {elapsed:6.2f}s  {server.graphql_requests - requests_before} GraphQL requests, "
+          f"{len(progress)} progress messages, results {report['counts']}")
+    failed_items = [item for item in report['items'] if item['status'] != 'success']
+    print("failed items:", ', '.join(f"#{item['index']} {item['client_id']} {item['error']}" for item in failed_items))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
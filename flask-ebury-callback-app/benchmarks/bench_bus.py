@@ -0,0 +1,83 @@
+# Benchmark of the message bus (app/message_bus.py) across 4 worker processes, each with
+# its own broadcaster and one browser on the 'callbacks' page, while every worker receives
+# 500 webhooks a second: the share of all the callbacks each browser is pushed, callbacks
+# pushed per second over all the browsers, and the time from a webhook arriving on any
+# worker to its push, with the "local" bus against the "unix" one for two batch windows.
+#
+#   python -m benchmarks.bench_bus
+import multiprocessing
+import os
+import tempfile
+import time
+
+from app import broadcaster
+from app.broadcaster import ALL_ROOM, CallbackBroadcaster
+from app.message_bus import LocalBus, UnixSocketBus
+from benchmarks.common import percentile
+
+WORKERS = 4
+RATE = 500
+SECONDS = 5
+BODY = b'{"id": "evt", "type": "PAYMENT", "client_id": "CLIENT0001", "filler": "' + b'x' * 900 + b'"}'
+
+
+def worker(index, backend, path, window, ready, results):
+    pushed = []
+    fanout = CallbackBroadcaster(window=window, bus=UnixSocketBus(path) if backend == 'unix' else LocalBus())
+
+    def emit(event, data, **kwargs):
+        now = time.time()
+        pushed.extend(now - item['received_at'] for item in data['events'])
+        fanout.ack('browser')
+
+    broadcaster.socketio.emit = emit
+    fanout.join('browser', [ALL_ROOM])
+    fanout.start()
+    ready.wait()
+
+    interval = 1.0 / RATE
+    next_send = time.perf_counter()
+    for i in range(RATE * SECONDS):
+        fanout.publish([{'seq': None, 'received_at': time.time(), 'client_id': 'CLIENT0001',
+                         'webhook_type': 'PAYMENT', 'header_info': {'worker': index}, 'body': BODY}])
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+    # let the last batches through
+    time.sleep(window * 2 + 1)
+    results.put((len(pushed), pushed, fanout.bus.snapshot()))
+
+
+def run(backend, window):
+    context = multiprocessing.get_context('fork')
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bus.sock')
+        ready = context.Barrier(WORKERS)
+        results = context.Queue()
+        processes = [context.Process(target=worker, args=(i, backend, path, window, ready, results))
+                     for i in range(WORKERS)]
+        for process in processes:
+            process.start()
+        collected = [results.get(timeout=SECONDS * 10) for _ in processes]
+        for process in processes:
+            process.join()
+
+    published = RATE * SECONDS * WORKERS
+    pushed = sum(count for count, _, _ in collected)
+    latencies = [latency for _, worker_latencies, _ in collected for latency in worker_latencies]
+    messages = sum(stats['messages_sent'] for _, _, stats in collected)
+    print(f"{backend:6s} {window * 1000:6.0f} ms  {pushed / WORKERS / published * 100:5.0f}% of callbacks per browser  "
+          f"{pushed / SECONDS:8.0f} pushed/s  latency p50 {percentile(latencies, 50) * 1000:6.1f} ms  "
+          f"p99 {percentile(latencies, 99) * 1000:6.1f} ms  {messages:5d} bus messages for {published} callbacks")
+
+
+def main():
+    print(f"{WORKERS} workers, {RATE} webhooks/s each for {SECONDS}s")
+    for window in (0.25, 0.02):
+        for backend in ('local', 'unix'):
+            run(backend, window)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,51 @@
+# Benchmark of the client directory (app/client_directory.py) for a login with 500
+# clients: handling a renewed token with the same clients, checking a client_id and
+# making the request headers for a client, each against the way it was done before.
+#
+#   python -m benchmarks.bench_client_directory
+import json
+import timeit
+from base64 import urlsafe_b64decode
+
+from app.client_directory import client_headers, snapshot
+from app.ebury_api import process_token_response
+from benchmarks.stub_server import make_token_response
+
+CLIENTS = 500
+
+
+def per_call(statement, number):
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    token_response = make_token_response('token', CLIENTS)
+    state = process_token_response(token_response)
+    clients = state.clients
+    directory = state.directory
+    last_client = clients[-1]['client_id']
+    print(f"{CLIENTS} clients in the id token ({len(token_response['id_token'])} bytes)")
+
+    def decode_before():
+        payload = json.loads(urlsafe_b64decode(token_response['id_token'].split('.')[1] + '==').decode())
+        return payload.get('clients', [])
+
+    rows = [
+        ("token renewed, same clients", lambda: decode_before(),
+         lambda: process_token_response(token_response), 2000),
+        ("client_id check (last client)", lambda: any(c.get('client_id') == last_client for c in clients),
+         lambda: last_client in directory, 200000),
+        ("first client", lambda: clients[0].get('client_id'),
+         lambda: directory.first().client_id, 200000),
+        ("request headers for a client", lambda: {"Authorization": "Bearer token", "Content-Type": "application/json",
+                                                  "X-Client-ID": last_client},
+         lambda: client_headers('token', last_client), 200000),
+    ]
+    print(f"{'':32s} {'before':>10s} {'directory':>10s}")
+    for name, before, after, number in rows:
+        print(f"{name:32s} {per_call(before, number):8.2f}us {per_call(after, number):8.2f}us")
+    print("directories:", snapshot())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# Benchmark of token lookups per second in each credential store backend, and a check
+# that with the shared store only one of several processes renews an expired token.
+#
+#   python -m benchmarks.bench_credential_store
+import multiprocessing
+import os
+import tempfile
+import threading
+import time
+
+from app.credential_store import InProcessCredentialStore, SqliteCredentialStore
+from app.startup import register_fork_reset
+from app.token_manager import TokenState
+from benchmarks.common import make_app
+from benchmarks.stub_server import StubServer
+
+SECONDS = 2
+WORKERS = 4
+
+
+def lookups_per_second(store, threads):
+    counts = []
+
+    def run():
+        count = 0
+        end = time.perf_counter() + SECONDS
+        while time.perf_counter() < end:
+            for _ in range(100):
+                store.load().access_token
+            count += 100
+        counts.append(count)
+
+    workers = [threading.Thread(target=run) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sum(counts) / SECONDS
+
+
+def renew_in_worker(app, barrier):
+    from app.ebury_api import token_manager
+    with app.app_context():
+        stale = token_manager.current()
+        barrier.wait()
+        token_manager.refresh(stale)
+
+
+def main():
+    directory = tempfile.mkdtemp()
+    state = TokenState('token', 'refresh', time.time() + 3600, [{'client_id': 'CLIENT0001'}])
+
+    print(f"{'backend':>8} {'threads':>8} {'lookups/s':>12}")
+    for name, store in (('memory', InProcessCredentialStore()),
+                        ('sqlite', SqliteCredentialStore(os.path.join(directory, 'lookups.db')))):
+        store.save(state)
+        for threads in (1, 4):
+            print(f"{name:>8} {threads:>8} {lookups_per_second(store, threads):>12,.0f}")
+
+    # Several workers find the token expired at the same time, only one should ask the auth server
+    server = StubServer(latency=0.01, token_latency=0.5).start()
+    app = make_app(
+        EBURY_AUTHENTICATION_URL=server.url,
+        EBURY_CREDENTIAL_STORE='sqlite',
+        EBURY_CREDENTIAL_STORE_PATH=os.path.join(directory, 'shared.db'),
+    )
+    from app.ebury_api import token_manager
+    with app.app_context():
+        token_manager.store.save(TokenState('expired', 'refresh', time.time() - 1, []))
+
+    # the workers are forked from an app that has been used, like a preloaded one
+    register_fork_reset()
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(WORKERS)
+    processes = [context.Process(target=renew_in_worker, args=(app, barrier)) for _ in range(WORKERS)]
+    for process in processes:
+        process.start()
+    for process in processes:
+        process.join()
+    print(f"{WORKERS} worker processes renewed an expired token with {server.token_requests} call(s) to the auth server")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+# Benchmark of the work done for a webhook from reading the /callback body to storing it
+# and pushing it to the callbacks page, for 1KB to 1MB bodies: the way it was done before
+# (whole body read, parsed, merged with the header info and encoded again for the event
+# store and for Socket.IO) against the raw bytes path (app/ingest.py). Shows the CPU time
+# and the peak memory allocated per webhook, and then that an oversized body is refused
+# with 413 by the app.
+#
+#   python -m benchmarks.bench_ingest
+import io
+import json
+import time
+import tracemalloc
+
+from app.dedup import delivery_key
+from app.ingest import read_body, routing_fields
+from benchmarks.common import make_app
+from benchmarks.webhook_generator import WebhookGenerator
+
+LIMIT = 1024 * 1024
+HEADER_INFO = {'X_EBURY_CLIENT_ID': 'CLIENT0001', 'X_EBURY_WEBHOOK': 'PAYMENT',
+               'X_EBURY_SIGNATURE': 'sha3-256=' + '0' * 64, 'Signature Valid': True}
+
+
+def before(body):
+    raw = io.BytesIO(body).read()
+    key = delivery_key(raw)
+    data = {'header info': HEADER_INFO, **json.loads(raw)}
+    stored = json.dumps(data)
+    emitted = json.dumps({'seq': 1, 'client_id': 'CLIENT0001', 'webhook_type': 'PAYMENT', 'payload': data})
+    return key, stored, emitted
+
+
+def after(body):
+    raw = read_body(io.BytesIO(body), len(body), LIMIT)
+    fields = routing_fields(raw)
+    key = delivery_key(raw, fields.get('id'))
+    stored = json.dumps(HEADER_INFO)
+    # the body goes out as a binary attachment, only the rest is encoded
+    emitted = json.dumps({'seq': 1, 'client_id': fields.get('client_id'), 'webhook_type': fields.get('type'),
+                          'header_info': HEADER_INFO, 'body': {'_placeholder': True, 'num': 0}})
+    return key, stored, emitted, raw
+
+
+def cpu_per_call(path, body, number):
+    best = float('inf')
+    for _ in range(5):
+        start = time.process_time()
+        for _ in range(number):
+            path(body)
+        best = min(best, (time.process_time() - start) / number)
+    return best
+
+
+def peak_allocated(path, body):
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    base = tracemalloc.get_traced_memory()[0]
+    path(body)
+    peak = tracemalloc.get_traced_memory()[1] - base
+    tracemalloc.stop()
+    return peak
+
+
+def main():
+    generator = WebhookGenerator('http://localhost/callback', 'bench secret')
+    print(f"{'body':>8} {'before us':>10} {'raw us':>10} {'before peak':>12} {'raw peak':>10}")
+    for size in (1024, 16 * 1024, 256 * 1024, 1024 * 1024 - 1024):
+        body = generator.payload('CLIENT0001', 'PAYMENT', size=size, amount={'currency': 'GBP', 'amount': 10.5})
+        number = max(20, 20000000 // size)
+        cpu_before = cpu_per_call(before, body, number)
+        cpu_after = cpu_per_call(after, body, number)
+        peak_before = peak_allocated(before, body)
+        peak_after = peak_allocated(after, body)
+        print(f"{len(body) // 1024:>6}KB {cpu_before * 1e6:>10.1f} {cpu_after * 1e6:>10.1f} "
+              f"{peak_before / 1024:>10.0f}KB {peak_after / 1024:>8.0f}KB")
+
+    # a body over EBURY_CALLBACK_MAX_BODY is refused before it is read
+    app = make_app(EBURY_EVENT_STORE_PATH=':memory:', EBURY_CALLBACK_MAX_BODY=LIMIT)
+    client = app.test_client()
+    body = generator.payload('CLIENT0001', 'PAYMENT', size=4 * LIMIT)
+    start = time.perf_counter()
+    response = client.post('/callback', data=body, headers=generator.headers(body, 'CLIENT0001', 'PAYMENT'))
+    elapsed = time.perf_counter() - start
+    print(f"{len(body) // 1024}KB body: {response.status_code} in {elapsed * 1000:.1f} ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+# Benchmark of the webhook health checks (app/prober.py): a round of pings for every
+# active subscription at different EBURY_PROBE_CONCURRENCY, with the stub delivering the
+# PING webhook of each ping back to the app's /callback, and the /webhooks/health summary.
+#
+#   python -m benchmarks.bench_prober
+import time
+
+from app import prober
+from app.webhook_queue import get_webhook_queue
+from benchmarks.common import make_app, fake_login, percentile, serve
+from benchmarks.stub_server import StubServer
+
+LATENCY = 0.02
+CLIENTS = [f'CLIENT{i:04d}' for i in range(50)]
+SUBSCRIPTIONS_PER_CLIENT = 2
+SECRET = 'bench secret'
+
+
+def main():
+    app = make_app(EBURY_WEBHOOK_SECRET=SECRET, EBURY_EVENT_STORE_PATH=':memory:', EBURY_CACHE_TTLS={})
+    http_server, base_url = serve(app)
+    server = StubServer(latency=LATENCY, subscriptions_per_client=SUBSCRIPTIONS_PER_CLIENT,
+                        callback_url=base_url + '/callback', webhook_secret=SECRET).start()
+    app.config['EBURY_API_URL'] = server.url
+    with app.app_context():
+        fake_login(CLIENTS)
+    total = len(CLIENTS) * SUBSCRIPTIONS_PER_CLIENT
+    print(f"{total} active subscriptions, stub latency {LATENCY * 1000:.0f} ms")
+
+    for concurrency in (1, 8, 32):
+        prober._prober = None
+        app.config['EBURY_PROBE_CONCURRENCY'] = concurrency
+        with app.app_context():
+            probe = prober.get_webhook_prober()
+            start = time.perf_counter()
+            probe.run_once()
+            elapsed = time.perf_counter() - start
+            # let the PING webhooks arrive and be processed
+            deadline = time.monotonic() + 10
+            while probe.snapshot()['awaiting_delivery'] and time.monotonic() < deadline:
+                time.sleep(0.05)
+            get_webhook_queue().join()
+        print(f"concurrency {concurrency:3d}: round of {total} pings in {elapsed:6.2f}s")
+
+    health = app.test_client().get('/webhooks/health').get_json()
+    subscriptions = health['subscriptions']
+    delivered = [s for s in subscriptions if s['delivery_ms']]
+    round_trip = [s['round_trip_ms']['p50'] for s in subscriptions if s['round_trip_ms']]
+    delivery = [s['delivery_ms']['p50'] for s in delivered]
+    print(f"/webhooks/health: {len(subscriptions)} subscriptions, {len(delivered)} with deliveries, "
+          f"{health['awaiting_delivery']} awaiting delivery, "
+          f"{sum(s['failures'] for s in subscriptions)} failures")
+    print(f"ping round trip p50 across subscriptions {percentile(round_trip, 50):.1f} ms, "
+          f"delivery p50 {percentile(delivery, 50):.1f} ms, p99 {percentile(delivery, 99):.1f} ms")
+    print("example:", subscriptions[0])
+    server.shutdown()
+    http_server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Memory and coalescing of the GraphiQL proxy.
+# Fetches pages of growing size through /proxy/ebury_graphql/ and reports the peak RSS growth,
+# which should stay flat as the responses are streamed, then sends concurrent identical
+# introspection queries and counts how many reached the stub.
+#
+#   python -m benchmarks.bench_proxy
+import http.client
+import resource
+import threading
+from urllib.parse import urlparse
+
+from benchmarks.common import fake_login, make_app, serve
+from benchmarks.stub_server import StubServer
+
+INTROSPECTION = b'{"query": "query IntrospectionQuery { __schema { queryType { name } } }"}'
+
+
+def peak_rss_mb():
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def fetch(base_url, method='GET', path='/proxy/ebury_graphql/', body=None):
+    parsed = urlparse(base_url)
+    conn = http.client.HTTPConnection(parsed.hostname, parsed.port)
+    conn.request(method, path, body=body, headers={'Content-Type': 'application/json'})
+    response = conn.getresponse()
+    size = 0
+    while True:
+        chunk = response.read(64 * 1024)
+        if not chunk:
+            break
+        size += len(chunk)
+    conn.close()
+    return response.status, size
+
+
+def main():
+    stub = StubServer(latency=0.2).start()
+    app = make_app(EBURY_API_URL=stub.url)
+    with app.app_context():
+        fake_login(['CLIENT0001'])
+    server, base_url = serve(app)
+
+    print(f"{'response':>10} {'received':>10} {'peak RSS growth':>16}")
+    baseline = peak_rss_mb()
+    for size_mb in (1, 10, 100, 300):
+        stub.page_size = size_mb * 1024 * 1024
+        status, size = fetch(base_url)
+        assert status == 200 and size == stub.page_size
+        print(f"{size_mb:>8}MB {size / 1024 / 1024:>8.0f}MB {peak_rss_mb() - baseline:>14.1f}MB")
+
+    before = stub.graphql_requests
+    threads = [threading.Thread(target=fetch, args=(base_url, 'POST', '/proxy/ebury_graphql/graphql', INTROSPECTION))
+               for _ in range(20)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    print(f"20 concurrent introspection queries reached the stub {stub.graphql_requests - before} time(s)")
+
+    server.shutdown()
+    stub.shutdown()
+
+
+if __name__ == '__main__':
+    main()
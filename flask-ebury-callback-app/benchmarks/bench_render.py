@@ -0,0 +1,84 @@
+# Benchmark of the dashboard page rendering (app/fragments.py) for 200 clients: for each
+# of /balance, /webhooks, /clients and /subscriptions/new, the time to answer and the
+# bytes sent when every fragment is rendered (as before the fragment cache), when the
+# page was rendered before, after one client's balances or subscriptions changed, and
+# for a browser sending If-None-Match, with the calls to the stub Ebury API made by each.
+#
+#   python -m benchmarks.bench_render
+import time
+
+from app import fragments
+from app.balances import get_balance_snapshots
+from app.cache import invalidate
+from benchmarks.common import make_app, fake_login
+from benchmarks.stub_server import StubServer
+
+CLIENTS = [f'CLIENT{i:04d}' for i in range(200)]
+PAGES = ['/balance', '/webhooks', '/clients', '/subscriptions/new']
+REPEAT = 20
+
+
+def timed(client, server, path, headers=None):
+    server.calls.clear()
+    best = float('inf')
+    for _ in range(REPEAT):
+        start = time.perf_counter()
+        response = client.get(path, headers=headers or {})
+        best = min(best, time.perf_counter() - start)
+    return best, response, sum(server.calls.values()) / REPEAT
+
+
+def change_one(app, path, round_):
+    client_id = CLIENTS[round_ % len(CLIENTS)]
+    with app.app_context():
+        if path == '/balance':
+            get_balance_snapshots().apply({client_id: [{'amount': {'currency': 'GBP', 'amount': float(round_)}}]})
+        else:
+            invalidate('webhooks', client_id)
+
+
+def main():
+    server = StubServer(latency=0.0).start()
+    app = make_app(EBURY_API_URL=server.url, EBURY_EVENT_STORE_PATH=':memory:',
+                   EBURY_CACHE_TTLS={'balances': 3600, 'webhooks': 3600})
+    with app.app_context():
+        fake_login(CLIENTS)
+    client = app.test_client()
+    print(f"{len(CLIENTS)} clients, best of {REPEAT}")
+    print(f"{'page':20s} {'case':22s} {'ms':>8s} {'bytes':>8s} {'api calls':>10s}")
+    for path in PAGES:
+        client.get(path)  # load the data cache
+
+        # every fragment rendered, as it was before the fragment cache
+        best = float('inf')
+        for _ in range(REPEAT):
+            fragments._cache = None
+            start = time.perf_counter()
+            response = client.get(path)
+            best = min(best, time.perf_counter() - start)
+        rows = [('full render', best, response, 0.0)]
+        rows.append(('rendered before',) + timed(client, server, path))
+
+        # one client changed between loads, for the pages with a fragment per client
+        if path in ('/balance', '/webhooks'):
+            best = float('inf')
+            server.calls.clear()
+            for round_ in range(REPEAT):
+                change_one(app, path, round_)
+                start = time.perf_counter()
+                response = client.get(path)
+                best = min(best, time.perf_counter() - start)
+            rows.append(('one client changed', best, response, sum(server.calls.values()) / REPEAT))
+
+        etag = response.headers['ETag']
+        rows.append(('If-None-Match',) + timed(client, server, path, {'If-None-Match': etag}))
+        for case, elapsed, response, calls in rows:
+            print(f"{path:20s} {case:22s} {elapsed * 1000:8.2f} {len(response.data):8d} {calls:10.1f}"
+                  + (' (304)' if response.status_code == 304 else ''))
+    with app.app_context():
+        print("fragments:", fragments.get_fragment_cache().snapshot())
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
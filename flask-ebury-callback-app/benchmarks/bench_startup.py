@@ -0,0 +1,110 @@
+# Benchmark of starting the app with 4 gunicorn workers, each creating the app itself
+# against the app created once in the master and forked (gunicorn.conf.py, see
+# app/startup.py): time from starting gunicorn to the first answered request, the first
+# /subscriptions/new of every worker (token, client directory and subscription types
+# from a stub Ebury API with 50ms latency), and the memory of each worker: RSS and PSS
+# (the shared pages split between the processes sharing them).
+#
+#   python -m benchmarks.bench_startup
+import http.client
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from app.credential_store import SqliteCredentialStore
+from app.ebury_api import process_token_response
+from benchmarks.common import percentile
+from benchmarks.stub_server import StubServer, make_token_response
+
+WORKERS = 4
+PORT = 5099
+LATENCY = 0.05
+
+
+def get(path):
+    conn = http.client.HTTPConnection('127.0.0.1', PORT, timeout=10)
+    try:
+        start = time.perf_counter()
+        conn.request('GET', path)
+        response = conn.getresponse()
+        response.read()
+        return response.status, time.perf_counter() - start
+    finally:
+        conn.close()
+
+
+def workers_of(pid):
+    with open(f'/proc/{pid}/task/{pid}/children') as f:
+        return [int(child) for child in f.read().split()]
+
+
+def memory_kb(pid):
+    rss = pss = 0
+    with open(f'/proc/{pid}/smaps_rollup') as f:
+        for line in f:
+            if line.startswith('Rss:'):
+                rss = int(line.split()[1])
+            elif line.startswith('Pss:'):
+                pss = int(line.split()[1])
+    return rss, pss
+
+
+def run(name, args, env):
+    start = time.perf_counter()
+    process = subprocess.Popen([sys.executable, '-m', 'gunicorn', *args, 'app:create_app()'], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while True:
+            try:
+                status, _ = get('/health')
+                if status == 200:
+                    break
+            except OSError:
+                pass
+            time.sleep(0.005)
+        first_request = time.perf_counter() - start
+        while len(workers_of(process.pid)) < WORKERS:
+            time.sleep(0.01)
+        workers_ready = time.perf_counter() - start
+
+        # new connections, so every worker gets some of them
+        latencies = [get('/subscriptions/new')[1] for _ in range(WORKERS * 4)]
+        memory = [memory_kb(pid) for pid in workers_of(process.pid)]
+        master_rss, master_pss = memory_kb(process.pid)
+    finally:
+        process.terminate()
+        process.wait()
+    print(f"{name:12s} first request {first_request * 1000:7.0f} ms  all workers {workers_ready * 1000:7.0f} ms  "
+          f"/subscriptions/new max {max(latencies) * 1000:6.1f} ms p50 {percentile(latencies, 50) * 1000:5.1f} ms")
+    print(f"{'':12s} worker RSS {sum(rss for rss, _ in memory) / len(memory) / 1024:6.1f} MB  "
+          f"PSS {sum(pss for _, pss in memory) / len(memory) / 1024:6.1f} MB  "
+          f"master RSS {master_rss / 1024:6.1f} MB  total PSS {(sum(pss for _, pss in memory) + master_pss) / 1024:6.1f} MB")
+
+
+def main():
+    server = StubServer(latency=LATENCY, client_count=50).start()
+    with tempfile.TemporaryDirectory() as tmp:
+        credentials = os.path.join(tmp, 'credentials.db')
+        SqliteCredentialStore(credentials).save(process_token_response(make_token_response('token', 50)))
+        env = dict(os.environ,
+                   FLASK_EBURY_API_URL=server.url + '/',
+                   FLASK_EBURY_CREDENTIAL_STORE='sqlite',
+                   FLASK_EBURY_CREDENTIAL_STORE_PATH=credentials,
+                   FLASK_EBURY_EVENT_STORE_PATH=os.path.join(tmp, 'events.db'),
+                   FLASK_EBURY_LOG_LEVEL='WARNING',
+                   EBURY_BIND=f'127.0.0.1:{PORT}',
+                   WEB_CONCURRENCY=str(WORKERS))
+        print(f"{WORKERS} workers, stub latency {LATENCY * 1000:.0f} ms")
+        # gunicorn reads ./gunicorn.conf.py unless given another config file
+        no_config = os.path.join(tmp, 'none.conf.py')
+        open(no_config, 'w').close()
+        run('no preload', ['-c', no_config, '-w', str(WORKERS), '-b', f'127.0.0.1:{PORT}'],
+            dict(env, FLASK_EBURY_PRELOAD='false'))
+        run('preload', ['-c', 'gunicorn.conf.py'], env)
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
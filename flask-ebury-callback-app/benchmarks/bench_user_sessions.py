@@ -0,0 +1,83 @@
+# Benchmark of 100 operators using the app at once (app/user_tokens.py): each logs in
+# through /auth_callback with their own browser session and then loads /balance over and
+# over, with tokens short lived enough to be renewed several times during the run.
+# Compares EBURY_USER_SESSIONS (a token per operator) with one token for the whole app,
+# where every login replaces the token everybody else is using.
+#
+#   python -m benchmarks.bench_user_sessions
+import threading
+import time
+
+import requests
+
+from app import ebury_api, user_tokens
+from benchmarks.common import make_app, percentile, serve
+from benchmarks.stub_server import StubServer
+
+USERS = 100
+DURATION = 8
+# the token is used for expires_in - 60 seconds and renewed REFRESH_AHEAD before that
+EXPIRES_IN = 66
+REFRESH_AHEAD = 3
+
+
+def run(sessions):
+    server = StubServer(latency=0.005, token_latency=0.1, client_count=2, expires_in=EXPIRES_IN).start()
+    app = make_app(EBURY_API_URL=server.url, EBURY_AUTHENTICATION_URL=server.url, EBURY_CACHE_TTLS={},
+                   EBURY_EVENT_STORE_PATH=':memory:', EBURY_USER_SESSIONS=sessions,
+                   EBURY_TOKEN_REFRESH_AHEAD=REFRESH_AHEAD, EBURY_TOKEN_REFRESH_JITTER=0,
+                   SECRET_KEY='bench')
+    # a fresh app token and registry for each run
+    ebury_api.token_manager._store = None
+    user_tokens._registry = None
+    http_server, base_url = serve(app)
+
+    browsers = [requests.Session() for _ in range(USERS)]
+    for i, browser in enumerate(browsers):
+        browser.get(f'{base_url}/auth_callback', params={'code': f'user-{i}'}, allow_redirects=False)
+    logins = server.token_requests
+
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    stop = time.monotonic() + DURATION
+
+    def operator(browser):
+        while time.monotonic() < stop:
+            start = time.perf_counter()
+            response = browser.get(f'{base_url}/balance')
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status_code != 200:
+                    errors[0] += 1
+
+    threads = [threading.Thread(target=operator, args=(browser,)) for browser in browsers]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    if sessions:
+        with app.app_context():
+            registry = user_tokens.get_user_tokens()
+            tokens = {registry.store.load_user(user_id)[0].access_token for user_id in list(registry._users)}
+        in_use = f"{len(tokens)} tokens in use for {len(registry)} operators"
+    else:
+        in_use = f"1 token in use, {logins - 1} of the {logins} logins replaced it for everybody"
+    print(f"{'a token per operator' if sessions else 'one app token':22s} "
+          f"{len(latencies) / DURATION:7.1f} req/s  p50 {percentile(latencies, 50) * 1000:6.1f} ms  "
+          f"p99 {percentile(latencies, 99) * 1000:7.1f} ms  errors {errors[0]}  "
+          f"token renewals {server.token_requests - logins}  {in_use}")
+    http_server.shutdown()
+    server.shutdown()
+
+
+def main():
+    print(f"{USERS} operators for {DURATION}s, tokens renewed every {EXPIRES_IN - 60 - REFRESH_AHEAD}s")
+    run(True)
+    run(False)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,38 @@
+# Microbenchmark of webhook signature verification per request, comparing the
+# original approach (new HMAC per request over url + body concatenated) with WebhookVerifier.
+#
+#   python -m benchmarks.bench_verify
+import hashlib
+import hmac
+import os
+import timeit
+
+from app.webhook_verifier import WebhookVerifier
+
+SECRET = 'your webhook secret'
+URL = 'https://example.ngrok.app/callback'
+
+
+def original(url, body, signature):
+    received_hash = signature.split("=", 1)[1]
+    payload = url.encode('utf-8') + body
+    computed_hash = hmac.new(key=SECRET.encode('utf-8'), msg=payload, digestmod=hashlib.sha3_256).hexdigest()
+    return hmac.compare_digest(received_hash, computed_hash)
+
+
+def main():
+    verifier = WebhookVerifier([SECRET])
+    print(f"{'payload':>8} {'original us':>12} {'verifier us':>12} {'speedup':>8}")
+    for size in (1024, 16 * 1024, 256 * 1024, 1024 * 1024):
+        body = os.urandom(size)
+        signature = 'sha3-256=' + hmac.new(SECRET.encode(), URL.encode() + body, hashlib.sha3_256).hexdigest()
+        assert original(URL, body, signature) and verifier.verify(URL, body, signature)
+
+        number = max(10, 20000000 // size)
+        before = min(timeit.repeat(lambda: original(URL, body, signature), number=number, repeat=5)) / number
+        after = min(timeit.repeat(lambda: verifier.verify(URL, body, signature), number=number, repeat=5)) / number
+        print(f"{size // 1024:>6}KB {before * 1e6:>12.1f} {after * 1e6:>12.1f} {before / after:>7.2f}x")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,53 @@
+# Latency of loading every client's webhook subscriptions (the /webhooks page) for 100 clients,
+# one query after another as before, against the concurrent GraphQL layer.
+#
+#   python -m benchmarks.bench_webhook_subscriptions
+import time
+
+from app import ebury_api
+from benchmarks.common import fake_login, make_app
+from benchmarks.stub_server import StubServer
+
+CLIENTS = 100
+LATENCY = 0.05
+
+
+def sequential(client_ids):
+    # what get_webhook_subscriptions used to do
+    return {client_id: ebury_api.get_client_webhook_subscriptions(client_id) for client_id in client_ids}
+
+
+def main():
+    server = StubServer(latency=LATENCY, subscriptions_per_client=250).start()
+    app = make_app(EBURY_API_URL=server.url, EBURY_CACHE_TTLS={})
+    client_ids = [f'CLIENT{i:04d}' for i in range(CLIENTS)]
+
+    with app.app_context():
+        fake_login(client_ids)
+        print(f"{CLIENTS} clients, 250 subscriptions each in pages of {app.config['EBURY_GRAPHQL_PAGE_SIZE']}, "
+              f"stub latency {LATENCY * 1000:.0f} ms")
+
+        start = time.perf_counter()
+        before = sequential(client_ids)
+        print(f"sequential: {time.perf_counter() - start:.2f}s")
+
+        for concurrency in (4, 16, 32):
+            app.config['EBURY_MAX_CONCURRENCY'] = concurrency
+            start = time.perf_counter()
+            after = ebury_api.get_webhook_subscriptions()
+            print(f"concurrent ({concurrency} in flight): {time.perf_counter() - start:.2f}s")
+        assert after == before
+
+        start = time.perf_counter()
+        ebury_api.get_subscription_types()
+        first = time.perf_counter() - start
+        start = time.perf_counter()
+        ebury_api.get_subscription_types()
+        print(f"subscription types: first load {first * 1000:.1f} ms, "
+              f"then {(time.perf_counter() - start) * 1000:.3f} ms from the process cache")
+
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
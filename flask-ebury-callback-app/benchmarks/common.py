@@ -0,0 +1,63 @@
+# Helpers shared by the benchmarks
+import threading
+import time
+from flask import Flask
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from app import socketio
+from app.config import Config
+
+
+# Build the app the same way create_app does, with config overrides for the benchmark
+def make_app(**overrides):
+    app = Flask('app')
+    app.config.from_object(Config)
+    app.config.update(overrides)
+    from app.log import configure_logging
+    configure_logging(app.config)
+    from app import routes
+    app.register_blueprint(routes.bp)
+    socketio.init_app(app)
+    return app
+
+
+# Pretend to be logged in with the given clients, so no auth calls are made
+def fake_login(client_ids, expires_in=3600):
+    from app.ebury_api import token_manager
+    from app.token_manager import TokenState
+    clients = [{'client_id': client_id, 'client_name': client_id} for client_id in client_ids]
+    token_manager.set_state(TokenState('token', None, time.time() + expires_in, clients))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+# Fields of /proc/<pid>/status, e.g. VmRSS and VmHWM (peak RSS) in KB, and Threads
+def proc_status(pid):
+    status = {}
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            name, _, value = line.partition(':')
+            value = value.split()
+            status[name] = value[0] if value else ''
+    return status
+
+
+class KeepAliveRequestHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_request(self, *args, **kwargs):
+        pass
+
+
+# Serve a WSGI app on a background thread, returns (server, base url)
+def serve(app, port=0):
+    server = make_server('127.0.0.1', port, app, threaded=True, request_handler=KeepAliveRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f'http://127.0.0.1:{server.server_port}'
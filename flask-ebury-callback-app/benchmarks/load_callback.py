@@ -0,0 +1,75 @@
+# Load test of /callback: sends signed webhooks at a target rate and reports how fast
+# they are acknowledged. By default a local instance is started in this process,
+# pass --url to point it at an instance that is already running.
+#
+#   python -m benchmarks.load_callback --rate 3000 --seconds 5
+import argparse
+import threading
+import time
+
+from benchmarks.common import make_app, percentile, serve
+from benchmarks.webhook_generator import WebhookGenerator
+
+SECRET = 'load-test-secret'
+
+
+def sender(generator, rate, seconds, results):
+    interval = 1.0 / rate if rate else 0
+    next_send = time.perf_counter()
+    end = next_send + seconds
+    while True:
+        now = time.perf_counter()
+        if now >= end:
+            break
+        if now < next_send:
+            time.sleep(next_send - now)
+        next_send += interval
+        body = generator.payload('CLIENT0001', 'load_test')
+        status, latency = generator.send(body, 'CLIENT0001', 'load_test')
+        results.append((latency, status))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--url', help='base url of a running instance')
+    parser.add_argument('--rate', type=int, default=3000, help='target webhooks per second')
+    parser.add_argument('--seconds', type=float, default=5)
+    parser.add_argument('--connections', type=int, default=16)
+    args = parser.parse_args()
+
+    app = None
+    base_url = args.url
+    if base_url is None:
+        app = make_app(EBURY_WEBHOOK_SECRET=SECRET)
+        server, base_url = serve(app)
+
+    generator = WebhookGenerator(base_url + '/callback', SECRET)
+    results = []
+    threads = [
+        threading.Thread(target=sender, args=(generator, args.rate / args.connections, args.seconds, results))
+        for _ in range(args.connections)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    acks = [latency for latency, status in results if status == 200]
+    busy = sum(1 for _, status in results if status == 503)
+    print(f"sent {len(results)} webhooks in {elapsed:.2f}s ({len(results) / elapsed:.0f}/s, target {args.rate}/s)")
+    print(f"acked {len(acks)}, rejected busy {busy}")
+    print(f"ack latency ms: p50 {percentile(acks, 50) * 1000:.2f}  p99 {percentile(acks, 99) * 1000:.2f}  "
+          f"max {max(acks, default=0) * 1000:.2f}")
+
+    if app is not None:
+        from app.webhook_queue import get_webhook_queue
+        with app.app_context():
+            get_webhook_queue().join()
+            print("webhook queue:", get_webhook_queue().snapshot())
+        server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
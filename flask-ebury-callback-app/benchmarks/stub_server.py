@@ -0,0 +1,269 @@
+# A local stand-in for the Ebury auth server and API used by the benchmarks.
+# Every request sleeps for `latency` seconds before answering, so wall time
+# measured against it is dominated by round-trips, like against the sandbox.
+# A share of the API calls (error_rate) fail with a 500, and pings deliver a signed
+# PING webhook to callback_url when it is set. `fault` can inject other failures:
+# it is called with (method, path) and returns None, a status to answer with,
+# ('hang', seconds) to wait before answering, or 'reset' to drop the connection.
+# With a `token_gate` event /token answers only once it is set, and sets
+# `token_held` while a call waits on it.
+#
+# It can also be run on its own, with the app's EBURY_AUTHENTICATION_URL and
+# EBURY_API_URL pointed at it:
+#
+#   python -m benchmarks.stub_server --port 8081 --latency 0.05 --clients 20
+import argparse
+from collections import Counter
+import json
+import random
+import re
+import socket
+import threading
+from base64 import urlsafe_b64encode
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlencode, urlparse, parse_qs
+
+from benchmarks.webhook_generator import WebhookGenerator
+
+
+MUTATION_FIELD = re.compile(r'(?:(\w+)\s*:\s*)?(createSubscription|updateSubscription|deleteSubscription)'
+                            r'\s*\(\s*input\s*:\s*\$(\w+)\s*\)')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def send_json(self, status, body):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    # An HTML page of `size` bytes written in chunks, standing in for the GraphiQL page
+    def send_page(self, size):
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/html')
+        self.send_header('Content-Length', str(size))
+        self.end_headers()
+        chunk = b'<!-- graphiql -->' * 4096
+        while size > 0:
+            self.wfile.write(chunk[:size])
+            size -= len(chunk)
+
+    # True when this call should fail, by `fault` or error_rate, and the answer has been sent
+    def send_fault(self):
+        path = urlparse(self.path).path
+        with self.server.lock:
+            self.server.calls[path] += 1
+        fault = self.server.fault(self.command, path) if self.server.fault else None
+        if fault == 'reset':
+            self.close_connection = True
+            self.connection.shutdown(socket.SHUT_RDWR)
+            return True
+        if isinstance(fault, tuple) and fault[0] == 'hang':
+            time.sleep(fault[1])
+        elif isinstance(fault, int):
+            with self.server.lock:
+                self.server.faults += 1
+            self.send_json(fault, {'error': 'injected fault'})
+            return True
+        if self.server.should_fail():
+            self.send_json(500, {'error': 'simulated failure'})
+            return True
+        return False
+
+    def do_GET(self):
+        time.sleep(self.server.latency)
+        parsed = urlparse(self.path)
+        if self.send_fault():
+            return
+        if parsed.path == '/webhooks/':
+            self.send_page(self.server.page_size)
+        elif parsed.path == '/balances':
+            client_id = parse_qs(parsed.query).get('client_id', [''])[0]
+            amounts = self.server.balances.get(client_id) or {'GBP': 100.0}
+            self.send_json(200, [{'amount': {'currency': currency, 'amount': amount}, 'client_id': client_id}
+                                 for currency, amount in amounts.items()])
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def do_POST(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length)
+        path = urlparse(self.path).path
+        if path == '/login':
+            # the login form redirects to the redirect url with a code
+            time.sleep(self.server.token_latency)
+            form = parse_qs(body.decode())
+            query = urlencode({'code': 'code-' + form.get('email', [''])[0],
+                               'state': form.get('state', [''])[0]})
+            self.send_response(302)
+            self.send_header('Location', 'http://127.0.0.1/auth_callback?' + query)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if path == '/token':
+            time.sleep(self.server.token_latency)
+            if self.server.token_gate is not None:
+                self.server.token_held.set()
+                self.server.token_gate.wait()
+            with self.server.lock:
+                self.server.token_requests += 1
+                number = self.server.token_requests
+            self.send_json(200, make_token_response(f'token-{number}', self.server.client_count,
+                                                    self.server.expires_in))
+            return
+        time.sleep(self.server.latency)
+        if self.send_fault():
+            return
+        if path.startswith('/webhooks/ping/'):
+            subscription_id = path[len('/webhooks/ping/'):]
+            self.send_response(204)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            self.server.deliver_ping(subscription_id, self.headers.get('X-Client-ID', ''))
+        elif path == '/webhooks/graphql':
+            with self.server.lock:
+                self.server.graphql_requests += 1
+            self.send_json(200, self.graphql(json.loads(body or b'{}')))
+        else:
+            self.send_json(200, {'data': {}})
+
+    def graphql(self, request):
+        query = request.get('query', '')
+        variables = request.get('variables') or {}
+        client_id = self.headers.get('X-Client-ID', '')
+        if '__schema' in query:
+            time.sleep(self.server.latency)
+            return {'data': {'__schema': {'queryType': {'name': 'Query'}}}}
+        if '__type' in query:
+            return {'data': {'__type': {'name': 'WebhookType', 'enumValues': [{'name': 'PING'}, {'name': 'PAYMENT'}]},
+                             'webhookTypes': ['PING', 'PAYMENT']}}
+        if 'subscriptions' in query:
+            total = self.server.subscriptions_per_client
+            start = int(variables.get('after') or 0)
+            end = min(total, start + (variables.get('first') or total))
+            nodes = [{'id': f'{client_id}-sub-{i}', 'clientId': client_id, 'createdAt': '2024-01-01T00:00:00Z',
+                      'url': 'https://example.com/callback', 'active': True, 'types': ['PING']}
+                     for i in range(start, end)]
+            return {'data': {'subscriptions': {'totalCount': total, 'nodes': nodes,
+                                               'pageInfo': {'hasNextPage': end < total, 'endCursor': str(end)}}}}
+        return self.mutations(query, variables)
+
+    # Mutations, aliased ones too. A subscription id of 'missing' gives an error for that field.
+    def mutations(self, query, variables):
+        data = {}
+        errors = []
+        for alias, field, variable in MUTATION_FIELD.findall(query):
+            key = alias or field
+            mutation_input = variables.get(variable) or {}
+            if mutation_input.get('id') == 'missing':
+                data[key] = None
+                errors.append({'message': 'Subscription not found', 'path': [key]})
+            elif field == 'createSubscription':
+                with self.server.lock:
+                    self.server.created += 1
+                    number = self.server.created
+                data[key] = {'subscription': dict(mutation_input.get('subscription') or {}, id=f'new-{number}')}
+            else:
+                data[key] = {'subscription': dict(mutation_input.get('patch') or {}, id=mutation_input.get('id'))}
+        result = {'data': data}
+        if errors:
+            result['errors'] = errors
+        return result
+
+
+# Token endpoint response with an id_token carrying the `clients` claim
+def make_token_response(access_token, client_count, expires_in=3600):
+    claims = {'clients': [{'client_id': f'CLIENT{i:04d}', 'client_name': f'Client {i}'} for i in range(client_count)]}
+    payload = urlsafe_b64encode(json.dumps(claims).encode()).decode().rstrip('=')
+    return {
+        'access_token': access_token,
+        'refresh_token': f'refresh-{access_token}',
+        'expires_in': expires_in,
+        'id_token': f'header.{payload}.signature',
+    }
+
+
+class StubServer(ThreadingHTTPServer):
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, latency=0.05, handler=StubHandler, port=0, token_latency=None, client_count=10,
+                 expires_in=3600, subscriptions_per_client=3, page_size=4096, error_rate=0.0,
+                 callback_url=None, webhook_secret='', seed=0, fault=None, token_gate=None):
+        super().__init__(('127.0.0.1', port), handler)
+        self.latency = latency
+        self.error_rate = error_rate
+        self.fault = fault
+        self.faults = 0
+        self.calls = Counter()
+        self.created = 0
+        # {client_id: {currency: amount}} to answer /balances with, GBP 100 for the others
+        self.balances = {}
+        # seeded, so the same calls fail on every run
+        self.random = random.Random(seed)
+        self.webhooks = WebhookGenerator(callback_url, webhook_secret) if callback_url else None
+        self.pings = 0
+        self.token_latency = latency if token_latency is None else token_latency
+        self.client_count = client_count
+        self.expires_in = expires_in
+        self.subscriptions_per_client = subscriptions_per_client
+        self.page_size = page_size
+        self.token_requests = 0
+        self.token_gate = token_gate
+        self.token_held = threading.Event()
+        self.graphql_requests = 0
+        self.lock = threading.Lock()
+
+    def should_fail(self):
+        if not self.error_rate:
+            return False
+        with self.lock:
+            return self.random.random() < self.error_rate
+
+    # Ebury answers the ping and then calls the subscription's url, like it does here
+    def deliver_ping(self, subscription_id, client_id):
+        with self.lock:
+            self.pings += 1
+        if self.webhooks is not None:
+            body = self.webhooks.payload(client_id, 'PING', subscription_id=subscription_id)
+            threading.Thread(target=self.webhooks.send, args=(body, client_id, 'PING', subscription_id),
+                             daemon=True).start()
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_address[1]}/'
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--port', type=int, default=8081, help='0 picks a free port')
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per call')
+    parser.add_argument('--error-rate', type=float, default=0.0, help='share of API calls that fail with a 500')
+    parser.add_argument('--clients', type=int, default=10, help='clients in the clients claim of the token')
+    parser.add_argument('--expires-in', type=int, default=3600, help='token lifetime in seconds')
+    parser.add_argument('--callback-url', help='where pings deliver their webhook, e.g. http://127.0.0.1:5001/callback')
+    parser.add_argument('--webhook-secret', default='')
+    args = parser.parse_args()
+
+    server = StubServer(latency=args.latency, port=args.port, client_count=args.clients,
+                        expires_in=args.expires_in, error_rate=args.error_rate,
+                        callback_url=args.callback_url, webhook_secret=args.webhook_secret)
+    print(server.url, flush=True)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,173 @@
+# End to end benchmark suite: runs the app against the Ebury simulator (stub_server.py),
+# each in its own process, and drives /balance, /webhooks, /callback and the token
+# exchange (/auth_callback) in turn. Reports throughput, p50/p99 latency and the app's
+# RSS for each, and can save them as JSON and compare a run with a saved one.
+#
+#   python -m benchmarks.suite --json baseline.json
+#   python -m benchmarks.suite --baseline baseline.json
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import requests
+
+from benchmarks.common import make_app, percentile, proc_status, serve
+from benchmarks.webhook_generator import WebhookGenerator
+
+SECRET = 'suite-secret'
+
+
+def run_app(simulator_url):
+    from app import ebury_api
+    app = make_app(
+        EBURY_AUTHENTICATION_URL=simulator_url,
+        EBURY_API_URL=simulator_url,
+        EBURY_WEBHOOK_SECRET=SECRET,
+        # measure the upstream calls, not the cache
+        EBURY_CACHE_TTLS={},
+        # keep a connection for every call the concurrent page loads can have in flight
+        EBURY_HTTP_POOL_SIZE=256,
+        EBURY_TOKEN_REFRESH_AHEAD=5,
+        EBURY_TOKEN_REFRESH_JITTER=1,
+        EBURY_EVENT_STORE_PATH=os.path.join(tempfile.mkdtemp(), 'events.db'),
+    )
+    # log in through the simulator's /login and /token like the host to host login does
+    with app.app_context():
+        ebury_api.get_ebury_token(ebury_api.login_ebury())
+    server, base_url = serve(app)
+    print(base_url, flush=True)
+    # nobody reads the app's logs here
+    os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    threading.Event().wait()
+
+
+def spawn(module, *args):
+    process = subprocess.Popen([sys.executable, '-m', module, *args], stdout=subprocess.PIPE, text=True)
+    return process, process.stdout.readline().strip()
+
+
+# Call request() from `concurrency` threads for `duration` seconds,
+# request returns the response status and None when it failed to connect
+def drive(request, concurrency, duration):
+    latencies = []
+    errors = 0
+    lock = threading.Lock()
+    stop = time.perf_counter() + duration
+
+    def worker():
+        nonlocal errors
+        session = requests.Session()
+        while time.perf_counter() < stop:
+            start = time.perf_counter()
+            status = request(session)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if status is None or status >= 400:
+                    errors += 1
+
+    workers = [threading.Thread(target=worker, daemon=True) for _ in range(concurrency)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    return latencies, errors
+
+
+def scenarios(base_url):
+    generator = WebhookGenerator(base_url + '/callback', SECRET)
+
+    def balance(session):
+        return session.get(base_url + '/balance').status_code
+
+    def webhooks(session):
+        return session.get(base_url + '/webhooks').status_code
+
+    def callback(session):
+        body = generator.payload('CLIENT0001', 'PAYMENT', size=1024)
+        status, _ = generator.send(body, 'CLIENT0001', 'PAYMENT')
+        return status
+
+    def token(session):
+        # exchanging a login code for a token, the page then redirects to /clients
+        return session.get(base_url + '/auth_callback', params={'code': 'suite'}, allow_redirects=False).status_code
+
+    return {'balance': balance, 'webhooks': webhooks, 'callback': callback, 'token': token}
+
+
+def compare(results, baseline):
+    print(f"\n{'scenario':>10} {'req/s':>9} {'p50':>9} {'p99':>9} {'rss':>9}   (change from baseline)")
+    for name, result in results['scenarios'].items():
+        before = baseline['scenarios'].get(name)
+        if not before:
+            continue
+        changes = [
+            (result[key] - before[key]) / before[key] * 100 if before[key] else 0.0
+            for key in ('rps', 'p50_ms', 'p99_ms', 'rss_mb')
+        ]
+        print(f"{name:>10} " + " ".join(f"{change:>+8.1f}%" for change in changes))
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--serve-app', help=argparse.SUPPRESS)
+    parser.add_argument('--duration', type=float, default=5, help='seconds per scenario')
+    parser.add_argument('--concurrency', type=int, default=16)
+    parser.add_argument('--latency', type=float, default=0.02, help='simulator latency per call')
+    parser.add_argument('--error-rate', type=float, default=0.0)
+    parser.add_argument('--clients', type=int, default=20)
+    parser.add_argument('--scenarios', nargs='+', default=['balance', 'webhooks', 'callback', 'token'])
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--baseline', help='compare with results saved by --json')
+    args = parser.parse_args()
+    if args.serve_app:
+        return run_app(args.serve_app)
+
+    # tokens are usable for expires_in - 60 seconds, so they are renewed in the
+    # background during the run
+    simulator, simulator_url = spawn('benchmarks.stub_server', '--port', '0', '--latency', str(args.latency),
+                                     '--error-rate', str(args.error_rate), '--clients', str(args.clients),
+                                     '--expires-in', '75')
+    app, base_url = spawn('benchmarks.suite', '--serve-app', simulator_url)
+    results = {'scenarios': {}}
+    try:
+        print(f"{args.clients} clients, simulator latency {args.latency * 1000:.0f} ms, error rate {args.error_rate}, "
+              f"{args.concurrency} connections, {args.duration}s per scenario")
+        print(f"{'scenario':>10} {'requests':>9} {'req/s':>9} {'p50 ms':>9} {'p99 ms':>9} {'errors':>7} {'rss MB':>8}")
+        available = scenarios(base_url)
+        for name in args.scenarios:
+            latencies, errors = drive(available[name], args.concurrency, args.duration)
+            rss = int(proc_status(app.pid)['VmRSS']) / 1024
+            r = results['scenarios'][name] = {
+                'requests': len(latencies),
+                'rps': round(len(latencies) / args.duration, 1),
+                'p50_ms': round(percentile(latencies, 50) * 1000, 2),
+                'p99_ms': round(percentile(latencies, 99) * 1000, 2),
+                'errors': errors,
+                'rss_mb': round(rss, 1),
+            }
+            print(f"{name:>10} {r['requests']:>9} {r['rps']:>9.1f} {r['p50_ms']:>9.2f} {r['p99_ms']:>9.2f} "
+                  f"{r['errors']:>7} {r['rss_mb']:>8.1f}")
+        token_stats = requests.get(base_url + '/stats').json()['token']
+        print(f"token renewals: {token_stats['background_refreshes']} background, "
+              f"{token_stats['blocking_refreshes']} blocking, {token_stats['failed_refreshes']} failed")
+        results['peak_rss_mb'] = round(int(proc_status(app.pid)['VmHWM']) / 1024, 1)
+        print(f"peak rss {results['peak_rss_mb']} MB")
+    finally:
+        app.kill()
+        simulator.kill()
+
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            compare(results, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
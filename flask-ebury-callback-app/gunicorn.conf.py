@@ -0,0 +1,25 @@
+# Production start up, with the app created once and forked into the workers:
+#
+#   gunicorn -c gunicorn.conf.py "app:create_app()"
+#
+# The config is app/config.py, overridden by the file named in EBURY_SETTINGS and by
+# FLASK_ prefixed environment variables, e.g. FLASK_EBURY_API_URL. Use the shared
+# credential store (FLASK_EBURY_CREDENTIAL_STORE=sqlite) so the token loaded before the
+# fork is the one all the workers keep using.
+#
+# Socket.IO runs in its threading mode (see app/__init__.py), where every long-poll and
+# websocket holds a thread for as long as it is open, so the workers are threaded.
+# One worker by default: Socket.IO needs every request of a connection to reach the
+# worker that accepted it, which gunicorn doesn't do. Only set WEB_CONCURRENCY higher
+# behind a proxy with sticky sessions, or with browsers connecting over websockets only
+# (see the README).
+import os
+
+bind = os.environ.get('EBURY_BIND', '127.0.0.1:5001')
+workers = int(os.environ.get('WEB_CONCURRENCY', 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('EBURY_THREADS', 32))
+preload_app = True
+
+# tells create_app it runs in the master, see app/startup.py
+os.environ.setdefault('FLASK_EBURY_PRELOAD', 'true')
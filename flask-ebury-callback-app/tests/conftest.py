@@ -0,0 +1,48 @@
+# Fixtures shared by the tests: the app built as in the benchmarks, against the
+# Ebury stub from benchmarks/stub_server.py
+import pytest
+
+from app import async_runtime, http_client, resilience
+from benchmarks.common import make_app, fake_login
+from benchmarks.stub_server import StubServer
+
+CLIENTS = [f'CLIENT{i:04d}' for i in range(8)]
+
+
+# New process wide policy, clients and async runtime, so circuits and the retry
+# budget start afresh in each test
+@pytest.fixture(autouse=True)
+def fresh_upstream():
+    resilience._policy = None
+    http_client._client = None
+    yield
+    if async_runtime._runtime is not None:
+        async_runtime._runtime.close()
+        async_runtime._runtime = None
+    resilience._policy = None
+    http_client._client = None
+
+
+# Starts the stub with a fault and an app logged in with its clients:
+#   server, app = stub_app(fault, clients, **config)
+@pytest.fixture
+def stub_app(tmp_path):
+    servers = []
+
+    def start(fault=None, clients=CLIENTS, **config):
+        server = StubServer(latency=0.005, fault=fault).start()
+        servers.append(server)
+        app = make_app(
+            EBURY_API_URL=server.url,
+            EBURY_AUTHENTICATION_URL=server.url,
+            EBURY_CACHE_TTLS={},
+            EBURY_EVENT_STORE_PATH=str(tmp_path / 'events.db'),
+            **config,
+        )
+        with app.app_context():
+            fake_login(clients)
+        return server, app
+
+    yield start
+    for server in servers:
+        server.shutdown()
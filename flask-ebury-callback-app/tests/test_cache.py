@@ -0,0 +1,92 @@
+# Loads of the API response cache (see app/cache.py): one load per key in flight,
+# and invalidations that only affect the keys they match
+import asyncio
+import threading
+
+import pytest
+
+from app.cache import TTLCache
+
+
+# A loader that blocks until released, counting its calls
+class SlowLoader:
+    def __init__(self, value):
+        self.value = value
+        self.calls = 0
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def __call__(self):
+        self.calls += 1
+        self.started.set()
+        assert self.release.wait(5)
+        if isinstance(self.value, Exception):
+            raise self.value
+        return self.value
+
+
+def get_in_threads(cache, key, loader, count):
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(cache.get(key, loader, 60))) for _ in range(count)]
+    for thread in threads:
+        thread.start()
+    return threads, results
+
+
+def test_concurrent_misses_load_once():
+    cache = TTLCache()
+    loader = SlowLoader('value')
+    threads, results = get_in_threads(cache, 'key', loader, 8)
+    assert loader.started.wait(5)
+    loader.release.set()
+    for thread in threads:
+        thread.join(5)
+
+    assert results == ['value'] * 8
+    assert loader.calls == 1
+    assert cache.snapshot()['coalesced'] == 7
+    assert cache.get('key', loader, 60) == 'value'
+    assert loader.calls == 1
+
+
+def test_failed_load_is_raised_to_its_waiters_and_not_stored():
+    cache = TTLCache()
+    loader = SlowLoader(ValueError('down'))
+    loader.release.set()
+    with pytest.raises(ValueError):
+        cache.get('key', loader, 60)
+    assert cache.get('key', lambda: 'value', 60) == 'value'
+
+
+def test_invalidation_only_drops_the_loads_of_matching_keys():
+    cache = TTLCache()
+    first, second = SlowLoader('first'), SlowLoader('second')
+    first_threads, _ = get_in_threads(cache, 'first', first, 1)
+    second_threads, _ = get_in_threads(cache, 'second', second, 1)
+    assert first.started.wait(5) and second.started.wait(5)
+
+    cache.invalidate(lambda key: key == 'first')
+    first.release.set()
+    second.release.set()
+    for thread in first_threads + second_threads:
+        thread.join(5)
+
+    # the invalidated load is not stored, the other one is
+    assert cache.get('first', lambda: 'reloaded', 60) == 'reloaded'
+    assert cache.get('second', lambda: 'reloaded', 60) == 'second'
+
+
+def test_async_misses_share_a_load():
+    cache = TTLCache()
+    calls = []
+
+    async def loader():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return 'value'
+
+    async def main():
+        return await asyncio.gather(*(cache.get_async('key', loader, 60) for _ in range(8)))
+
+    assert asyncio.run(main()) == ['value'] * 8
+    assert len(calls) == 1
@@ -0,0 +1,31 @@
+# Webhook bodies are stored as the bytes they came as, next to their header info
+import sqlite3
+import time
+
+from app.event_store import EventStore
+
+
+def wait_for(store, count):
+    end = time.monotonic() + 5
+    while store.snapshot()['committed'] < count and time.monotonic() < end:
+        time.sleep(0.01)
+    assert store.snapshot()['committed'] == count
+
+
+def test_bodies_are_stored_as_bytes(tmp_path):
+    path = str(tmp_path / 'events.db')
+    store = EventStore(path)
+    header_info = {'X-EBURY-EVENT-TYPE': 'PING'}
+    store.append(b'{"id": "1"}', header_info, client_id='CLIENT0000', webhook_type='PING')
+    store.append(b'\xff not json', header_info, client_id='CLIENT0000', webhook_type='PING')
+    wait_for(store, 2)
+
+    types = [row[0] for row in sqlite3.connect(path).execute('SELECT typeof(payload) FROM events')]
+    assert types == ['blob', 'blob']
+
+    first, second = store.query(after=0)
+    assert first['payload'] == {'header info': header_info, 'id': '1'}
+    assert second['payload'] == {'header info': header_info, 'body': '\ufffd not json'}
+    raw = store.query(after=0, raw=True)
+    assert [event['body'] for event in raw] == [b'{"id": "1"}', b'\xff not json']
+    assert raw[0]['header_info'] == header_info
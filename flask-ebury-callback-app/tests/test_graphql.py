@@ -0,0 +1,44 @@
+# Paging through a client's webhook subscriptions (see app/graphql.py)
+import logging
+
+from app import graphql
+
+
+def page(nodes, cursor, has_next=True):
+    return {'data': {'subscriptions': {
+        'totalCount': 1000, 'nodes': nodes, 'pageInfo': {'hasNextPage': has_next, 'endCursor': cursor}}}}
+
+
+def fake_execute(monkeypatch, pages):
+    calls = []
+
+    def execute(access_token, client_id, document, variables=None):
+        calls.append(variables['after'])
+        return pages(len(calls))
+
+    monkeypatch.setattr(graphql, 'execute', execute)
+    return calls
+
+
+def test_all_pages_are_fetched(monkeypatch):
+    calls = fake_execute(monkeypatch, lambda number: page([{'id': number}], f'cursor-{number}', number < 3))
+    result = graphql.fetch_all_subscriptions('token', 'CLIENT0000')
+    assert calls == [None, 'cursor-1', 'cursor-2']
+    assert result['data']['subscriptions']['nodes'] == [{'id': 1}, {'id': 2}, {'id': 3}]
+
+
+def test_repeated_cursor_stops_paging(monkeypatch, caplog):
+    calls = fake_execute(monkeypatch, lambda number: page([{'id': number}], 'cursor-1'))
+    with caplog.at_level(logging.WARNING, logger='app.graphql'):
+        result = graphql.fetch_all_subscriptions('token', 'CLIENT0000')
+    assert calls == [None, 'cursor-1']
+    assert result['data']['subscriptions']['nodes'] == [{'id': 1}, {'id': 2}]
+    assert "Stopped paging" in caplog.text
+
+
+def test_paging_stops_at_max_pages(monkeypatch):
+    calls = fake_execute(monkeypatch, lambda number: page([{'id': number}], f'cursor-{number}'))
+    result = graphql.fetch_all_subscriptions('token', 'CLIENT0000', max_pages=5)
+    assert len(calls) == 5
+    assert len(result['data']['subscriptions']['nodes']) == 5
+    assert result['data']['subscriptions']['totalCount'] == 1000
@@ -0,0 +1,40 @@
+# Records are made safe to hand to the logging listener thread (see app/log.py)
+import json
+import logging
+import queue
+
+from app.log import DroppingQueueHandler, JsonFormatter
+
+
+def queued_logger(name):
+    records = queue.Queue()
+    logger = logging.getLogger(name)
+    logger.handlers[:] = [DroppingQueueHandler(records)]
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    return logger, records
+
+
+def test_message_is_rendered_when_queued():
+    logger, records = queued_logger('tests.log.message')
+    clients = ['CLIENT0000']
+    logger.info("fetching %s", clients, extra={'fields': {'client_id': 'CLIENT0000'}})
+    clients.append('CLIENT0001')
+
+    entry = json.loads(JsonFormatter().format(records.get_nowait()))
+    assert entry['message'] == "fetching ['CLIENT0000']"
+    assert entry['client_id'] == 'CLIENT0000'
+
+
+def test_exception_is_rendered_when_queued():
+    logger, records = queued_logger('tests.log.exception')
+    try:
+        raise ValueError('bad payload')
+    except ValueError:
+        logger.exception("failed")
+
+    record = records.get_nowait()
+    assert record.exc_info is None
+    entry = json.loads(JsonFormatter().format(record))
+    assert entry['message'] == 'failed'
+    assert 'ValueError: bad payload' in entry['exception']
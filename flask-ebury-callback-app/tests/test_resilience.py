@@ -0,0 +1,186 @@
+# Resilience rules for calls to the Ebury API (see app/resilience.py), against the
+# stub with injected faults: a hung endpoint, transient 503s, an endpoint that
+# always fails, connection resets and failing mutations
+import asyncio
+import time
+from urllib.parse import urlsplit
+
+import pytest
+
+from app import ebury_api, resilience
+from app.async_runtime import get_async_runtime
+from app.http_client import EburyHttpClient
+from app.resilience import CircuitBreaker, CircuitOpenError, DeadlineExceeded, UpstreamPolicy, deadline_scope
+from tests.conftest import CLIENTS
+
+
+def errors_in(balances):
+    return sum(1 for balance in balances.values() if 'error' in balance)
+
+
+@pytest.mark.parametrize('async_mode', [False, True], ids=['threads', 'async'])
+def test_hung_endpoint_answers_by_the_deadline(stub_app, async_mode):
+    server, app = stub_app(lambda method, path: ('hang', 30) if path == '/balances' else None,
+                           EBURY_REQUEST_DEADLINE=1.5, EBURY_ASYNC_MODE=async_mode)
+    start = time.perf_counter()
+    response = app.test_client().get('/balance')
+    elapsed = time.perf_counter() - start
+
+    assert response.status_code == 200
+    assert response.text.count('<div class="error">') == len(CLIENTS)
+    # the deadline plus some slack for the page itself, far below the 30s hang
+    assert elapsed < 5
+
+
+# A coroutine that doesn't end by the deadline is given up on and cancelled
+def test_async_run_ends_at_the_deadline(stub_app):
+    server, app = stub_app()
+    cancelled = asyncio.Event()
+
+    async def stuck():
+        try:
+            await asyncio.sleep(30)
+        except asyncio.CancelledError:
+            cancelled.set()
+            raise
+
+    with app.app_context(), deadline_scope(time.monotonic() + 0.2):
+        runtime = get_async_runtime()
+        start = time.perf_counter()
+        with pytest.raises(DeadlineExceeded):
+            runtime.run(stuck(), app, 30)
+    assert time.perf_counter() - start < 2
+    assert runtime.run(asyncio.wait_for(cancelled.wait(), 1), app, 2) is True
+
+
+def test_transient_errors_are_retried(stub_app):
+    failed_once = set()
+
+    def fault(method, path):
+        # the first call for each client fails
+        if path == '/balances' and len(failed_once) < len(CLIENTS):
+            failed_once.add(len(failed_once))
+            return 503
+        return None
+
+    # the failures come all at once, keep the circuit closed for them
+    server, app = stub_app(fault, EBURY_RETRY_BACKOFF=0.01, EBURY_CIRCUIT_FAILURES=20)
+    with app.app_context():
+        balances = ebury_api.get_ebury_balance()
+
+    assert server.faults == len(CLIENTS)
+    assert errors_in(balances) == 0
+
+
+def test_retries_are_limited_by_the_budget(stub_app):
+    clients = [f'CLIENT{i:04d}' for i in range(200)]
+    server, app = stub_app(lambda method, path: 503 if path == '/balances' else None, clients,
+                           EBURY_RETRY_BACKOFF=0.001, EBURY_CIRCUIT_FAILURES=10 ** 6,
+                           EBURY_RETRY_BUDGET_RATIO=0.1, EBURY_RETRY_BUDGET_MIN_PER_SECOND=5)
+    with app.app_context():
+        budget = resilience.get_upstream_policy().budget.max_balance
+        ebury_api.get_ebury_balance()
+
+    retries = server.calls['/balances'] - len(clients)
+    # without a budget every client would be tried 3 times, 400 retries
+    assert retries <= budget + 0.1 * len(clients) + 5 * 2
+
+
+def test_circuit_opens_fails_fast_and_closes(stub_app):
+    state = {'fault': 'reset'}
+    server, app = stub_app(lambda method, path: state['fault'] if path == '/balances' else None,
+                           EBURY_MAX_CONCURRENCY=1, EBURY_CIRCUIT_FAILURES=5, EBURY_CIRCUIT_RESET_TIMEOUT=1,
+                           EBURY_RETRY_BACKOFF=0.001)
+    with app.app_context():
+        balances = ebury_api.get_ebury_balance()
+        # the first client's attempts and the second's first two open it, the others fail fast
+        calls = server.calls['/balances']
+        assert calls == 5
+        assert sum(1 for balance in balances.values() if 'Circuit open' in balance.get('error', '')) == len(CLIENTS) - 1
+
+        balances = ebury_api.get_ebury_balance()
+        assert server.calls['/balances'] == calls
+        assert errors_in(balances) == len(CLIENTS)
+
+        state['fault'] = None
+        time.sleep(1.1)
+        balances = ebury_api.get_ebury_balance()
+        assert errors_in(balances) == 0
+        assert resilience.get_upstream_policy().snapshot()['circuits'][urlsplit(server.url).netloc]['state'] == 'closed'
+
+
+def test_mutations_are_not_retried(stub_app):
+    server, app = stub_app(lambda method, path: 503 if path == '/webhooks/graphql' else None,
+                           EBURY_RETRY_BACKOFF=0.001)
+    with app.app_context():
+        with pytest.raises(Exception):
+            ebury_api.disable_webhook_subscription(CLIENTS[0], 'subscription')
+        mutation_calls = server.calls['/webhooks/graphql']
+        with pytest.raises(Exception):
+            ebury_api.get_client_webhook_subscriptions(CLIENTS[0])
+        query_calls = server.calls['/webhooks/graphql'] - mutation_calls
+
+    assert mutation_calls == 1
+    assert query_calls == 3
+
+
+def open_breaker(reset_timeout=0):
+    breaker = CircuitBreaker('host', failure_threshold=1, reset_timeout=reset_timeout)
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    return breaker
+
+
+def test_half_open_circuit_lets_one_trial_through():
+    breaker = open_breaker()
+    assert breaker.before_call() is True
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+    breaker.record(True)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.before_call() is False
+
+
+def test_released_trial_lets_the_next_call_be_the_trial():
+    breaker = open_breaker()
+    assert breaker.before_call() is True
+    breaker.release_trial()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert breaker.before_call() is True
+
+
+def test_failed_trial_opens_the_circuit_again():
+    breaker = open_breaker(reset_timeout=0.05)
+    time.sleep(0.06)
+    assert breaker.before_call() is True
+    breaker.record(False)
+    assert breaker.state == CircuitBreaker.OPEN
+    with pytest.raises(CircuitOpenError):
+        breaker.before_call()
+
+
+# A trial that ends with an error the client doesn't record (not a requests error)
+# must not leave the circuit half open with a trial that never ends
+def test_unrecorded_trial_is_released(stub_app, monkeypatch):
+    state = {'fault': 503}
+    server, app = stub_app(lambda method, path: state['fault'] if path == '/balances' else None)
+    client = EburyHttpClient(policy=UpstreamPolicy(attempts=1, failure_threshold=1, reset_timeout=0.05))
+    url = f'{server.url}balances?client_id={CLIENTS[0]}'
+    try:
+        assert client.get(url).status_code == 503
+        breaker = client.policy.breaker(urlsplit(server.url).netloc)
+        assert breaker.state == CircuitBreaker.OPEN
+
+        time.sleep(0.06)
+        with monkeypatch.context() as patch:
+            patch.setattr(client.session, 'request', lambda *args, **kwargs: (_ for _ in ()).throw(ValueError('bad')))
+            with pytest.raises(ValueError):
+                client.get(url)
+        assert breaker.state == CircuitBreaker.HALF_OPEN
+
+        state['fault'] = None
+        assert client.get(url).status_code == 200
+        assert breaker.state == CircuitBreaker.CLOSED
+    finally:
+        client.close()
@@ -0,0 +1,67 @@
+# Request threads never wait on the auth server while the token is renewed in the
+# background (see app/token_manager.py). The stub holds the renewal on an event, so
+# the request threads ask for the token while it is known to be in flight.
+import threading
+import time
+
+import pytest
+
+from app import ebury_api
+from app.token_manager import TokenManager, TokenState
+from benchmarks.common import make_app
+from benchmarks.stub_server import StubServer
+
+THREADS = 16
+
+
+@pytest.mark.parametrize('store', ['memory', 'sqlite'])
+def test_requests_use_the_current_token_while_it_is_renewed(tmp_path, store):
+    gate = threading.Event()
+    # renewed tokens never need renewing again during the test
+    server = StubServer(latency=0.001, token_latency=0, expires_in=10 ** 6, token_gate=gate).start()
+    app = make_app(
+        EBURY_AUTHENTICATION_URL=server.url,
+        EBURY_API_URL=server.url,
+        # the first token is due for renewal as soon as it is set
+        EBURY_TOKEN_REFRESH_AHEAD=3600,
+        EBURY_TOKEN_REFRESH_JITTER=0,
+        EBURY_CREDENTIAL_STORE=store,
+        EBURY_CREDENTIAL_STORE_PATH=str(tmp_path / 'credentials.db'),
+    )
+    # a manager of its own, so the refresher thread runs against this app
+    manager = TokenManager(ebury_api.renew_token)
+    tokens = []
+    lock = threading.Lock()
+
+    def request_thread():
+        with app.app_context():
+            seen = [manager.get_access_token() for _ in range(100)]
+        with lock:
+            tokens.extend(seen)
+
+    try:
+        with app.app_context():
+            manager.set_state(TokenState('token-0', 'refresh-token-0', time.time() + 3600, []))
+        assert server.token_held.wait(5), "the token was not renewed in the background"
+
+        threads = [threading.Thread(target=request_thread, daemon=True) for _ in range(THREADS)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join(5)
+        assert not any(thread.is_alive() for thread in threads), "a request thread waited on the renewal"
+        assert tokens == ['token-0'] * THREADS * 100
+
+        gate.set()
+        with app.app_context():
+            end = time.monotonic() + 5
+            while manager.current().access_token == 'token-0' and time.monotonic() < end:
+                time.sleep(0.01)
+            assert manager.get_access_token() == 'token-1'
+            stats = manager.snapshot()
+        assert stats['background_refreshes'] == 1
+        assert stats['blocking_refreshes'] == 0
+        assert server.token_requests == 1
+    finally:
+        gate.set()
+        server.shutdown()